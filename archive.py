@@ -0,0 +1,23 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# summary: export oplogs into an archive, or replay an archive
+
+from gevent import monkey
+monkey.patch_all()
+
+from mongosync.command_options import ArchiveCommandOptions
+from mongosync.logger import Logger
+
+if __name__ == '__main__':
+    conf = ArchiveCommandOptions.parse()
+    Logger.init(conf.logfilepath)
+
+    from mongosync.mongo.archive import OplogExporter, ArchiveSyncer
+    from mongosync.oplog_archive import ArchiveReader
+    if conf.mode == 'export':
+        OplogExporter(conf).run()
+    else:
+        archive = ArchiveReader(conf.archive_path)
+        ArchiveSyncer(conf.sync_conf, archive).run()
+        archive.close()
@@ -0,0 +1,26 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# summary: oplog replay benchmark
+
+from gevent import monkey
+monkey.patch_all()
+
+from mongosync.command_options import BenchmarkCommandOptions
+from mongosync.logger import Logger
+
+if __name__ == '__main__':
+    conf = BenchmarkCommandOptions.parse()
+    Logger.init(conf.logfilepath)
+
+    from mongosync.benchmark.replay_benchmark import ReplayBenchmark
+    res = ReplayBenchmark(conf).run()
+
+    print '=' * 48
+    for key in sorted(res.iterkeys()):
+        val = res[key]
+        if isinstance(val, float):
+            print '%-16s:  %.3f' % (key, val)
+        else:
+            print '%-16s:  %s' % (key, val)
+    print '=' * 48
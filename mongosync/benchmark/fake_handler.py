@@ -0,0 +1,122 @@
+import collections
+import bson
+import gevent
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from mongosync.mongo.handler import MongoHandler
+
+
+class BenchmarkDone(Exception):
+    """ All oplogs are replayed.
+    """
+    pass
+
+
+class FakeClient(object):
+    """ MongoClient stub that only provides what replay needs.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.is_mongos = False
+
+    def close(self):
+        pass
+
+
+class FakeOplogCursor(object):
+    """ Tailable cursor over oplogs encoded in BSON.
+
+    Oplogs are decoded on reading like a real cursor.
+    When exhausted, raise BenchmarkDone if is_done() returns True, otherwise wait a moment like an awaitable cursor.
+    """
+    def __init__(self, data, raw, is_done):
+        self._data = data
+        self._pos = 0
+        self._codec_options = CodecOptions(document_class=RawBSONDocument if raw else SON)
+        self._is_done = is_done
+        self.alive = True
+
+    def next(self):
+        if self._pos < len(self._data):
+            data = self._data[self._pos]
+            self._pos += 1
+            return bson.BSON(data).decode(codec_options=self._codec_options)
+        if self._is_done():
+            raise BenchmarkDone()
+        gevent.sleep(0.01)
+        raise StopIteration
+
+    def close(self):
+        self.alive = False
+
+
+class FakeSourceHandler(object):
+    """ Source that serves oplogs in memory.
+    """
+    def __init__(self, data, is_done):
+        """
+        Parameter:
+          - data: list of oplogs encoded in BSON
+          - is_done: function that tells whether all oplogs are replayed
+        """
+        self._data = data
+        self._is_done = is_done
+        self._mc = FakeClient(('benchmark', 0))
+
+    def client(self):
+        return self._mc
+
+    def reconnect(self):
+        pass
+
+    def tail_oplog(self, start_optime=None, await_time_ms=None, raw=False, ns_query=None, projection=None):
+        return FakeOplogCursor(self._data, raw, self._is_done)
+
+
+class FakeMongoHandler(MongoHandler):
+    """ Destination that records writes in memory.
+
+    Latency of a round trip to server is simulated by sleeping.
+    """
+    def __init__(self, latency_ms=1.0, op_latency_us=0.0):
+        """
+        Parameter:
+          - latency_ms: milliseconds of a request
+          - op_latency_us: microseconds of each operation in a request
+        """
+        self._latency = latency_ms / 1000.0
+        self._op_latency = op_latency_us / 1000000.0
+        self._mc = FakeClient(('fake', 0))
+        self._shard_router = None
+        self.n_requests = 0
+        self.n_commands = 0
+        self.n_ops = collections.Counter()  # {operation type: count}
+
+    def connect(self):
+        return True
+
+    def reconnect(self):
+        pass
+
+    def enable_shard_routing(self):
+        pass
+
+    def bulk_write(self, dbname, collname, reqs, ordered=True, ignore_duplicate_key_error=False):
+        self.n_requests += 1
+        for req in reqs:
+            self.n_ops[type(req).__name__] += 1
+        self._wait(len(reqs))
+
+    def apply_oplog(self, oplog, ignore_duplicate_key_error=False):
+        self.n_requests += 1
+        if oplog['op'] == 'c':
+            self.n_commands += 1
+        else:
+            self.n_ops[oplog['op']] += 1
+        self._wait(1)
+
+    def _wait(self, n_ops):
+        t = self._latency + self._op_latency * n_ops
+        if t > 0:
+            gevent.sleep(t)
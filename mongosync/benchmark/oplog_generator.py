@@ -0,0 +1,116 @@
+import bisect
+import random
+import time
+from bson.son import SON
+from bson.timestamp import Timestamp
+
+
+class OplogGenerator(object):
+    """ Generate a synthetic oplog stream.
+
+    Namespaces are picked with a Zipf distribution, updates and deletes hit hot keys with a probability.
+    The first oplog is a no-op, which is the start optime of replay.
+    """
+    def __init__(self, n_namespaces=10, mix=(60, 30, 9, 1), ns_skew=1.0, hot_keys=0.5, n_hot_keys=100, doc_size=256, seed=0):
+        """
+        Parameter:
+          - n_namespaces: namespace count
+          - mix: weights of (insert, update, delete, command)
+          - ns_skew: exponent of Zipf distribution of namespaces, 0 means uniform
+          - hot_keys: probability that an update or delete hits hot keys
+          - n_hot_keys: hot key count of a namespace
+          - doc_size: approximate bytes of an inserted document
+        """
+        assert n_namespaces > 0
+        assert len(mix) == 4 and sum(mix) > 0
+        self._namespaces = ['bench.coll%d' % i for i in xrange(n_namespaces)]
+        self._ns_weights = self._cumulate([1.0 / (i + 1) ** ns_skew for i in xrange(n_namespaces)])
+        self._op_weights = self._cumulate(mix)
+        self._hot_keys = hot_keys
+        self._n_hot_keys = n_hot_keys
+        self._doc_size = doc_size
+        self._random = random.Random(seed)
+        self._n_inserted = dict((ns, 0) for ns in self._namespaces)  # inserted _id are 0, 1, 2, ...
+        self._n_commands = 0
+
+    def generate(self, n):
+        """ Generate n oplogs.
+        """
+        now = int(time.time())
+        yield SON([('ts', Timestamp(now, 1)), ('op', 'n'), ('ns', ''), ('o', {'msg': 'benchmark'})])
+        for i in xrange(1, n):
+            ts = Timestamp(now, i + 1)
+            ns = self._namespaces[self._pick(self._ns_weights)]
+            op = 'iudc'[self._pick(self._op_weights)]
+            if op != 'c' and self._n_inserted[ns] == 0:
+                op = 'i'
+            if op == 'i':
+                yield self._gen_insert(ts, ns)
+            elif op == 'u':
+                yield self._gen_update(ts, ns)
+            elif op == 'd':
+                yield SON([('ts', ts), ('op', 'd'), ('ns', ns), ('o', {'_id': self._pick_id(ns)})])
+            else:
+                yield self._gen_command(ts, ns)
+
+    def _gen_insert(self, ts, ns):
+        _id = self._n_inserted[ns]
+        self._n_inserted[ns] += 1
+        return SON([('ts', ts), ('op', 'i'), ('ns', ns), ('o', self._gen_doc(_id))])
+
+    def _gen_update(self, ts, ns):
+        _id = self._pick_id(ns)
+        r = self._random.random()
+        if r < 0.1:
+            o = self._gen_doc(_id)  # replacement
+        elif r < 0.5:
+            o = {'$inc': {'n': 1}}
+        else:
+            o = {'$set': {'name': self._gen_str(16)}}
+        return SON([('ts', ts), ('op', 'u'), ('ns', ns), ('o2', {'_id': _id}), ('o', o)])
+
+    def _gen_command(self, ts, ns):
+        """ Create or drop a temporary collection in database of namespace.
+        """
+        dbname = ns.split('.', 1)[0]
+        collname = 'tmp%d' % (self._n_commands / 2)
+        o = {'create': collname} if self._n_commands % 2 == 0 else {'drop': collname}
+        self._n_commands += 1
+        return SON([('ts', ts), ('op', 'c'), ('ns', '%s.$cmd' % dbname), ('o', o)])
+
+    def _gen_doc(self, _id):
+        doc = SON([('_id', _id), ('name', self._gen_str(16)), ('n', 0)])
+        doc['payload'] = 'x' * max(self._doc_size - 64, 0)
+        return doc
+
+    def _gen_str(self, n):
+        return ''.join([self._random.choice('abcdefghijklmnopqrstuvwxyz') for i in xrange(n)])
+
+    def _pick_id(self, ns):
+        n = self._n_inserted[ns]
+        if self._random.random() < self._hot_keys:
+            return self._random.randint(0, min(n, self._n_hot_keys) - 1)
+        return self._random.randint(0, n - 1)
+
+    def _pick(self, cum_weights):
+        return bisect.bisect_right(cum_weights, self._random.random() * cum_weights[-1])
+
+    @staticmethod
+    def _cumulate(weights):
+        res = []
+        total = 0
+        for w in weights:
+            total += w
+            res.append(total)
+        return res
+
+
+# test case
+if __name__ == '__main__':
+    g = OplogGenerator(n_namespaces=3, mix=(1, 1, 1, 1))
+    oplogs = list(g.generate(1000))
+    assert len(oplogs) == 1000
+    assert oplogs[0]['op'] == 'n'
+    assert all(oplogs[i]['ts'] < oplogs[i + 1]['ts'] for i in xrange(999))
+    assert set(oplog['op'] for oplog in oplogs) == set(['n', 'i', 'u', 'd', 'c'])
+    print 'test cases all pass'
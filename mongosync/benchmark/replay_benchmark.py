@@ -0,0 +1,116 @@
+import resource
+import time
+import bson
+from mongosync.common_syncer import CommonSyncer, Stage
+from mongosync.config import BenchmarkConfig
+from mongosync.logger import Logger
+from mongosync.mongo.handler import MongoHandler
+from mongosync.mongo.syncer import MongoSyncer
+from mongosync.benchmark.fake_handler import BenchmarkDone, FakeMongoHandler, FakeSourceHandler
+from mongosync.benchmark.oplog_generator import OplogGenerator
+
+log = Logger.get()
+
+
+class BenchmarkSyncer(MongoSyncer):
+    """ MongoSyncer that replays oplogs from a fake source and records latency of batches.
+    """
+    def __init__(self, conf, src, dst):
+        CommonSyncer.__init__(self, conf)
+        self._src = src
+        self._dst = dst
+        self._oplog_hub = None
+        self._spool = None
+        self._init_shards()
+        self._init_replayer()
+        self._stage = Stage.oplog_sync
+        self.batch_latencies = []
+
+    def _flush_oplogs(self):
+        start_time = time.time()
+        MongoSyncer._flush_oplogs(self)
+        self.batch_latencies.append(time.time() - start_time)
+
+    @property
+    def last_optime(self):
+        return self._last_optime
+
+
+class ReplayBenchmark(object):
+    """ Measure throughput of oplog replay.
+
+    Oplogs are generated and encoded in advance, then replayed by MongoSyncer
+    into a fake destination or a real MongoDB.
+    """
+    def __init__(self, conf):
+        assert isinstance(conf, BenchmarkConfig)
+        self._conf = conf
+
+    def run(self):
+        """ Run benchmark and return a dict of results.
+        """
+        conf = self._conf
+        generator = OplogGenerator(n_namespaces=conf.n_namespaces,
+                                   mix=conf.mix,
+                                   ns_skew=conf.ns_skew,
+                                   hot_keys=conf.hot_keys,
+                                   n_hot_keys=conf.n_hot_keys,
+                                   doc_size=conf.doc_size,
+                                   seed=conf.seed)
+        oplogs = list(generator.generate(conf.n_oplogs))
+        start_optime = oplogs[0]['ts']
+        end_optime = oplogs[-1]['ts']
+        data = [bson.BSON.encode(oplog) for oplog in oplogs]
+        n_bytes = sum(len(d) for d in data)
+        log.info('generated %d oplogs, %d bytes' % (len(data), n_bytes))
+        del oplogs
+
+        if conf.sync_conf.dst_conf.hosts:
+            dst = MongoHandler(conf.sync_conf.dst_conf)
+            if not dst.connect():
+                raise RuntimeError('connect to mongodb(dst) failed: %s' % conf.sync_conf.dst_hostportstr)
+        else:
+            if conf.sync_conf.replay_processes > 0:
+                raise RuntimeError('replay processes require a real destination')
+            dst = FakeMongoHandler(latency_ms=conf.dst_latency_ms, op_latency_us=conf.dst_op_latency_us)
+
+        syncer = None
+        src = FakeSourceHandler(data, lambda: syncer.last_optime == end_optime)
+        syncer = BenchmarkSyncer(conf.sync_conf, src, dst)
+
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        start_time = time.time()
+        try:
+            syncer._replay_oplog(start_optime)
+        except BenchmarkDone:
+            pass
+        elapsed = time.time() - start_time
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+
+        latencies = sorted(syncer.batch_latencies)
+        res = {'oplogs': len(data),
+               'bytes': n_bytes,
+               'seconds': elapsed,
+               'ops_per_sec': len(data) / elapsed,
+               'mb_per_sec': n_bytes / elapsed / 1024 / 1024,
+               'batches': len(latencies),
+               'batch_p50_ms': percentile(latencies, 50) * 1000,
+               'batch_p90_ms': percentile(latencies, 90) * 1000,
+               'batch_p99_ms': percentile(latencies, 99) * 1000,
+               'batch_max_ms': (latencies[-1] if latencies else 0) * 1000,
+               'cpu_us_per_op': cpu / len(data) * 1000000}
+        if isinstance(dst, FakeMongoHandler):
+            res['requests'] = dst.n_requests
+            res['commands'] = dst.n_commands
+            res['writes'] = dict(dst.n_ops)
+        return res
+
+
+def percentile(sorted_vals, p):
+    """ Return the p-th percentile of sorted values, 0 if empty.
+    """
+    if not sorted_vals:
+        return 0
+    pos = int(round((len(sorted_vals) - 1) * p / 100.0))
+    return sorted_vals[pos]
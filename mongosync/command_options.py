@@ -1,7 +1,7 @@
 import sys
 import argparse
 from bson.timestamp import Timestamp
-from mongosync.config import Config, CheckConfig
+from mongosync.config import Config, CheckConfig, BenchmarkConfig, ArchiveConfig, MongoConfig
 from mongosync.config_file import ConfigFile
 from mongosync.mongo_utils import parse_hostportstr
 from mongosync.optime_logger import OptimeLogger
@@ -28,7 +28,10 @@ class CommandOptions(object):
         parser.add_argument('--dst-password', nargs='?', required=False, help='dst password, for MongoDB')
         parser.add_argument('--start-optime', type=int, nargs='?', required=False, help='timestamp in second, indicates oplog based increment sync')
         parser.add_argument('--optime-logfile', nargs='?', required=False, help="optime log file path, use this as start optime if without '--start-optime'")
+        parser.add_argument('--optime-ns', nargs='?', required=False, help="record optime in this collection of destination after each batch and resume from it if without '--start-optime', for MongoDB")
+        parser.add_argument('--optime-name', nargs='?', required=False, help='name of sync task in optime collection, default is src hostportstr')
         parser.add_argument('--logfile', nargs='?', required=False, help='log file path')
+        parser.add_argument('--metrics-listen', nargs='?', required=False, help="serve metrics in Prometheus format at http://METRICS_LISTEN/metrics, e.g. '0.0.0.0:9216'")
 
         args = parser.parse_args()
 
@@ -57,8 +60,14 @@ class CommandOptions(object):
             if args.start_optime is None:
                 optime_logger = OptimeLogger(args.optime_logfile)
                 conf.start_optime = optime_logger.read()
+        if args.optime_ns is not None:
+            conf.optime_logns = args.optime_ns
+        if args.optime_name is not None:
+            conf.optime_logname = args.optime_name
         if args.logfile is not None:
             conf.logfilepath = args.logfile
+        if args.metrics_listen is not None:
+            conf.metrics_listen = args.metrics_listen
 
         return conf
 
@@ -100,3 +109,87 @@ class CheckCommandOptions(object):
             sys.exit(1)
 
         return conf
+
+
+class BenchmarkCommandOptions(object):
+    """ Benchmark command options.
+    """
+    @staticmethod
+    def parse():
+        """ Parse command options and generate config.
+        """
+        conf = BenchmarkConfig()
+
+        parser = argparse.ArgumentParser(description='Benchmark oplog replay with synthetic oplogs.')
+        parser.add_argument('-n', '--oplogs', type=int, nargs='?', default=conf.n_oplogs, help='oplog count, default is %(default)s')
+        parser.add_argument('--namespaces', type=int, nargs='?', default=conf.n_namespaces, help='namespace count, default is %(default)s')
+        parser.add_argument('--mix', nargs='?', default=':'.join(map(str, conf.mix)), help="weights of insert:update:delete:command, default is '%(default)s'")
+        parser.add_argument('--ns-skew', type=float, nargs='?', default=conf.ns_skew, help='exponent of Zipf distribution of namespaces, 0 means uniform, default is %(default)s')
+        parser.add_argument('--hot-keys', type=float, nargs='?', default=conf.hot_keys, help='probability that an update or delete hits hot keys, default is %(default)s')
+        parser.add_argument('--n-hot-keys', type=int, nargs='?', default=conf.n_hot_keys, help='hot key count of a namespace, default is %(default)s')
+        parser.add_argument('--doc-size', type=int, nargs='?', default=conf.doc_size, help='bytes of an inserted document, default is %(default)s')
+        parser.add_argument('--seed', type=int, nargs='?', default=conf.seed, help='random seed, default is %(default)s')
+        parser.add_argument('--dst', nargs='?', required=False, help='hostportstr of a local mongod, replay into a fake destination if not set')
+        parser.add_argument('--dst-latency-ms', type=float, nargs='?', default=conf.dst_latency_ms, help='milliseconds of a request to fake destination, default is %(default)s')
+        parser.add_argument('--dst-op-latency-us', type=float, nargs='?', default=conf.dst_op_latency_us, help='microseconds of each operation to fake destination, default is %(default)s')
+        parser.add_argument('-f', '--config', nargs='?', required=False, help='configuration file to load replay options')
+        parser.add_argument('--logfile', nargs='?', required=False, help='log file path')
+
+        args = parser.parse_args()
+
+        conf.n_oplogs = args.oplogs
+        conf.n_namespaces = args.namespaces
+        conf.mix = tuple(int(w) for w in args.mix.split(':'))
+        if len(conf.mix) != 4:
+            print "Terminated, '--mix' expects 4 weights"
+            sys.exit(1)
+        conf.ns_skew = args.ns_skew
+        conf.hot_keys = args.hot_keys
+        conf.n_hot_keys = args.n_hot_keys
+        conf.doc_size = args.doc_size
+        conf.seed = args.seed
+        conf.dst_latency_ms = args.dst_latency_ms
+        conf.dst_op_latency_us = args.dst_op_latency_us
+        if args.logfile is not None:
+            conf.logfilepath = args.logfile
+
+        conf.sync_conf = ConfigFile.load(args.config) if args.config is not None else Config()
+        conf.sync_conf.src_conf = MongoConfig(u'benchmark', 'admin', '', '')
+        conf.sync_conf.dst_conf = MongoConfig(unicode(args.dst) if args.dst else u'', 'admin', '', '')
+        return conf
+
+
+class ArchiveCommandOptions(object):
+    """ Archive command options.
+    """
+    @staticmethod
+    def parse():
+        """ Parse command options and generate config.
+        """
+        conf = ArchiveConfig()
+
+        parser = argparse.ArgumentParser(description='Export oplogs of source into an archive, or replay an archive into destination.')
+        subparsers = parser.add_subparsers(dest='mode')
+        export_parser = subparsers.add_parser('export', help='export oplogs of source into an archive')
+        import_parser = subparsers.add_parser('import', help='replay oplogs of an archive into destination')
+        for p in (export_parser, import_parser):
+            p.add_argument('-f', '--config', nargs='?', required=True, help='configuration file, source, destination, data filter and replay options are loaded')
+            p.add_argument('--archive', nargs='?', required=True, help='archive file path')
+            p.add_argument('--start-optime', type=int, nargs='?', required=False, help='timestamp in second, export or replay from this optime')
+            p.add_argument('--logfile', nargs='?', required=False, help='log file path')
+        export_parser.add_argument('--end-optime', type=int, nargs='?', required=False, help='timestamp in second, export until this optime, default is the latest optime of source')
+
+        args = parser.parse_args()
+
+        conf.mode = args.mode
+        conf.archive_path = args.archive
+        if args.start_optime is not None:
+            conf.start_optime = Timestamp(args.start_optime, 0)
+        if conf.mode == 'export' and args.end_optime is not None:
+            conf.end_optime = Timestamp(args.end_optime, 0xffffffff)
+        if args.logfile is not None:
+            conf.logfilepath = args.logfile
+        conf.sync_conf = ConfigFile.load(args.config)
+        # start optime of sync is ignored, replay resumes from the recorded optime if without '--start-optime'
+        conf.sync_conf.start_optime = conf.start_optime
+        return conf
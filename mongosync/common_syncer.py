@@ -3,6 +3,7 @@ import time
 import datetime
 import exceptions
 import gevent
+from mongosync import metrics, partitioner
 from mongosync.config import Config
 from mongosync.logger import Logger
 from mongosync.mongo_utils import get_optime
@@ -49,9 +50,12 @@ class CommonSyncer(object):
         self._optime_log_interval = 10  # default 10s
         self._last_optime = None  # optime of the last oplog was applied
         self._last_optime_logtime = time.time()
+        self._last_logged_optime = None
 
         self._log_interval = 2  # default 2s
         self._last_logtime = time.time()  # use in oplog replay
+        self._lag_gauge = metrics.REPLAY_LAG.labels(conf.dst_hostportstr)
+        self._optime_gauge = metrics.REPLAY_OPTIME.labels(conf.dst_hostportstr)
 
         # for large collections
         self._n_workers = 8  # multi-process
@@ -59,9 +63,12 @@ class CommonSyncer(object):
 
         self._initial_sync_start_optime = None
         self._initial_sync_end_optime = None
+        self._initial_sync_state = None  # progress of initial sync to resume from
 
         self._stage = Stage.stopped
         self._oplog_batchsize = 1000
+        self._oplog_prefetch_batches = 8
+        self._oplog_prefetch_bytes = 64 * 1024 * 1024  # 64MB
 
     @property
     def from_to(self):
@@ -92,31 +99,53 @@ class CommonSyncer(object):
         """
         if self._conf.start_optime:
             log.info("locating oplog, it will take a while")
-            doc = self._src.client()['local']['oplog.rs'].find_one({'ts': {'$gte': self._conf.start_optime}})
-            if not doc:
+            start_optime = self._locate_start_optime(self._conf.start_optime)
+            if not start_optime:
                 log.error('oplog is stale')
                 return
-            start_optime = doc['ts']
             log.info('start timestamp is %s actually' % start_optime)
             self._stage = Stage.oplog_sync
             self._replay_oplog(start_optime)
         else:
             # initial sync
             log.info('step into stage: initial_sync')
-            self._initial_sync_start_optime = get_optime(self._src.client())
+            self._initial_sync_start_optime = self._start_initial_sync()
             self._stage = Stage.initial_sync
             self._initial_sync()
 
             # markup post initial sync
             log.info('step into stage: post_initial_sync')
             self._stage = Stage.post_initial_sync
-            self._initial_sync_end_optime = get_optime(self._src.client())
+            self._initial_sync_end_optime = self._get_end_optime()
 
             # oplog sync
             if self._optime_logger:
                 self._optime_logger.write(self._initial_sync_start_optime)
+            if self._initial_sync_state:
+                self._initial_sync_state.clear()
             self._replay_oplog(self._initial_sync_start_optime)
 
+    def _locate_start_optime(self, optime):
+        """ Return ts of the first oplog at or after optime, None if not found.
+        """
+        doc = self._src.client()['local']['oplog.rs'].find_one({'ts': {'$gte': optime}})
+        return doc['ts'] if doc else None
+
+    def _start_initial_sync(self):
+        """ Return optime to replay oplog from after initial sync.
+        """
+        return self._get_start_optime()
+
+    def _get_start_optime(self):
+        """ Get optime to replay oplog from, before initial sync.
+        """
+        return get_optime(self._src.client())
+
+    def _get_end_optime(self):
+        """ Get optime that initial sync is done at.
+        """
+        return get_optime(self._src.client())
+
     def _collect_colls(self):
         """ Collect collections to sync.
         """
@@ -137,39 +166,10 @@ class CommonSyncer(object):
     def _split_coll(self, namespace_tuple, n_partitions):
         """ Split a collection into n partitions.
 
-        Return a list of split points.
-
-        splitPointCount = partitionCount - 1
-        splitPointCount = keyTotalCount / (keyCount + 1)
-        keyCount = maxChunkSize / (2 * avgObjSize)
-        =>
-        maxChunkSize = (keyTotalCount / (partionCount - 1) - 1) * 2 * avgObjSize
-
-        Note: maxChunkObjects is default 250000.
+        Return a list of split points, [] if not able to split.
         """
-        if n_partitions <= 1:
-            raise RuntimeError('n_partitions need greater than 1, but %s' % n_partitions)
-
         dbname, collname = namespace_tuple
-        ns = '.'.join(namespace_tuple)
-        db = self._src.client()[dbname]
-        collstats = db.command('collstats', collname)
-
-        if 'avgObjSize' not in collstats:  # empty collection
-            return []
-
-        n_points = n_partitions - 1
-        max_chunk_size = ((collstats['count'] / (n_partitions - 1) - 1) * 2 * collstats['avgObjSize']) / 1024 / 1024
-
-        if max_chunk_size <= 0:
-            return []
-
-        res = db.command('splitVector', ns, keyPattern={'_id': 1}, maxSplitPoints=n_points, maxChunkSize=max_chunk_size, maxChunkObjects=collstats['count'])
-
-        if res['ok'] != 1:
-            return []
-        else:
-            return [doc['_id'] for doc in res['splitKeys']]
+        return partitioner.split_coll(self._src.client()[dbname][collname], n_partitions, self._conf.partitioner)
 
     def _initial_sync(self):
         """ Initial sync.
@@ -182,6 +182,7 @@ class CommonSyncer(object):
                 if points:
                     large_colls.append((ns_tuple, points))
                 else:
+                    log.warn('%s.%s is not split, copy it with a single cursor' % ns_tuple)
                     small_colls.append(ns_tuple)
             else:
                 small_colls.append(ns_tuple)
@@ -242,6 +243,8 @@ class CommonSyncer(object):
         """ Print progress periodically.
         """
         now = time.time()
+        self._lag_gauge.set(now - self._last_optime.time)
+        self._optime_gauge.set(self._last_optime.time)
         if now - self._last_logtime >= self._log_interval:
             delay = now - self._last_optime.time
             time_unit = 'second' if delay <= 1 else 'seconds'
@@ -265,8 +268,17 @@ class CommonSyncer(object):
         """
         if not self._optime_logger:
             return
+        if optime == self._last_logged_optime:
+            return
         now = time.time()
         if now - self._last_optime_logtime >= self._optime_log_interval:
-            self._optime_logger.write(optime)
+            self._optime_logger.write(optime, self._optime_partitions())
             self._last_optime_logtime = now
-            log.info("flush optime into file '%s': %s" % (self._optime_logger.filepath, optime))
+            self._last_logged_optime = optime
+            if isinstance(self._optime_logger, OptimeLogger):
+                log.info("flush optime into file '%s': %s" % (self._optime_logger.filepath, optime))
+
+    def _optime_partitions(self):
+        """ Return positions of partitions to record with optime.
+        """
+        return None
@@ -14,12 +14,41 @@ class CheckConfig(object):
         self.dst_db = ''
 
 
+class BenchmarkConfig(object):
+    def __init__(self):
+        self.n_oplogs = 100000
+        self.n_namespaces = 10
+        self.mix = (60, 30, 9, 1)  # weights of insert, update, delete and command
+        self.ns_skew = 1.0  # exponent of Zipf distribution of namespaces
+        self.hot_keys = 0.5  # probability that an update or delete hits hot keys
+        self.n_hot_keys = 100
+        self.doc_size = 256
+        self.seed = 0
+        self.dst_latency_ms = 1.0  # for fake destination
+        self.dst_op_latency_us = 10.0  # for fake destination
+        self.logfilepath = ''
+        self.sync_conf = None  # replay options and destination, fake destination if dst hosts is empty
+
+
+class ArchiveConfig(object):
+    def __init__(self):
+        self.mode = None  # 'export' or 'import'
+        self.archive_path = ''
+        self.start_optime = None
+        self.end_optime = None  # for export, default is the latest optime of source
+        self.logfilepath = ''
+        self.sync_conf = None  # source, destination, data filter and replay options
+
+
 class MongoConfig(object):
     def __init__(self, hosts, authdb, username, password):
         self.hosts = hosts
         self.authdb = authdb
         self.username = username
         self.password = password
+        self.write_concern = {}  # options of pymongo.WriteConcern for writes, w=1 if empty
+        self.max_pool_size = 100
+        self.min_pool_size = 0
 
 
 class EsConfig(object):
@@ -33,6 +62,7 @@ class Config(object):
     def __init__(self):
         self.src_conf = None
         self.dst_conf = None
+        self.dst_confs = []  # all destinations, oplogs are read once and fanned out if more than one
 
         self.data_filter = DataFilter()
 
@@ -43,8 +73,47 @@ class Config(object):
         self.fieldmap = {}
 
         self.start_optime = None
+        self.partitioner = 'auto'  # split large collections for initial sync, see mongosync.partitioner
+        self.initial_sync_workers = 0  # processes to copy collections, 0 means by cores
         self.optime_logfilepath = ''
+        self.optime_logns = ''  # record optime in a collection of destination
+        self.optime_logname = ''  # name of sync task in optime collection, default is src hostportstr
         self.logfilepath = ''
+        self.metrics_listen = ''  # hostportstr to serve metrics, not served if empty
+
+        # oplog replay options
+        self.replay_batch_size = 1000  # oplogs applied in a batch
+        self.replay_vector_size = 40  # oplogs of a namespace in a bulk write
+        self.replay_writers = 10  # concurrent bulk writes
+        self.replay_processes = 0  # apply oplogs in processes if greater than 0
+        self.replay_max_latency = 1.0  # seconds that an oplog waits in buffer at most
+        self.replay_adaptive = False
+        self.replay_lazy_decode = False
+        self.replay_oplog_projection = False
+        self.replay_shard_routing = False
+        self.replay_coalesce = False
+        self.replay_fanout_buffer = 64  # batches buffered for each destination if several destinations
+        self.replay_error_policy = 'abort'  # 'abort', 'ignore' or 'dead_letter' for a failed write
+        self.replay_dead_letter_path = ''  # file to record failed writes if error policy is 'dead_letter'
+
+        # write concern tiers of destination, options of pymongo.WriteConcern, w=1 if empty
+        self.write_concern_initial_sync = {}
+        self.write_concern_replay = {}
+        self.write_concern_checkpoint = {}  # optime recorded in destination
+
+        # oplog spool
+        self.spool_path = ''  # directory to spool oplogs of source, not spooled if empty
+        self.spool_segment_bytes = 64 * 1024 * 1024
+        self.spool_max_bytes = 10 * 1024 * 1024 * 1024
+        self.spool_compress = False
+
+        # admission control of destination writes
+        self.admission_enabled = False
+        self.admission_max_rate = 0  # operations per second, 0 means unlimited until destination is busy
+        self.admission_min_rate = 100
+        self.admission_max_lag = 10  # seconds of replication lag of secondaries
+        self.admission_max_dirty_ratio = 0.1  # ratio of dirty bytes in WiredTiger cache
+        self.admission_max_queued_writers = 16
 
     @property
     def src_hostportstr(self):
@@ -104,13 +173,56 @@ class Config(object):
                 f('dst password    :  %s' % self.dst_conf.password)
                 f('dst db version  :  %s' % get_version(self.dst_conf.hosts))
 
+        if len(self.dst_confs) > 1:
+            f('all dsts        :  %s' % ', '.join([self.hostportstr(dst_conf.hosts) for dst_conf in self.dst_confs]))
+            f('fan-out buffer  :  %d' % self.replay_fanout_buffer)
+
         f('databases       :  %s' % ', '.join(self.data_filter._related_dbs))
         f('collections     :  %s' % ', '.join(self.data_filter._include_colls))
         f('db mapping      :  %s' % self.dbmap_str)
         f('fileds          :  %s' % self.fieldmap_str)
 
         f('start optime    :  %s' % self.start_optime)
+        f('partitioner     :  %s' % self.partitioner)
+        f('sync workers    :  %d' % self.initial_sync_workers)
         f('optime logfile  :  %s' % self.optime_logfilepath)
+        f('optime logns    :  %s' % self.optime_logns)
+        f('optime logname  :  %s' % self.optime_logname)
         f('log filepath    :  %s' % self.logfilepath)
+        f('metrics listen  :  %s' % self.metrics_listen)
+        f('replay batch    :  %d' % self.replay_batch_size)
+        f('replay vector   :  %d' % self.replay_vector_size)
+        f('replay writers  :  %d' % self.replay_writers)
+        f('replay processes:  %d' % self.replay_processes)
+        f('replay latency  :  %.3fs' % self.replay_max_latency)
+        f('replay adaptive :  %s' % self.replay_adaptive)
+        f('replay coalesce :  %s' % self.replay_coalesce)
+        f('lazy decode     :  %s' % self.replay_lazy_decode)
+        f('oplog projection:  %s' % self.replay_oplog_projection)
+        f('shard routing   :  %s' % self.replay_shard_routing)
+        f('write concern   :  initial sync %s, replay %s, checkpoint %s' % (format_write_concern(self.write_concern_initial_sync),
+                                                                            format_write_concern(self.write_concern_replay),
+                                                                            format_write_concern(self.write_concern_checkpoint)))
+        f('error policy    :  %s' % self.replay_error_policy)
+        if self.replay_error_policy == 'dead_letter':
+            f('dead letter     :  %s' % self.replay_dead_letter_path)
+        f('spool path      :  %s' % self.spool_path)
+        if self.spool_path:
+            f('spool size      :  %dMB segment, %dMB at most' % (self.spool_segment_bytes / 1024 / 1024, self.spool_max_bytes / 1024 / 1024))
+            f('spool compress  :  %s' % self.spool_compress)
+        f('admission       :  %s' % self.admission_enabled)
+        if self.admission_enabled:
+            f('admission rate  :  %d-%d ops/s' % (self.admission_min_rate, self.admission_max_rate))
+            f('admission limit :  lag %ds, dirty cache %.1f%%, %d queued writers' % (self.admission_max_lag,
+                                                                                     self.admission_max_dirty_ratio * 100,
+                                                                                     self.admission_max_queued_writers))
         f('pymongo version :  %s' % pymongo.version)
         f('================================================')
+
+
+def format_write_concern(options):
+    """ Format options of write concern, e.g. 'w=majority,j=True'.
+    """
+    if not options:
+        return 'w=1'
+    return ','.join('%s=%s' % (k, options[k]) for k in sorted(options.iterkeys()))
@@ -1,7 +1,11 @@
 import toml
 from bson.timestamp import Timestamp
 from mongosync.config import Config, MongoConfig, EsConfig
+from mongosync.dead_letter import ERROR_POLICIES
 from mongosync.mongo_utils import gen_namespace
+from mongosync.partitioner import PARTITIONERS
+
+WRITE_CONCERN_OPTIONS = ('w', 'j', 'wtimeout')
 
 
 class ConfigFile(object):
@@ -16,15 +20,19 @@ class ConfigFile(object):
                                     tml['src'].get('username', ''),
                                     tml['src'].get('password', ''))
 
-        if type not in tml['dst'] or tml['dst']['type'] == 'mongo':
-            conf.dst_conf = MongoConfig(tml['dst']['hosts'],
-                                        tml['dst'].get('authdb', 'admin'),
-                                        tml['dst'].get('username', ''),
-                                        tml['dst'].get('password', ''))
-        elif tml['dst']['type'] == 'es':
-            conf.dst_conf = EsConfig(tml['dst']['hosts'])
-        else:
-            raise Exception('invalid dst.type')
+        # [dst] for a destination, or [[dst]] for several destinations
+        dsts = tml['dst'] if isinstance(tml['dst'], list) else [tml['dst']]
+        for dst in dsts:
+            if 'type' not in dst or dst['type'] == 'mongo':
+                conf.dst_confs.append(MongoConfig(dst['hosts'],
+                                                  dst.get('authdb', 'admin'),
+                                                  dst.get('username', ''),
+                                                  dst.get('password', '')))
+            elif dst['type'] == 'es':
+                conf.dst_confs.append(EsConfig(dst['hosts']))
+            else:
+                raise Exception('invalid dst.type')
+        conf.dst_conf = conf.dst_confs[0]
 
         if 'sync' in tml and 'dbs' in tml['sync']:
             for dbentry in tml['sync']['dbs']:
@@ -73,8 +81,64 @@ class ConfigFile(object):
 
         if 'sync' in tml and 'start_optime' in tml['sync']:
             conf.start_optime = Timestamp(tml['sync']['start_optime'], 0)
+        if 'sync' in tml and 'partitioner' in tml['sync']:
+            conf.partitioner = tml['sync']['partitioner']
+            if conf.partitioner not in PARTITIONERS:
+                raise Exception('invalid sync.partitioner: %s' % conf.partitioner)
+        if 'sync' in tml and 'workers' in tml['sync']:
+            conf.initial_sync_workers = tml['sync']['workers']
 
         if 'log' in tml and 'filepath' in tml['log']:
             conf.logfilepath = tml['log']['filepath']
+        if 'log' in tml and 'optime_ns' in tml['log']:
+            conf.optime_logns = tml['log']['optime_ns']
+        if 'log' in tml and 'optime_name' in tml['log']:
+            conf.optime_logname = tml['log']['optime_name']
+
+        if 'metrics' in tml and 'listen' in tml['metrics']:
+            conf.metrics_listen = tml['metrics']['listen']
+
+        if 'replay' in tml:
+            conf.replay_batch_size = tml['replay'].get('batch_size', conf.replay_batch_size)
+            conf.replay_vector_size = tml['replay'].get('vector_size', conf.replay_vector_size)
+            conf.replay_writers = tml['replay'].get('writers', conf.replay_writers)
+            conf.replay_processes = tml['replay'].get('processes', conf.replay_processes)
+            if 'max_latency_ms' in tml['replay']:
+                conf.replay_max_latency = tml['replay']['max_latency_ms'] / 1000.0
+            conf.replay_adaptive = tml['replay'].get('adaptive', False)
+            conf.replay_coalesce = tml['replay'].get('coalesce', False)
+            conf.replay_lazy_decode = tml['replay'].get('lazy_decode', False)
+            conf.replay_oplog_projection = tml['replay'].get('oplog_projection', False)
+            conf.replay_shard_routing = tml['replay'].get('shard_routing', False)
+            conf.replay_fanout_buffer = tml['replay'].get('fanout_buffer', conf.replay_fanout_buffer)
+            conf.replay_error_policy = tml['replay'].get('error_policy', conf.replay_error_policy)
+            if conf.replay_error_policy not in ERROR_POLICIES:
+                raise Exception('invalid replay.error_policy: %s' % conf.replay_error_policy)
+            conf.replay_dead_letter_path = tml['replay'].get('dead_letter_path', '')
+            if conf.replay_error_policy == 'dead_letter' and not conf.replay_dead_letter_path:
+                raise Exception("replay.dead_letter_path is required if replay.error_policy is 'dead_letter'")
+
+        if 'write_concern' in tml:
+            for tier in ('initial_sync', 'replay', 'checkpoint'):
+                options = tml['write_concern'].get(tier, {})
+                if not isinstance(options, dict) or set(options.iterkeys()) - set(WRITE_CONCERN_OPTIONS):
+                    raise Exception('invalid write_concern.%s: %s' % (tier, options))
+                setattr(conf, 'write_concern_%s' % tier, dict(options))
+
+        if 'spool' in tml:
+            conf.spool_path = tml['spool'].get('path', '')
+            if 'segment_mb' in tml['spool']:
+                conf.spool_segment_bytes = tml['spool']['segment_mb'] * 1024 * 1024
+            if 'max_mb' in tml['spool']:
+                conf.spool_max_bytes = tml['spool']['max_mb'] * 1024 * 1024
+            conf.spool_compress = tml['spool'].get('compress', False)
+
+        if 'admission' in tml:
+            conf.admission_enabled = tml['admission'].get('enabled', False)
+            conf.admission_max_rate = tml['admission'].get('max_rate', conf.admission_max_rate)
+            conf.admission_min_rate = tml['admission'].get('min_rate', conf.admission_min_rate)
+            conf.admission_max_lag = tml['admission'].get('max_lag', conf.admission_max_lag)
+            conf.admission_max_dirty_ratio = tml['admission'].get('max_dirty_ratio', conf.admission_max_dirty_ratio)
+            conf.admission_max_queued_writers = tml['admission'].get('max_queued_writers', conf.admission_max_queued_writers)
 
         return conf
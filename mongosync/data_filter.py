@@ -1,3 +1,4 @@
+import re
 from mongo_utils import parse_namespace, gen_namespace
 
 
@@ -50,6 +51,34 @@ class DataFilter(object):
         else:
             return self.valid_ns(ns)
 
+    def gen_oplog_ns_query(self):
+        """ Generate query on 'ns' of oplog, which selects the same oplogs as valid_oplog except no-ops.
+
+        Return None if filter is inactive.
+        """
+        if not self._include_colls:
+            return None
+        nss = []
+        wildcard_dbs = []
+        for ns in sorted(self._include_colls):
+            dbname, collname = parse_namespace(ns)
+            if collname == '*':
+                wildcard_dbs.append(dbname)
+            else:
+                nss.append(ns)
+        # commands of related databases
+        for dbname in sorted(self._related_dbs):
+            nss.append(gen_namespace(dbname, '$cmd'))
+        # transactions are applyOps commands of admin, operations are filtered after expanding
+        if 'admin' not in self._related_dbs:
+            nss.append(gen_namespace('admin', '$cmd'))
+
+        query = {'ns': {'$in': nss}}
+        if wildcard_dbs:
+            regex = '^(%s)\\.' % '|'.join([re.escape(dbname) for dbname in wildcard_dbs])
+            query = {'$or': [query, {'ns': {'$regex': regex}}]}
+        return query
+
     @property
     def active(self):
         return True if self._include_colls else False
@@ -92,4 +121,8 @@ if __name__ == '__main__':
     assert f.valid_oplog(oplog8)
     assert f.valid_oplog(oplog9) is False
 
+    assert f.gen_oplog_ns_query() == {'$or': [{'ns': {'$in': ['db1.coll', 'db0.$cmd', 'db1.$cmd', 'admin.$cmd']}},
+                                              {'ns': {'$regex': '^(db0)\\.'}}]}
+    assert DataFilter().gen_oplog_ns_query() is None
+
     print 'test cases all pass'
@@ -0,0 +1,47 @@
+import time
+import bson.json_util
+from bson.son import SON
+
+# policies of a write error that is not retryable
+ERROR_POLICIES = ('abort', 'ignore', 'dead_letter')
+
+
+class DeadLetterFile(object):
+    """ Record failed write requests in file, a request per line in extended JSON.
+
+    Lines are appended with a single write, so processes are able to share a file.
+    """
+    def __init__(self, filepath):
+        assert filepath
+        self._filepath = filepath
+        self._fd = open(filepath, 'ab')
+
+    def __del__(self):
+        self._fd.close()
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+    def write(self, ns, req, code, errmsg):
+        """ Append a failed request of bulk write or a failed oplog.
+        """
+        doc = SON([('time', time.time()), ('ns', ns), ('code', code), ('errmsg', errmsg)])
+        if isinstance(req, dict):
+            # oplog applied alone
+            doc['oplog'] = req
+        else:
+            doc.update(request_to_doc(req))
+        self._fd.write(bson.json_util.dumps(doc) + '\n')
+        self._fd.flush()
+
+
+def request_to_doc(req):
+    """ Convert a write request of bulk write to document.
+    """
+    doc = SON([('op', type(req).__name__)])
+    for attr in ('filter', 'doc', 'upsert'):
+        val = getattr(req, '_' + attr, None)
+        if val is not None:
+            doc[attr] = val
+    return doc
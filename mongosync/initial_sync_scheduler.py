@@ -0,0 +1,99 @@
+import collections
+import multiprocessing
+import gevent
+import gevent.socket
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+# a part of collection to copy
+# size is estimated bytes, a larger task is scheduled earlier
+CopyTask = collections.namedtuple('CopyTask', ['namespace_tuple', 'part', 'query', 'size'])
+
+
+class InitialSyncScheduler(object):
+    """ Copy tasks of all collections by a pool of worker processes.
+
+    Tasks are kept largest-first in the main process, and an idle worker takes the next task,
+    so a slow task only holds its own worker, and small collections are copied beside large ones.
+    Workers report to the main process through pipes:
+      ('progress', ns, n) - n documents more are copied
+      ('done', task, n) - task is done with n documents copied
+    """
+    def __init__(self, n_workers, init_worker, run_task):
+        """
+        Parameter:
+          - n_workers: worker process count
+          - init_worker: function called at start of a worker, e.g. to reconnect
+          - run_task: function called with (task, progress) in a worker, return count of documents copied,
+                      progress is a function to report count of documents copied periodically
+        """
+        assert n_workers > 0
+        self._n_workers = n_workers
+        self._init_worker = init_worker
+        self._run_task = run_task
+
+    def run(self, tasks, on_progress, on_done):
+        """ Run tasks until all are done.
+
+        Parameter:
+          - on_progress: function called with (ns, n) in the main process
+          - on_done: function called with (task, n) in the main process
+        """
+        if not tasks:
+            return
+        pending = collections.deque(sorted(tasks, key=lambda task: task.size, reverse=True))
+        n_workers = min(self._n_workers, len(tasks))
+
+        workers = []
+        for i in xrange(n_workers):
+            # use one-way pipes rather than socket pair, which is non-blocking after monkey patching
+            task_r, task_w = multiprocessing.Pipe(duplex=False)
+            msg_r, msg_w = multiprocessing.Pipe(duplex=False)
+            p = multiprocessing.Process(target=copy_worker,
+                                        args=(self._init_worker, self._run_task, task_r, msg_w),
+                                        name='copier-%d' % i)
+            p.daemon = True
+            p.start()
+            task_r.close()
+            msg_w.close()
+            workers.append((p, task_w, msg_r))
+        log.info('copy %d tasks with %d processes' % (len(tasks), n_workers))
+
+        def serve(p, task_w, msg_r):
+            """ Give tasks to a worker one by one until no task is left.
+            """
+            while pending:
+                task_w.send(pending.popleft())
+                while True:
+                    try:
+                        # wait cooperatively, so that other workers are served
+                        gevent.socket.wait_read(msg_r.fileno())
+                        msg = msg_r.recv()
+                    except EOFError:
+                        raise RuntimeError('copy process %s exited' % p.name)
+                    if msg[0] == 'progress':
+                        on_progress(msg[1], msg[2])
+                    else:
+                        on_done(msg[1], msg[2])
+                        break
+            task_w.send(None)
+
+        gevent.joinall([gevent.spawn(serve, *worker) for worker in workers], raise_error=True)
+        for p, task_w, msg_r in workers:
+            p.join()
+            task_w.close()
+            msg_r.close()
+
+
+def copy_worker(init_worker, run_task, task_r, msg_w):
+    """ Run tasks received from pipe until None.
+    """
+    init_worker()
+    while True:
+        task = task_r.recv()
+        if task is None:
+            return
+        ns = '.'.join(task.namespace_tuple)
+        n = run_task(task, lambda n: msg_w.send(('progress', ns, n)))
+        msg_w.send(('done', task, n))
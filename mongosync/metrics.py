@@ -0,0 +1,214 @@
+import bisect
+import multiprocessing.util
+import gevent.pywsgi
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+_registry = []  # all metrics in order of definition
+_servers = []  # servers started, kept for closing them in forked processes
+
+
+class _Value(object):
+    """ Value of a counter or gauge with label values.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets(object):
+    """ Value of a histogram with label values.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+    """ A metric of Prometheus text format.
+
+    Values are kept for each tuple of label values, and returned by labels() for hot paths to update.
+    Metrics are updated in greenlets of the main process without locking,
+    metrics of worker processes are not collected.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def labels(self, *labelvalues):
+        """ Return value of label values, which is created at the first time.
+        """
+        try:
+            return self._values[labelvalues]
+        except KeyError:
+            assert len(labelvalues) == len(self.labelnames)
+            v = self._values[labelvalues] = self._new_value()
+            return v
+
+    def _new_value(self):
+        return _Value()
+
+    def _format_labels(self, labelvalues, extra=()):
+        pairs = zip(self.labelnames, labelvalues) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+    def expose(self):
+        """ Return lines of Prometheus text format.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labelvalues, v in sorted(self._values.iteritems()):
+            lines.append('%s%s %s' % (self.name, self._format_labels(labelvalues), _format_number(v.value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=()):
+        assert buckets and list(buckets) == sorted(buckets)
+        self._bounds = tuple(float(b) for b in buckets)
+        Metric.__init__(self, name, help, labelnames)
+
+    def _new_value(self):
+        return _Buckets(self._bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labelvalues, v in sorted(self._values.iteritems()):
+            n = 0
+            for bound, count in zip(self._bounds + (float('inf'),), v.counts):
+                n += count
+                le = '+Inf' if bound == float('inf') else _format_number(bound)
+                lines.append('%s_bucket%s %d' % (self.name, self._format_labels(labelvalues, [('le', le)]), n))
+            lines.append('%s_sum%s %s' % (self.name, self._format_labels(labelvalues), _format_number(v.sum)))
+            lines.append('%s_count%s %d' % (self.name, self._format_labels(labelvalues), v.count))
+        return lines
+
+
+def _escape(value):
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf-8', 'replace')
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def expose():
+    """ Return all metrics in Prometheus text format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def _app(environ, start_response):
+    if environ['PATH_INFO'] != '/metrics':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['not found, see /metrics\n']
+    body = expose()
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def start_server(host, port):
+    """ Serve metrics at http://host:port/metrics in background.
+
+    Metrics are served by the main process only, a forked process closes the inherited server,
+    otherwise it might accept scrapes with its own metrics.
+    """
+    server = gevent.pywsgi.WSGIServer((host, port), _app, log=None)
+    server.start()
+    _servers.append(server)
+    multiprocessing.util.register_after_fork(server, gevent.pywsgi.WSGIServer.close)
+    log.info('serve metrics at http://%s:%d/metrics' % (host, port))
+    return server
+
+
+# oplog replay
+OPLOGS_READ = Counter('mongosync_oplogs_read_total', 'Oplogs read from source.', ['ns'])
+OPLOGS_APPLIED = Counter('mongosync_oplogs_applied_total', 'Oplogs applied to destination, before coalescing.', ['ns'])
+OPLOGS_SKIPPED = Counter('mongosync_oplogs_skipped_total', 'Oplogs skipped by filter.', ['ns'])
+REPLAY_BATCH_OPLOGS = Histogram('mongosync_replay_batch_oplogs', 'Oplogs applied in a batch.',
+                                buckets=(1, 10, 50, 100, 500, 1000, 2000, 5000, 10000))
+REPLAY_BATCH_SECONDS = Histogram('mongosync_replay_batch_seconds', 'Seconds to apply a batch.',
+                                 buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+REPLAY_BUFFERED_OPLOGS = Gauge('mongosync_replay_buffered_oplogs', 'Oplogs buffered in replayer, not applied yet.')
+READER_QUEUED_BATCHES = Gauge('mongosync_oplog_reader_queued_batches', 'Oplog batches prefetched from source, not consumed yet.')
+REPLAY_LAG = Gauge('mongosync_replay_lag_seconds', 'Seconds between now and the last applied optime.', ['dst'])
+REPLAY_OPTIME = Gauge('mongosync_replay_optime_seconds', 'The last applied optime in seconds since epoch.', ['dst'])
+
+# destination writes
+BULK_WRITE_SECONDS = Histogram('mongosync_bulk_write_seconds', 'Seconds of a successful bulk write.',
+                               buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+BULK_WRITE_OPS = Histogram('mongosync_bulk_write_ops', 'Operations in a bulk write.',
+                           buckets=(1, 2, 5, 10, 20, 40, 100, 200, 500, 1000))
+BULK_WRITE_FALLBACKS = Counter('mongosync_bulk_write_fallbacks_total', 'Failed bulk writes, retried without the failed requests or in halves.', ['ns'])
+DUPLICATE_KEY_ERRORS = Counter('mongosync_duplicate_key_errors_total', 'Duplicate key errors ignored before initial sync is done.', ['ns'])
+WRITE_ERRORS = Counter('mongosync_write_errors_total', 'Failed requests handled by error policy.', ['ns', 'policy'])
+INSERT_UPSERTS = Counter('mongosync_insert_upserts_total', 'Inserts retried as upserts since documents exist.', ['ns'])
+RECONNECTS = Counter('mongosync_reconnects_total', 'Reconnections to servers.', ['host'])
+
+# admission control of destination writes
+ADMISSION_RATE = Gauge('mongosync_admission_rate', 'Operations per second admitted to destination, 0 means unlimited.', ['dst'])
+ADMISSION_WAIT_SECONDS = Counter('mongosync_admission_wait_seconds_total', 'Seconds that writes waited for admission.', ['dst'])
+DST_REPLICATION_LAG = Gauge('mongosync_dst_replication_lag_seconds', 'Replication lag of the slowest secondary of destination.', ['dst'])
+DST_DIRTY_CACHE_RATIO = Gauge('mongosync_dst_dirty_cache_ratio', 'Ratio of dirty bytes in WiredTiger cache of destination.', ['dst'])
+DST_QUEUED_WRITERS = Gauge('mongosync_dst_queued_writers', 'Writers queued for locks on destination.', ['dst'])
+
+# oplog spool
+SPOOL_BYTES = Gauge('mongosync_spool_bytes', 'Bytes of spool segment files.', ['path'])
+SPOOL_BACKLOG_BYTES = Gauge('mongosync_spool_backlog_bytes', 'Bytes of spooled oplogs that are not read by applier.', ['path'])
+
+# initial sync
+INITIAL_SYNC_DOCS = Counter('mongosync_initial_sync_docs_total', 'Documents copied by initial sync.', ['ns'])
+INITIAL_SYNC_BYTES = Counter('mongosync_initial_sync_bytes_total', 'Bytes copied by initial sync, estimated by average document size.', ['ns'])
@@ -0,0 +1,202 @@
+import time
+import gevent
+import pymongo
+from mongosync import metrics, mongo_utils
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+
+class AdmissionController(object):
+    """ Limit write rate to destination with a token bucket, and tune the rate by health of destination.
+
+    Health signals are polled periodically from serverStatus and replSetGetStatus of destination,
+    or of shards if destination is a mongos:
+      - replication lag of secondaries
+      - ratio of dirty bytes in WiredTiger cache
+      - writers queued for locks
+    The rate is tuned in AIMD way, it's decreased multiplicatively if any signal is over its limit,
+    and increased additively while destination is healthy and the rate is fully used.
+    The rate is unlimited until destination is unhealthy at the first time, if max rate is not specified.
+    """
+    def __init__(self, mongo_handler, max_rate=0, min_rate=100,
+                 max_lag=10, max_dirty_ratio=0.1, max_queued_writers=16, interval=1.0):
+        """
+        Parameter:
+          - mongo_handler: MongoHandler of destination
+          - max_rate: maximum operations per second, 0 means unlimited
+          - min_rate: minimum operations per second
+          - max_lag: maximum replication lag in seconds of secondaries
+          - max_dirty_ratio: maximum ratio of dirty bytes in WiredTiger cache
+          - max_queued_writers: maximum writers queued for locks
+          - interval: seconds between polls
+        """
+        assert max_rate >= 0
+        assert min_rate > 0
+        assert interval > 0
+        self._mongo_handler = mongo_handler
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._max_lag = max_lag
+        self._max_dirty_ratio = max_dirty_ratio
+        self._max_queued_writers = max_queued_writers
+        self._interval = interval
+        self._burst = 0.5  # seconds of tokens that bucket holds at most
+
+        self._rate = float(max_rate) if max_rate > 0 else None  # None means unlimited
+        self._tokens = 0.0
+        self._last_refill = time.time()
+        self._admitted = 0  # operations admitted since the last poll
+
+        self._shard_clients = {}  # {shard: MongoClient} if destination is a mongos
+        dst = mongo_handler._conf.hosts
+        self._rate_gauge = metrics.ADMISSION_RATE.labels(dst)
+        self._rate_gauge.set(self._rate or 0)
+        self._wait_counter = metrics.ADMISSION_WAIT_SECONDS.labels(dst)
+        self._lag_gauge = metrics.DST_REPLICATION_LAG.labels(dst)
+        self._dirty_gauge = metrics.DST_DIRTY_CACHE_RATIO.labels(dst)
+        self._queued_gauge = metrics.DST_QUEUED_WRITERS.labels(dst)
+        self._greenlet = gevent.spawn(self._run)
+
+    @property
+    def rate(self):
+        """ Return operations per second, None if unlimited.
+        """
+        return self._rate
+
+    def acquire(self, n):
+        """ Wait until n operations are admitted.
+
+        A bulk write larger than the bucket is admitted once tokens are available, and takes tokens in advance,
+        so the following writes wait longer.
+        """
+        self._admitted += n
+        if self._rate is None:
+            return
+        wait_start = None
+        while True:
+            now = time.time()
+            self._tokens = min(self._rate * self._burst, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            if self._tokens > 0:
+                break
+            if wait_start is None:
+                wait_start = now
+            gevent.sleep(-self._tokens / self._rate)
+        self._tokens -= n
+        if wait_start is not None:
+            self._wait_counter.inc(time.time() - wait_start)
+
+    def stop(self):
+        """ Stop polling.
+        """
+        self._greenlet.kill()
+        for mc in self._shard_clients.itervalues():
+            mc.close()
+        self._shard_clients.clear()
+
+    def _run(self):
+        """ Poll health signals and tune rate periodically.
+        """
+        last_poll = time.time()
+        while True:
+            gevent.sleep(self._interval)
+            now = time.time()
+            observed = self._admitted / (now - last_poll)
+            self._admitted = 0
+            last_poll = now
+            try:
+                lag, dirty_ratio, queued_writers = self._poll()
+            except Exception as e:
+                # keep the rate if destination is unavailable, writers are retrying anyway
+                log.error('poll destination health failed: %s' % e)
+                continue
+            self._lag_gauge.set(lag)
+            self._dirty_gauge.set(dirty_ratio)
+            self._queued_gauge.set(queued_writers)
+            reasons = []
+            if lag > self._max_lag:
+                reasons.append('replication lag %ds' % lag)
+            if dirty_ratio > self._max_dirty_ratio:
+                reasons.append('dirty cache %.1f%%' % (dirty_ratio * 100))
+            if queued_writers > self._max_queued_writers:
+                reasons.append('%d queued writers' % queued_writers)
+            self._tune(observed, reasons)
+
+    def _tune(self, observed, reasons):
+        """ Tune rate with the observed rate and the reasons that destination is unhealthy.
+        """
+        if reasons:
+            # decrease from what destination actually took, a limit far above it takes no effect
+            base = observed if self._rate is None else min(self._rate, observed)
+            rate = max(self._min_rate, base * 0.7)
+            if self._rate is None or rate < self._rate:
+                log.info('destination is busy (%s), limit write rate to %d ops/s' % (', '.join(reasons), rate))
+            self._set_rate(rate)
+        elif self._rate is not None and observed >= self._rate * 0.9:
+            # probe slowly while the rate is fully used
+            rate = self._rate + max(self._min_rate, self._rate * 0.05)
+            if self._max_rate > 0:
+                rate = min(rate, self._max_rate)
+            self._set_rate(rate)
+
+    def _set_rate(self, rate):
+        if self._rate is None:
+            # start with an empty bucket
+            self._tokens = 0.0
+            self._last_refill = time.time()
+        self._rate = float(rate)
+        self._rate_gauge.set(self._rate)
+
+    def _poll(self):
+        """ Return (replication lag, dirty cache ratio, queued writers), the worst of destination or shards.
+        """
+        lag = 0
+        dirty_ratio = 0.0
+        queued_writers = 0
+        for mc in self._clients():
+            status = mc['admin'].command('serverStatus')
+            cache = status.get('wiredTiger', {}).get('cache', {})
+            if cache.get('maximum bytes configured'):
+                dirty_ratio = max(dirty_ratio, float(cache['tracked dirty bytes in the cache']) / cache['maximum bytes configured'])
+            queued_writers = max(queued_writers, status['globalLock']['currentQueue']['writers'])
+            try:
+                rs_status = mc['admin'].command('replSetGetStatus')
+            except pymongo.errors.OperationFailure:
+                # standalone
+                continue
+            lag = max(lag, get_replication_lag(rs_status))
+        return lag, dirty_ratio, queued_writers
+
+    def _clients(self):
+        """ Return clients to poll.
+        """
+        mc = self._mongo_handler.client()
+        if not mc.is_mongos:
+            return [mc]
+        # mongos reports no storage and replication status, poll shards directly
+        for shard in mc['config']['shards'].find():
+            if shard['_id'] not in self._shard_clients:
+                # host is 'replset/host0:port0,host1:port1' or 'host:port'
+                host, port = mongo_utils.parse_hostportstr(shard['host'].split('/')[-1].split(',')[0])
+                conf = self._mongo_handler._conf
+                self._shard_clients[shard['_id']] = mongo_utils.connect(host, port,
+                                                                        authdb=conf.authdb,
+                                                                        username=conf.username,
+                                                                        password=conf.password)
+        return self._shard_clients.values()
+
+
+def get_replication_lag(rs_status):
+    """ Return seconds that the slowest secondary is behind primary in replSetGetStatus.
+    """
+    primary_optime = None
+    secondary_optimes = []
+    for member in rs_status['members']:
+        if member['state'] == 1:
+            primary_optime = member['optimeDate']
+        elif member['state'] == 2:
+            secondary_optimes.append(member['optimeDate'])
+    if primary_optime is None or not secondary_optimes:
+        return 0
+    return max(0, (primary_optime - min(secondary_optimes)).total_seconds())
@@ -0,0 +1,169 @@
+import time
+import bson
+from mongosync import mongo_utils
+from mongosync.common_syncer import CommonSyncer, Stage
+from mongosync.config import ArchiveConfig
+from mongosync.logger import Logger
+from mongosync.mongo.handler import MongoHandler
+from mongosync.mongo.optime_logger import MongoOptimeLogger
+from mongosync.mongo.syncer import MongoSyncer
+from mongosync.oplog_archive import ArchiveDone, ArchiveOplogReader, ArchiveWriter
+from mongosync.transaction_buffer import is_transaction_oplog
+
+log = Logger.get()
+
+
+class OplogExporter(object):
+    """ Export oplogs of a time range from source into an archive.
+
+    Oplogs are filtered like oplog replay, no-ops are dropped.
+    """
+    def __init__(self, conf):
+        assert isinstance(conf, ArchiveConfig)
+        self._conf = conf
+        self._sync_conf = conf.sync_conf
+        self._src = MongoHandler(self._sync_conf.src_conf)
+        if not self._src.connect():
+            raise RuntimeError('connect to mongodb(src) failed: %s' % self._sync_conf.src_hostportstr)
+        if self._src.client().is_mongos:
+            raise RuntimeError('export from sharded cluster is not supported, export from each shard instead')
+
+    def run(self):
+        """ Export and return count of oplogs.
+        """
+        coll = self._src.client()['local'].get_collection('oplog.rs',
+                                                          codec_options=bson.codec_options.CodecOptions(document_class=bson.raw_bson.RawBSONDocument))
+        end_optime = self._conf.end_optime or mongo_utils.get_optime(self._src.client())
+        start_optime = self._conf.start_optime
+        if start_optime is None:
+            start_optime = coll.find_one(sort=[('$natural', 1)])['ts']
+        query = {'fromMigrate': {'$exists': False}, 'ts': {'$gte': start_optime, '$lte': end_optime}}
+        ns_query = self._sync_conf.data_filter.gen_oplog_ns_query()
+        if ns_query:
+            query.update(ns_query)
+        log.info('export oplogs from %s to %s into %s' % (start_optime, end_optime, self._conf.archive_path))
+
+        data_filter = self._sync_conf.data_filter
+        writer = ArchiveWriter(self._conf.archive_path)
+        n_read = 0
+        last_logtime = time.time()
+        for oplog in coll.find(query, oplog_replay=True):
+            n_read += 1
+            if is_transaction_oplog(oplog) and 'lsid' in oplog:
+                # oplogs of a transaction are kept together, operations are filtered after expanding in replay
+                pass
+            elif mongo_utils.is_apply_ops(oplog):
+                # operations are filtered after expanding in replay
+                if not any(data_filter.valid_oplog(op) for op in mongo_utils.expand_apply_ops(oplog)):
+                    continue
+            elif oplog['op'] == 'n' or not data_filter.valid_oplog(oplog):
+                continue
+            writer.write(oplog)
+            now = time.time()
+            if now - last_logtime >= 10:
+                log.info('exported %d of %d oplogs, at %s' % (writer.count, n_read, oplog['ts']))
+                last_logtime = now
+        writer.close()
+        log.info('exported %d of %d oplogs, from %s to %s' % (writer.count, n_read, start_optime, writer.last_optime))
+        return writer.count
+
+
+class ArchiveClient(object):
+    """ Client of archive source, it provides what oplog replay needs.
+    """
+    def __init__(self, path):
+        self.address = (path, 0)
+        self.is_mongos = False
+
+
+class ArchiveSource(object):
+    """ Archive in place of MongoHandler of source.
+    """
+    def __init__(self, path):
+        self._mc = ArchiveClient(path)
+
+    def client(self):
+        return self._mc
+
+    def reconnect(self):
+        pass
+
+
+class ArchiveSyncer(MongoSyncer):
+    """ MongoSyncer that replays oplogs of an archive without source.
+
+    Oplogs go through the same replay path as oplogs of source, including renaming, filtering and concurrent replay.
+    """
+    def __init__(self, conf, archive):
+        """
+        Parameter:
+          - archive: ArchiveReader
+        """
+        CommonSyncer.__init__(self, conf)
+        self._archive = archive
+        self._src = ArchiveSource(archive.path)
+        self._oplog_hub = None
+        self._spool = None
+        self._init_shards()
+        self._init_pool_size()
+        self._dst = MongoHandler(self._conf.dst_conf)
+        if not self._dst.connect():
+            raise RuntimeError('connect to mongodb(dst) failed: %s' % self._conf.dst_hostportstr)
+        if self._conf.optime_logns:
+            self._optime_logger = MongoOptimeLogger(self._dst,
+                                                    self._conf.optime_logns,
+                                                    self._conf.optime_logname or self._conf.src_hostportstr,
+                                                    write_concern=self._conf.write_concern_checkpoint)
+            self._optime_log_interval = 0
+        self._init_write_concern()
+        self._init_replayer()
+        if self._conf.admission_enabled:
+            self._dst.enable_admission_control(**self._admission_options())
+
+    def run(self):
+        """ Replay oplogs from start optime until the end of archive.
+        """
+        start_optime = self._conf.start_optime
+        if start_optime is None and self._optime_logger:
+            start_optime = self._optime_logger.read()
+            if start_optime:
+                log.info("resume from optime in '%s': %s" % (self._conf.optime_logns, start_optime))
+        if start_optime is None:
+            start_optime = self._archive.first_optime
+        else:
+            start_optime = self._archive.locate(start_optime)
+        if start_optime is None:
+            log.info('no oplog to replay in %s' % self._archive.path)
+            return
+        log.info('replay oplogs from %s to %s in %s' % (start_optime, self._archive.last_optime, self._archive.path))
+        self._stage = Stage.oplog_sync
+        start_time = time.time()
+        try:
+            self._replay_oplog(start_optime)
+        except ArchiveDone:
+            # all oplogs are applied, including skipped ones at the end
+            self._last_optime = self._archive.last_optime
+            if self._optime_logger:
+                self._optime_logger.write(self._last_optime)
+        log.info('replayed oplogs to %s in %.1fs' % (self._last_optime, time.time() - start_time))
+
+    def _fetch_oplog(self, query):
+        """ Return an oplog of archive by query, None if not found.
+        """
+        for ts, data in self._archive.iter_raw(query['ts']):
+            if ts != query['ts']:
+                break
+            oplog = bson.BSON(data).decode(codec_options=bson.codec_options.CodecOptions(document_class=bson.son.SON))
+            if 'lsid' in oplog and oplog['lsid']['id'] == query['lsid.id'] and oplog.get('txnNumber') == query['txnNumber']:
+                return oplog
+        return None
+
+    def _open_oplog_reader(self):
+        """ Return a reader of archive from the last optime.
+
+        It's done once all oplogs are read and applied.
+        """
+        return ArchiveOplogReader(self._archive,
+                                  self._last_optime,
+                                  self._conf.replay_lazy_decode,
+                                  lambda: self._multi_oplog_replayer.count() == 0)
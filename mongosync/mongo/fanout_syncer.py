@@ -0,0 +1,63 @@
+import copy
+import gevent
+from mongosync.config import Config, MongoConfig
+from mongosync.logger import Logger
+from mongosync.mongo.handler import MongoHandler
+from mongosync.mongo.syncer import MongoSyncer
+from mongosync.oplog_hub import OplogHub
+
+log = Logger.get()
+
+
+class FanoutSyncer(object):
+    """ Synchronizer from a replica set to several MongoDB destinations.
+
+    Each destination is synced by a MongoSyncer with its own initial sync, replay options and optime,
+    while oplogs are read and decoded once and fanned out to them.
+    """
+    def __init__(self, conf):
+        if not isinstance(conf, Config):
+            raise RuntimeError('invalid config type')
+        for dst_conf in conf.dst_confs:
+            if not isinstance(dst_conf, MongoConfig):
+                raise RuntimeError('invalid dst config type, only MongoDB destinations are supported')
+        sinks = [conf.hostportstr(dst_conf.hosts) for dst_conf in conf.dst_confs]
+        if len(set(sinks)) != len(sinks):
+            raise RuntimeError('duplicate destinations: %s' % ', '.join(sinks))
+        if conf.optime_logfilepath:
+            raise RuntimeError('optime log file is shared by destinations, record optime in destinations instead')
+        if conf.spool_path:
+            raise RuntimeError('oplog spool is not supported with several destinations')
+
+        self._src = MongoHandler(conf.src_conf)
+        if not self._src.connect():
+            raise RuntimeError('connect to mongodb(src) failed: %s' % conf.src_hostportstr)
+        if self._src.client().is_mongos:
+            raise RuntimeError('sharded cluster source is not supported with several destinations')
+
+        self._hub = OplogHub(self._open_reader, self._src.reconnect, sinks, max_batches=conf.replay_fanout_buffer)
+        self._syncers = []
+        for dst_conf in conf.dst_confs:
+            sink_conf = copy.copy(conf)
+            sink_conf.dst_conf = dst_conf
+            sink_conf.dst_confs = [dst_conf]
+            self._syncers.append(MongoSyncer(sink_conf, oplog_hub=self._hub))
+
+    def run(self):
+        """ Start to sync all destinations.
+        """
+        threads = []
+        for syncer in self._syncers:
+            t = gevent.spawn(syncer.run)
+            # a destination that stopped never holds back the others
+            t.link(lambda t, sink=syncer._conf.dst_hostportstr: self._hub.close(sink))
+            threads.append(t)
+        gevent.joinall(threads)
+
+    def _open_reader(self, start_optime):
+        """ Return a started oplog reader of source.
+        """
+        log.info('try to sync oplog from %s on %s:%d' % ((start_optime,) + self._src.client().address))
+        reader = self._syncers[0]._tail_oplog(self._src, start_optime)
+        reader.start()
+        return reader
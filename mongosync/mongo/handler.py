@@ -2,19 +2,38 @@ import sys
 import time
 import pymongo
 import bson
-from mongosync import mongo_utils
+from mongosync import metrics, mongo_utils
 from mongosync.config import MongoConfig
+from mongosync.dead_letter import DeadLetterFile, ERROR_POLICIES
 from mongosync.logger import Logger
+from mongosync.mongo.admission_controller import AdmissionController
+from mongosync.mongo.shard_router import ShardRouter, STALE_CONFIG_CODES
 
 log = Logger.get()
 
 
+# oplog fields used in replay, lsid, txnNumber and prevOpTime are used to buffer transactions
+OPLOG_PROJECTION = {'ts': 1, 'op': 1, 'ns': 1, 'o': 1, 'o2': 1, 'lsid': 1, 'txnNumber': 1, 'prevOpTime': 1}
+
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+# seconds to wait before writing again requests that do not meet write concern, doubled each time
+WRITE_CONCERN_RETRY_DELAY = 1
+WRITE_CONCERN_RETRY_MAX_DELAY = 30
+
+
 class MongoHandler(object):
     def __init__(self, conf):
         if not isinstance(conf, MongoConfig):
             raise Exception('expect MongoConfig')
         self._conf = conf
         self._mc = None
+        self._shard_router = None
+        self._admission_controller = None
+        self._error_policy = 'abort'
+        self._dead_letter = None
+        self._write_concern = None
+        self.set_write_concern(conf.write_concern)
 
     def __del__(self):
         self.close()
@@ -28,7 +47,9 @@ class MongoHandler(object):
                 self._mc = mongo_utils.connect(host, port,
                                                authdb=self._conf.authdb,
                                                username=self._conf.username,
-                                               password=self._conf.password)
+                                               password=self._conf.password,
+                                               max_pool_size=self._conf.max_pool_size,
+                                               min_pool_size=self._conf.min_pool_size)
                 self._mc.admin.command('ismaster')
                 return True
             elif isinstance(self._conf.__hosts, list):
@@ -41,6 +62,7 @@ class MongoHandler(object):
     def reconnect(self):
         """ Try to reconnect until success.
         """
+        metrics.RECONNECTS.labels(self._conf.hosts).inc()
         while True:
             try:
                 self.close()
@@ -61,6 +83,31 @@ class MongoHandler(object):
     def client(self):
         return self._mc
 
+    def enable_shard_routing(self):
+        """ Route bulk writes to shards if connected to a mongos.
+        """
+        if self._mc.is_mongos:
+            self._shard_router = ShardRouter(self._mc)
+        else:
+            log.info('not a mongos, ignore shard routing')
+
+    @property
+    def shard_router(self):
+        return self._shard_router
+
+    def enable_admission_control(self, **options):
+        """ Limit write rate by health of destination, see AdmissionController for options.
+
+        A controller enabled before, e.g. inherited by a forked process, is stopped and replaced.
+        """
+        if self._admission_controller:
+            self._admission_controller.stop()
+        self._admission_controller = AdmissionController(self, **options)
+
+    @property
+    def admission_controller(self):
+        return self._admission_controller
+
     def create_index(self, dbname, collname, keys, **options):
         """ Create index.
         """
@@ -72,60 +119,146 @@ class MongoHandler(object):
                 log.error('%s' % e)
                 self.reconnect()
 
+    def set_write_concern(self, options):
+        """ Set write concern of writes, options of pymongo.WriteConcern, w=1 if empty.
+        """
+        self._write_concern = pymongo.write_concern.WriteConcern(**options) if options else None
+
+    def _coll(self, dbname, collname):
+        """ Return collection to write with write concern.
+        """
+        if self._write_concern is None:
+            return self._mc[dbname][collname]
+        return self._mc[dbname].get_collection(collname, write_concern=self._write_concern)
+
+    def set_error_policy(self, policy, dead_letter_path=''):
+        """ Set policy of a write error that is not retryable.
+
+        Policy is one of 'abort', 'ignore' and 'dead_letter'.
+        """
+        assert policy in ERROR_POLICIES
+        self._error_policy = policy
+        self._dead_letter = DeadLetterFile(dead_letter_path) if policy == 'dead_letter' else None
+
     def bulk_write(self, dbname, collname, reqs, ordered=True, ignore_duplicate_key_error=False):
         """ Bulk write until success.
+
+        If some requests failed, the failed ones are handled by error policy one by one,
+        and the others that are not executed yet are written in bulk again.
         """
-        while True:
+        if self._admission_controller:
+            self._admission_controller.acquire(len(reqs))
+        self._bulk_write(dbname, collname, reqs, ordered, ignore_duplicate_key_error)
+
+    def _bulk_write(self, dbname, collname, reqs, ordered, ignore_duplicate_key_error):
+        ns = mongo_utils.gen_namespace(dbname, collname)
+        write_concern_retry_delay = WRITE_CONCERN_RETRY_DELAY
+        while reqs:
             try:
-                self._mc[dbname][collname].bulk_write(reqs,
-                                                      ordered=ordered,
-                                                      bypass_document_validation=False)
+                start_time = time.time()
+                self._coll(dbname, collname).bulk_write(reqs,
+                                                        ordered=ordered,
+                                                        bypass_document_validation=False)
+                metrics.BULK_WRITE_SECONDS.observe(time.time() - start_time)
+                metrics.BULK_WRITE_OPS.observe(len(reqs))
                 return
             except pymongo.errors.AutoReconnect as e:
                 log.error('%s' % e)
                 self.reconnect()
+            except pymongo.errors.BulkWriteError as e:
+                # requests are retried from details of write errors
+                reqs = self._handle_bulk_write_error(ns, reqs, e, ordered, ignore_duplicate_key_error)
+                if e.details.get('writeConcernErrors'):
+                    time.sleep(write_concern_retry_delay)
+                    write_concern_retry_delay = min(write_concern_retry_delay * 2, WRITE_CONCERN_RETRY_MAX_DELAY)
             except Exception as e:
+                # unknown which request failed, e.g. stale config or a too large request, bisect to find it
                 log.error('bulk write failed: %s' % e)
-                # retry to write one by one
-                for req in reqs:
-                    while True:
-                        try:
-                            if isinstance(req, pymongo.ReplaceOne):
-                                mc[dbname][collname].replace_one(req._filter, req._doc, upsert=req._upsert)
-                            elif isinstance(req, pymongo.InsertOne):
-                                mc[dbname][collname].insert_one(req._doc)
-                            elif isinstance(req, pymongo.UpdateOne):
-                                mc[dbname][collname].update_one(req._filter, req._doc, upsert=req._upsert)
-                            elif isinstance(req, pymongo.DeleteOne):
-                                mc[dbname][collname].delete_one(req._filter)
-                            else:
-                                log.error('invalid req: %s' % req)
-                                sys.exit(1)
-                            break
-                        except pymongo.errors.AutoReconnect as e:
-                            log.error('%s' % e)
-                            self.reconnect()
-                            continue
-                        except pymongo.errors.DuplicateKeyError as e:
-                            if ignore_duplicate_key_error:
-                                log.info('ignore duplicate key error: %s: %s' % (e, req))
-                                break
-                            else:
-                                log.error('%s: %s' % (e, req))
-                                sys.exit(1)
-                        except Exception as e:
-                            # generally it's an odd oplog that program cannot process
-                            # so abort it and bugfix
-                            log.error('%s when excuting %s on %s.%s' % (e, req, dbname, collname))
-                            sys.exit(1)
-
-    def tail_oplog(self, start_optime=None, await_time_ms=None):
+                metrics.BULK_WRITE_FALLBACKS.labels(ns).inc()
+                if self._shard_router and mongo_utils.get_error_codes(e) & STALE_CONFIG_CODES:
+                    self._shard_router.invalidate(ns)
+                if len(reqs) == 1:
+                    self._handle_write_error(ns, reqs[0], getattr(e, 'code', None), str(e), ignore_duplicate_key_error)
+                    return
+                mid = len(reqs) / 2
+                self._bulk_write(dbname, collname, reqs[:mid], ordered, ignore_duplicate_key_error)
+                reqs = reqs[mid:]
+
+    def _handle_bulk_write_error(self, ns, reqs, e, ordered, ignore_duplicate_key_error):
+        """ Handle write errors of a bulk write and return requests to write again.
+
+        An ordered bulk write stops at the failed request, the following ones are not executed,
+        while an unordered bulk write executes all requests.
+        If executed requests do not meet write concern, they are written again,
+        so that the bulk write is not acknowledged and optime is not recorded beyond them.
+        """
+        errors = e.details.get('writeErrors', [])
+        write_concern_errors = e.details.get('writeConcernErrors')
+        if write_concern_errors:
+            log.error('bulk write on %s does not meet write concern, write again: %s' % (ns, write_concern_errors))
+            metrics.BULK_WRITE_FALLBACKS.labels(ns).inc()
+        if not errors:
+            return reqs if write_concern_errors else []
+        retry_reqs = []
+        for err in errors:
+            req = reqs[err['index']]
+            if err.get('code') in DUPLICATE_KEY_CODES and isinstance(req, pymongo.InsertOne) and '_id' in req._doc:
+                # document exists, e.g. oplogs are replayed again after resuming, upsert it
+                metrics.INSERT_UPSERTS.labels(ns).inc()
+                retry_reqs.append(to_upsert(req))
+            else:
+                metrics.BULK_WRITE_FALLBACKS.labels(ns).inc()
+                self._handle_write_error(ns, req, err.get('code'), err.get('errmsg'), ignore_duplicate_key_error)
+        if write_concern_errors:
+            # requests that are executed without error, i.e. before the failed one if ordered
+            failed = set(err['index'] for err in errors)
+            end = errors[0]['index'] if ordered else len(reqs)
+            retry_reqs = [req for i, req in enumerate(reqs[:end]) if i not in failed] + retry_reqs
+        if ordered:
+            retry_reqs.extend(reqs[errors[0]['index'] + 1:])
+        return retry_reqs
+
+    def _handle_write_error(self, ns, req, code, errmsg, ignore_duplicate_key_error):
+        """ Handle a failed request by error policy.
+        """
+        if code in DUPLICATE_KEY_CODES and ignore_duplicate_key_error:
+            log.info('ignore duplicate key error: %s: %s' % (errmsg, req))
+            metrics.DUPLICATE_KEY_ERRORS.labels(ns).inc()
+            return
+        metrics.WRITE_ERRORS.labels(ns, self._error_policy).inc()
+        if self._error_policy == 'ignore':
+            log.error('ignore write error on %s: %s: %s' % (ns, errmsg, req))
+        elif self._error_policy == 'dead_letter':
+            log.error('write error on %s: %s: %s, record in %s' % (ns, errmsg, req, self._dead_letter.filepath))
+            self._dead_letter.write(ns, req, code, errmsg)
+        else:
+            # generally it's an odd oplog that program cannot process
+            # so abort it and bugfix
+            log.error('%s when excuting %s on %s' % (errmsg, req, ns))
+            sys.exit(1)
+
+    def tail_oplog(self, start_optime=None, await_time_ms=None, raw=False, ns_query=None, projection=None):
         """ Return a tailable curosr of local.oplog.rs from the specified optime.
+
+        If raw is True, oplogs are RawBSONDocument that are decoded lazily,
+        embedded documents like 'o' and 'o2' are not decoded until accessed.
+
+        If ns_query is specified, oplogs are filtered by server,
+        no-ops and the oplog of start optime are always returned.
         """
-        # set codec options to guarantee the order of keys in command
+        if raw:
+            document_class = bson.raw_bson.RawBSONDocument
+        else:
+            # set codec options to guarantee the order of keys in command
+            document_class = bson.son.SON
         coll = self._mc['local'].get_collection('oplog.rs',
-                                                codec_options=bson.codec_options.CodecOptions(document_class=bson.son.SON))
-        cursor = coll.find({'fromMigrate': {'$exists': False}, 'ts': {'$gte': start_optime}},
+                                                codec_options=bson.codec_options.CodecOptions(document_class=document_class))
+        query = {'fromMigrate': {'$exists': False}, 'ts': {'$gte': start_optime}}
+        if ns_query:
+            # no-ops advance optime, the oplog of start optime validates that oplog is not stale
+            query['$or'] = [ns_query, {'op': 'n'}, {'ts': start_optime}]
+        cursor = coll.find(query,
+                           projection=projection,
                            cursor_type=pymongo.cursor.CursorType.TAILABLE_AWAIT,
                            no_cursor_timeout=True)
         # New in version 3.2
@@ -137,21 +270,32 @@ class MongoHandler(object):
     def apply_oplog(self, oplog, ignore_duplicate_key_error=False):
         """ Apply oplog.
         """
+        oplog = mongo_utils.decode_raw(oplog)
         dbname, collname = mongo_utils.parse_namespace(oplog['ns'])
+        if self._admission_controller:
+            self._admission_controller.acquire(1)
         while True:
             try:
                 op = oplog['op']  # 'n' or 'i' or 'u' or 'c' or 'd'
                 if op == 'i':  # insert
                     if '_id' in oplog['o']:
-                        self._mc[dbname][collname].replace_one({'_id': oplog['o']['_id']}, oplog['o'], upsert=True)
+                        if ignore_duplicate_key_error:
+                            self._coll(dbname, collname).replace_one({'_id': oplog['o']['_id']}, oplog['o'], upsert=True)
+                        else:
+                            try:
+                                self._coll(dbname, collname).insert_one(oplog['o'])
+                            except pymongo.errors.DuplicateKeyError:
+                                # document exists, e.g. oplogs are replayed again after resuming
+                                metrics.INSERT_UPSERTS.labels(oplog['ns']).inc()
+                                self._coll(dbname, collname).replace_one({'_id': oplog['o']['_id']}, oplog['o'], upsert=True)
                     else:
                         # create index
                         # insert into db.system.indexes
-                        self._mc[dbname][collname].insert(oplog['o'], check_keys=False)
+                        self._coll(dbname, collname).insert(oplog['o'], check_keys=False)
                 elif op == 'u':  # update
-                    self._mc[dbname][collname].update(oplog['o2'], oplog['o'])
+                    self._coll(dbname, collname).update(oplog['o2'], oplog['o'])
                 elif op == 'd':  # delete
-                    self._mc[dbname][collname].delete_one(oplog['o'])
+                    self._coll(dbname, collname).delete_one(oplog['o'])
                 elif op == 'c':  # command
                     # FIX ISSUE #4 and #5
                     # if use '--colls' option to sync target collections,
@@ -165,17 +309,14 @@ class MongoHandler(object):
                     pass
                 else:
                     log.error('invaid op: %s' % oplog)
+                metrics.OPLOGS_APPLIED.labels(oplog['ns']).inc()
                 return
             except pymongo.errors.AutoReconnect as e:
                 self.reconnect()
                 continue
             except pymongo.errors.DuplicateKeyError as e:
-                if ignore_duplicate_key_error:
-                    log.info('ignore duplicate key error: %s :%s' % (e, oplog))
-                    break
-                else:
-                    log.error('%s: %s' % (e, oplog))
-                    sys.exit(1)
+                self._handle_write_error(oplog['ns'], oplog, e.code, str(e), ignore_duplicate_key_error)
+                break
             except pymongo.errors.WriteError as e:
                 log.error('%s' % e)
 
@@ -206,3 +347,9 @@ class MongoHandler(object):
                     if not res.inserted_id:
                         log.error('replay update failed: insert new document failed:', new_doc)
                         sys.exit(1)
+
+
+def to_upsert(req):
+    """ Convert InsertOne to ReplaceOne with upsert.
+    """
+    return pymongo.ReplaceOne({'_id': req._doc['_id']}, req._doc, upsert=True)
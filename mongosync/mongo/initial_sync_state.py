@@ -0,0 +1,109 @@
+import datetime
+import pymongo
+from mongosync import mongo_utils
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+
+class InitialSyncState(object):
+    """ Record progress of initial sync in a collection of destination, so that initial sync resumes after restart.
+
+    Documents of a sync task:
+      {_id: 'name', task: name, start_optime: ts, shard_optimes: {shard: ts}, updatedAt: datetime}
+      {_id: 'name:ns:part', task: name, ns: ns, part: part, lower: _id, upper: _id, last_id: _id, n: count, done: bool, updatedAt: datetime}
+    A collection is copied in parts in order of _id, e.g. 'all', a range of a large collection or documents on a shard.
+    Documents up to last_id of a part are copied, lower and upper are bounds of a range if any.
+    """
+    def __init__(self, mongo_handler, ns, name, write_concern=None):
+        """
+        Parameter:
+          - mongo_handler: MongoHandler of destination
+          - ns: namespace of collection to record progress
+          - name: name of sync task
+          - write_concern: options of pymongo.WriteConcern to record progress, w=1 if empty
+        """
+        assert ns
+        assert name
+        self._mongo_handler = mongo_handler
+        self._dbname, self._collname = mongo_utils.parse_namespace(ns)
+        self._ns = ns
+        self._name = name
+        self._write_concern = pymongo.write_concern.WriteConcern(**write_concern) if write_concern else None
+
+    @property
+    def ns(self):
+        return self._ns
+
+    def read(self):
+        """ Return (start optime, {shard: start optime}) of initial sync, (None, {}) if not started.
+        """
+        doc = self._retry(lambda coll: coll.find_one({'_id': self._name}))
+        if not doc:
+            return None, {}
+        return doc['start_optime'], doc.get('shard_optimes', {})
+
+    def start(self, start_optime, shard_optimes=None):
+        """ Start initial sync over, progress of parts is cleared.
+        """
+        self.clear()
+        doc = {'_id': self._name,
+               'task': self._name,
+               'start_optime': start_optime,
+               'shard_optimes': shard_optimes or {},
+               'updatedAt': datetime.datetime.utcnow()}
+        self._retry(lambda coll: coll.replace_one({'_id': self._name}, doc, upsert=True))
+
+    def clear(self):
+        """ Remove all documents of sync task.
+        """
+        self._retry(lambda coll: coll.delete_many({'task': self._name}))
+
+    def parts(self, ns):
+        """ Return a dict {part: document} of collection.
+        """
+        return dict((doc['part'], doc) for doc in self._retry(lambda coll: list(coll.find({'task': self._name, 'ns': ns}))))
+
+    def get(self, ns, part):
+        """ Return document of a part, None if not recorded.
+        """
+        return self._retry(lambda coll: coll.find_one({'_id': self._part_id(ns, part)}))
+
+    def add_range(self, ns, part, lower=None, upper=None):
+        """ Record bounds of a range part before copying.
+        """
+        doc = {'task': self._name, 'ns': ns, 'part': part, 'n': 0, 'done': False, 'updatedAt': datetime.datetime.utcnow()}
+        if lower is not None:
+            doc['lower'] = lower
+        if upper is not None:
+            doc['upper'] = upper
+        self._retry(lambda coll: coll.replace_one({'_id': self._part_id(ns, part)}, doc, upsert=True))
+
+    def save(self, ns, part, last_id, n, done=False):
+        """ Record that n documents up to last_id of a part are copied.
+        """
+        doc = {'task': self._name, 'ns': ns, 'part': part, 'last_id': last_id, 'n': n, 'done': done,
+               'updatedAt': datetime.datetime.utcnow()}
+        self._retry(lambda coll: coll.update_one({'_id': self._part_id(ns, part)}, {'$set': doc}, upsert=True))
+
+    def done(self, ns, part, n):
+        """ Record that a part is copied.
+        """
+        doc = {'task': self._name, 'ns': ns, 'part': part, 'n': n, 'done': True, 'updatedAt': datetime.datetime.utcnow()}
+        self._retry(lambda coll: coll.update_one({'_id': self._part_id(ns, part)}, {'$set': doc}, upsert=True))
+
+    def _part_id(self, ns, part):
+        return '%s:%s:%s' % (self._name, ns, part)
+
+    def _retry(self, func):
+        """ Call func with collection until success.
+        """
+        while True:
+            try:
+                coll = self._mongo_handler.client()[self._dbname][self._collname]
+                if self._write_concern:
+                    coll = coll.with_options(write_concern=self._write_concern)
+                return func(coll)
+            except pymongo.errors.AutoReconnect as e:
+                log.error('access initial sync state failed: %s' % e)
+                self._mongo_handler.reconnect()
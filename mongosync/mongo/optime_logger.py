@@ -0,0 +1,85 @@
+import datetime
+import pymongo
+from mongosync import mongo_utils
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+
+class MongoOptimeLogger(object):
+    """ Record optime in a collection of destination.
+
+    A document is kept for each sync task:
+      {_id: name, ts: optime, partitions: {partition: optime}, updatedAt: datetime}
+    Partitions are positions of workers or source shards, and ts is the position that is safe to resume from.
+    """
+    def __init__(self, mongo_handler, ns, name, write_concern=None):
+        """
+        Parameter:
+          - mongo_handler: MongoHandler of destination
+          - ns: namespace of collection to record optime
+          - name: name of sync task
+          - write_concern: options of pymongo.WriteConcern to record optime, w=1 if empty
+        """
+        assert ns
+        assert name
+        self._mongo_handler = mongo_handler
+        self._dbname, self._collname = mongo_utils.parse_namespace(ns)
+        self._ns = ns
+        self._name = name
+        self._write_concern = pymongo.write_concern.WriteConcern(**write_concern) if write_concern else None
+
+    def write(self, optime, partitions=None):
+        """ Write optime and positions of partitions.
+        """
+        doc = {'ts': optime, 'updatedAt': datetime.datetime.utcnow()}
+        if partitions:
+            for partition, ts in partitions.iteritems():
+                doc['partitions.%s' % partition] = ts
+        while True:
+            try:
+                coll = self._coll()
+                if self._write_concern:
+                    coll = coll.with_options(write_concern=self._write_concern)
+                coll.update_one({'_id': self._name}, {'$set': doc}, upsert=True)
+                return
+            except pymongo.errors.AutoReconnect as e:
+                log.error('write optime failed: %s' % e)
+                self._mongo_handler.reconnect()
+
+    def read(self):
+        """ Read optime.
+        Return optime if OK else None.
+        """
+        doc = self._read()
+        return doc.get('ts') if doc else None
+
+    def read_partitions(self):
+        """ Read positions of partitions.
+        Return a dict {partition: optime}.
+        """
+        doc = self._read()
+        return doc.get('partitions', {}) if doc else {}
+
+    def _read(self):
+        while True:
+            try:
+                return self._coll().find_one({'_id': self._name})
+            except pymongo.errors.AutoReconnect as e:
+                log.error('read optime failed: %s' % e)
+                self._mongo_handler.reconnect()
+
+    def _coll(self):
+        return self._mongo_handler.client()[self._dbname][self._collname]
+
+    @property
+    def ns(self):
+        """ Return namespace.
+        """
+        return self._ns
+
+    @property
+    def name(self):
+        """ Return name of sync task.
+        """
+        return self._name
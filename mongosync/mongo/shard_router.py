@@ -0,0 +1,152 @@
+import bisect
+import collections
+import time
+from mongosync import mongo_utils
+from mongosync.logger import Logger
+from mongosync.oplog_coalescer import is_update
+
+log = Logger.get()
+
+# error codes of stale shard version
+# @ref https://github.com/mongodb/mongo/blob/master/src/mongo/base/error_codes.err
+STALE_CONFIG_CODES = frozenset([63, 150, 13388])
+
+
+class CollectionRoute(object):
+    """ Chunk ranges of a sharded collection.
+    """
+    def __init__(self, key_fields, chunks, version):
+        """
+        Parameter:
+          - key_fields: shard key fields
+          - chunks: list of (min, shard) sorted by min
+          - version: (lastmodEpoch, lastmod) of the latest chunk
+        """
+        self.key_fields = key_fields
+        self.version = version
+        ranges = sorted([(gen_shard_key_sort_key(key_fields, min_doc), shard) for min_doc, shard in chunks])
+        self._mins = [min_key for min_key, shard in ranges]
+        self._shards = [shard for min_key, shard in ranges]
+        self.load_time = time.time()
+
+    def find_shard(self, doc):
+        """ Return shard that owns document, or None if unknown.
+
+        Missing shard key field is regarded as null.
+        """
+        try:
+            key = gen_shard_key_sort_key(self.key_fields, doc)
+        except (TypeError, KeyError):
+            return None
+        pos = bisect.bisect_right(self._mins, key) - 1
+        if pos < 0:
+            return None
+        return self._shards[pos]
+
+
+class ShardRouter(object):
+    """ Route documents to shards by caching chunk metadata of destination.
+    """
+    def __init__(self, mc, refresh_interval=60):
+        """
+        Parameter:
+          - mc: MongoClient of mongos
+          - refresh_interval: check chunk version every so many seconds
+        """
+        self._mc = mc
+        self._refresh_interval = refresh_interval
+        self._routes = {}  # {ns: CollectionRoute}, None if not sharded or not routable
+
+    def invalidate(self, ns):
+        """ Invalidate route of namespace, e.g. when stale config error occurs.
+        """
+        if ns in self._routes:
+            log.info('invalidate shard route of %s' % ns)
+            del self._routes[ns]
+
+    def get_route(self, ns):
+        """ Return route of namespace, None if not sharded or not routable.
+        """
+        return self._get_route(ns)
+
+    def partition(self, ns, oplogs):
+        """ Group oplogs by destination shard.
+
+        Return a dict {shard: oplogs}, shard is None if unknown.
+        Oplogs of a document always fall into the same group in order.
+        """
+        route = self._get_route(ns)
+        if route is None:
+            return {None: oplogs}
+
+        # shard key is immutable, so the owner of a document can be found from any full document
+        owners = {}
+        only_id = route.key_fields == ['_id']
+        for oplog in oplogs:
+            if oplog['op'] == 'i' or (oplog['op'] == 'u' and not is_update(oplog)):
+                doc = oplog['o']
+            elif only_id:
+                doc = {'_id': mongo_utils.get_oplog_id(oplog)}
+            else:
+                continue
+            key = mongo_utils.gen_hashable_id(mongo_utils.get_oplog_id(oplog))
+            if key not in owners:
+                owners[key] = route.find_shard(doc)
+
+        groups = {}
+        for oplog in oplogs:
+            shard = owners.get(mongo_utils.gen_hashable_id(mongo_utils.get_oplog_id(oplog)))
+            if shard not in groups:
+                groups[shard] = []
+            groups[shard].append(oplog)
+        return groups
+
+    def _get_route(self, ns):
+        """ Get route of namespace, load or refresh if necessary.
+        """
+        if ns in self._routes:
+            route = self._routes[ns]
+            if route is None or time.time() - route.load_time < self._refresh_interval:
+                return route
+            if self._get_version(ns) == route.version:
+                route.load_time = time.time()
+                return route
+        self._routes[ns] = self._load_route(ns)
+        return self._routes[ns]
+
+    def _get_version(self, ns):
+        """ Get version of the latest chunk.
+        """
+        chunk = self._mc['config']['chunks'].find_one({'ns': ns}, sort=[('lastmod', -1)])
+        if not chunk:
+            return None
+        return (chunk.get('lastmodEpoch'), chunk.get('lastmod'))
+
+    def _load_route(self, ns):
+        """ Load chunks of namespace from config server.
+        """
+        coll = self._mc['config']['collections'].find_one({'_id': ns})
+        if not coll or coll.get('dropped'):
+            return None
+        key_fields = coll['key'].keys()
+        if 'hashed' in coll['key'].values():
+            log.info('shard key of %s is hashed, not routable' % ns)
+            return None
+        version = self._get_version(ns)
+        chunks = [(chunk['min'], chunk['shard']) for chunk in self._mc['config']['chunks'].find({'ns': ns}).sort('min', 1)]
+        if not chunks:
+            return None
+        log.info('load shard route of %s: %d chunks, version %s' % (ns, len(chunks), version))
+        return CollectionRoute(key_fields, chunks, version)
+
+
+def gen_shard_key_sort_key(key_fields, doc):
+    """ Generate sort key of shard key values in document.
+    """
+    res = []
+    for field in key_fields:
+        val = doc
+        for key in field.split('.'):
+            val = val.get(key) if isinstance(val, collections.Mapping) else None
+        res.append(mongo_utils.gen_bson_sort_key(val))
+    return tuple(res)
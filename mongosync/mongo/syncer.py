@@ -1,34 +1,210 @@
+import sys
 import time
+import collections
 import multiprocessing
 import gevent
+import gevent.pool
 import pymongo
-from mongosync import mongo_utils
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from mongosync import metrics, mongo_utils
 from mongosync.logger import Logger
 from mongosync.config import MongoConfig
 from mongosync.common_syncer import CommonSyncer, Stage
-from mongosync.mongo.handler import MongoHandler
+from mongosync.initial_sync_scheduler import InitialSyncScheduler, CopyTask
+from mongosync.mongo.handler import MongoHandler, OPLOG_PROJECTION
+from mongosync.mongo.initial_sync_state import InitialSyncState
+from mongosync.mongo.optime_logger import MongoOptimeLogger
+from mongosync.mongo.shard_router import ShardRouter
 from mongosync.multi_oplog_replayer import MultiOplogReplayer
+from mongosync.multi_process_oplog_replayer import MultiProcessOplogReplayer
+from mongosync.oplog_reader import OplogReader, MergedOplogReader, StaleOplogError
+from mongosync.oplog_spool import OplogSpool
+from mongosync.progress_logger import LoggerThread
+from mongosync.replay_controller import ReplayController, MAX_WRITERS
+from mongosync.transaction_buffer import TransactionBuffer, is_transaction_oplog
 
 log = Logger.get()
 
+# concurrent bulk writes of a copy task
+COPY_WRITERS = 10
+# concurrent bulk writes of initial sync, copy tasks in parallel by concurrent bulk writes of a task
+INITIAL_SYNC_WRITERS = 8 * COPY_WRITERS
+# seconds between optimes recorded over oplogs that need no replay, e.g. filtered oplogs and no-ops
+SKIPPED_OPTIME_LOG_INTERVAL = 1
+
 
 class MongoSyncer(CommonSyncer):
     """ MongoDB synchronizer.
     """
-    def __init__(self, conf):
+    def __init__(self, conf, oplog_hub=None):
+        """
+        Parameter:
+          - oplog_hub: OplogHub that reads oplogs for several destinations, read oplogs by itself if None
+        """
         CommonSyncer.__init__(self, conf)
+        self._oplog_hub = oplog_hub
+        self._bulk_load_limits_cache = None
+        self._n_copy_workers = 1
 
         if not isinstance(self._conf.src_conf, MongoConfig):
             raise RuntimeError('invalid src config type')
         self._src = MongoHandler(self._conf.src_conf)
         if not self._src.connect():
             raise RuntimeError('connect to mongodb(src) failed: %s' % self._conf.src_hostportstr)
+        self._init_shards()
         if not isinstance(self._conf.dst_conf, MongoConfig):
             raise RuntimeError('invalid dst config type')
+        self._init_pool_size()
         self._dst = MongoHandler(self._conf.dst_conf)
         if not self._dst.connect():
             raise RuntimeError('connect to mongodb(dst) failed: %s' % self._conf.dst_hostportstr)
-        self._multi_oplog_replayer = MultiOplogReplayer(self._dst, 10)
+        if self._conf.optime_logns:
+            # record optime in destination after each batch, so resuming replays one batch at most
+            self._optime_logger = MongoOptimeLogger(self._dst,
+                                                    self._conf.optime_logns,
+                                                    self._conf.optime_logname or self._conf.src_hostportstr,
+                                                    write_concern=self._conf.write_concern_checkpoint)
+            self._optime_log_interval = 0
+            if not self._conf.start_optime:
+                self._conf.start_optime = self._optime_logger.read()
+                if self._conf.start_optime:
+                    log.info("resume from optime in '%s': %s" % (self._conf.optime_logns, self._conf.start_optime))
+                    for shard, optime in self._optime_logger.read_partitions().iteritems():
+                        if shard in self._shard_srcs:
+                            self._shard_optimes[shard] = optime
+            if not self._conf.start_optime:
+                # record progress of initial sync beside optime
+                self._initial_sync_state = InitialSyncState(self._dst,
+                                                            self._conf.optime_logns + '.initial_sync',
+                                                            self._conf.optime_logname or self._conf.src_hostportstr,
+                                                            write_concern=self._conf.write_concern_checkpoint)
+        self._init_write_concern()
+        self._init_spool()
+        self._init_replayer()
+        if self._conf.admission_enabled:
+            # after replay processes are started, they control their own writes
+            self._dst.enable_admission_control(**self._admission_options())
+
+    def _init_pool_size(self):
+        """ Size connection pool of destination by write concurrency.
+        """
+        n_writers = MAX_WRITERS if self._conf.replay_adaptive else self._conf.replay_writers
+        # and connections to record optime and poll health of destination
+        self._conf.dst_conf.max_pool_size = max(n_writers, INITIAL_SYNC_WRITERS) + 2
+        self._conf.dst_conf.min_pool_size = self._conf.replay_writers
+
+    def _init_write_concern(self):
+        """ Set write concern of destination by tiers.
+
+        Optime is recorded with checkpoint tier after the writes it covers are acknowledged.
+        Replication of a replica set is in order of oplog, so the writes before a checkpoint meet its tier as well.
+        Otherwise, i.e. destination is a mongos or optime is recorded in file,
+        the writes with default write concern use checkpoint tier instead.
+        """
+        def is_default(options):
+            return not options or options == {'w': 1}
+
+        self._initial_sync_write_concern = self._conf.write_concern_initial_sync
+        replay_write_concern = self._conf.write_concern_replay
+        if self._optime_logger and not is_default(self._conf.write_concern_checkpoint):
+            if self._dst.client().is_mongos or not isinstance(self._optime_logger, MongoOptimeLogger):
+                log.info('optime is not recorded in the replica set of writes, write with checkpoint write concern')
+                if is_default(self._initial_sync_write_concern):
+                    self._initial_sync_write_concern = self._conf.write_concern_checkpoint
+                if is_default(replay_write_concern):
+                    replay_write_concern = self._conf.write_concern_checkpoint
+        # for replay processes
+        self._conf.dst_conf.write_concern = replay_write_concern
+        self._dst.set_write_concern(replay_write_concern)
+
+    def _init_shards(self):
+        """ Discover shards if source is a mongos, then oplogs are tailed from shards directly.
+        """
+        self._shard_srcs = collections.OrderedDict()  # {shard: MongoHandler}
+        self._shard_optimes = {}  # {shard: ts of oplog to resume from}
+        self._ignore_oplog_dbs = []
+        self._oplog_note_times = {}  # {shard: time of the last appended oplog note}
+        self._oplog_note_enabled = True
+        if not self._src.client().is_mongos:
+            return
+        for shard in self._src.client()['config']['shards'].find(sort=[('_id', 1)]):
+            # host is 'replset/host0:port0,host1:port1' or 'host:port'
+            hostportstr = shard['host'].split('/')[-1].split(',')[0]
+            src = MongoHandler(MongoConfig(unicode(hostportstr),
+                                           self._conf.src_conf.authdb,
+                                           self._conf.src_conf.username,
+                                           self._conf.src_conf.password))
+            if not src.connect():
+                raise RuntimeError('connect to shard %s failed: %s' % (shard['_id'], shard['host']))
+            self._shard_srcs[shard['_id']] = src
+            log.info('source shard %s: %s' % (shard['_id'], shard['host']))
+        self._src_router = ShardRouter(self._src.client())
+        # cache and sessions of shards
+        self._ignore_dbs.append('config')
+        self._ignore_oplog_dbs.append('config')
+
+    def _init_spool(self):
+        """ Create oplog spool if spool path is specified.
+        """
+        self._spool = None
+        if not self._conf.spool_path:
+            return
+        if self._shard_srcs:
+            raise RuntimeError('oplog spool is not supported for sharded cluster source')
+        self._spool = OplogSpool(self._conf.spool_path,
+                                 segment_bytes=self._conf.spool_segment_bytes,
+                                 max_bytes=self._conf.spool_max_bytes,
+                                 compress=self._conf.spool_compress)
+        if not self._conf.start_optime and self._spool.checkpoint:
+            self._conf.start_optime = self._spool.checkpoint
+            log.info("resume from checkpoint of spool '%s': %s" % (self._conf.spool_path, self._conf.start_optime))
+
+    def _init_replayer(self):
+        """ Create oplog replayer with replay options.
+        """
+        self._oplog_batchsize = self._conf.replay_batch_size
+        self._oplog_max_latency = self._conf.replay_max_latency
+        error_policy = {'policy': self._conf.replay_error_policy,
+                        'dead_letter_path': self._conf.replay_dead_letter_path}
+        self._dst.set_error_policy(**error_policy)
+        if self._conf.replay_processes > 0:
+            self._multi_oplog_replayer = MultiProcessOplogReplayer(self._dst,
+                                                                   self._conf.dst_conf,
+                                                                   n_processes=self._conf.replay_processes,
+                                                                   n_writers=self._conf.replay_writers,
+                                                                   batch_size=self._conf.replay_vector_size,
+                                                                   coalesce=self._conf.replay_coalesce,
+                                                                   shard_routing=self._conf.replay_shard_routing,
+                                                                   admission=self._admission_options(self._conf.replay_processes),
+                                                                   error_policy=error_policy)
+        else:
+            if self._conf.replay_shard_routing:
+                self._dst.enable_shard_routing()
+            self._multi_oplog_replayer = MultiOplogReplayer(self._dst,
+                                                            n_writers=self._conf.replay_writers,
+                                                            batch_size=self._conf.replay_vector_size,
+                                                            coalesce=self._conf.replay_coalesce)
+        if self._conf.replay_adaptive:
+            self._replay_controller = ReplayController(batch_size=self._conf.replay_batch_size,
+                                                       vector_size=self._conf.replay_vector_size,
+                                                       n_writers=self._conf.replay_writers,
+                                                       max_latency=self._conf.replay_max_latency)
+        else:
+            self._replay_controller = None
+
+    def _admission_options(self, n_shares=1):
+        """ Return options of admission control, rates are shared by n processes.
+        Return None if disabled.
+        """
+        if not self._conf.admission_enabled:
+            return None
+        return {'max_rate': float(self._conf.admission_max_rate) / n_shares,
+                'min_rate': float(self._conf.admission_min_rate) / n_shares,
+                'max_lag': self._conf.admission_max_lag,
+                'max_dirty_ratio': self._conf.admission_max_dirty_ratio,
+                'max_queued_writers': self._conf.admission_max_queued_writers}
 
     def _create_index(self, namespace_tuple):
         """ Create indexes.
@@ -81,160 +257,478 @@ class MongoSyncer(CommonSyncer):
         # create indexes first
         self._create_index(namespace_tuple)
 
+        src_ns = mongo_utils.gen_namespace(*namespace_tuple)
+        total = self._src.client()[namespace_tuple[0]][namespace_tuple[1]].count()
+        self._progress_logger.register(src_ns, total)
+        avg_obj_size = self._avg_obj_size(self._src, namespace_tuple)
+
+        def add_progress(n):
+            self._progress_logger.add(src_ns, n)
+            self._add_copied(src_ns, n, avg_obj_size)
+
+        self._copy_docs(self._src, namespace_tuple, 'all', add_progress=add_progress)
+        self._progress_logger.add(src_ns, 0, done=True)
+
+    def _copy_docs(self, src, namespace_tuple, part, query=None, skip_doc=None, add_progress=None):
+        """ Copy documents of a part of collection in order of _id until success.
+
+        If initial sync state is recorded, progress is recorded after each round of bulk writes,
+        so a cursor failure or a restart resumes from the last copied _id.
+        Return count of documents copied.
+
+        Parameter:
+          - part: name of the part in initial sync state
+          - query: filter of documents of the part
+          - skip_doc: function that returns True if a document is skipped, e.g. an orphaned document
+          - add_progress: function called with count of documents copied periodically
+        """
         src_dbname, src_collname = namespace_tuple
         dst_dbname, dst_collname = self._conf.db_coll_mapping(src_dbname, src_collname)
-        src_ns = '%s.%s' % (src_dbname, src_collname)
+        src_ns = mongo_utils.gen_namespace(src_dbname, src_collname)
+        state = self._initial_sync_state
 
-        total = self._src.client()[src_dbname][src_collname].count()
-        self._progress_logger.register(src_ns, total)
+        n_total = 0
+        resume = False
+        last_id = None
+        doc = state.get(src_ns, part) if state else None
+        if doc:
+            n_total = doc['n']
+            if add_progress and n_total:
+                add_progress(n_total)
+            if doc['done']:
+                log.info('skip %s (%s), %d documents copied' % (src_ns, part, n_total))
+                return n_total
+            if 'last_id' in doc:
+                resume = True
+                last_id = doc['last_id']
+                log.info('resume %s (%s) from _id %r, %d documents copied' % (src_ns, part, last_id, n_total))
+
+        # a part without documents in destination is loaded by large inserts of raw documents,
+        # and documents that exist are upserted from details of bulk write errors
+        bulk_load = not resume and self._is_dst_empty(dst_dbname, dst_collname, query)
+        if bulk_load:
+            reqs_max, reqs_max_bytes = self._bulk_load_limits()
+            log.info('bulk load %s (%s) in batches of %d documents or %d bytes' % (src_ns, part, reqs_max, reqs_max_bytes))
+        else:
+            reqs_max, reqs_max_bytes = 100, None
 
         while True:
             try:
-                cursor = self._src.client()[src_dbname][src_collname].find(filter=None,
-                                                                           cursor_type=pymongo.cursor.CursorType.EXHAUST,
-                                                                           no_cursor_timeout=True,
-                                                                           modifiers={'$snapshot': True})
+                coll = src.client()[src_dbname][src_collname]
+                if bulk_load:
+                    coll = coll.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+                # scan _id index, documents are in order of _id and copied only once
+                cursor = coll.find(filter=query,
+                                   cursor_type=pymongo.cursor.CursorType.EXHAUST,
+                                   no_cursor_timeout=True)
+                cursor.hint([('_id', 1)])
+                if resume:
+                    # min of index is inclusive and compares _id of any type, unlike $gt
+                    cursor.min([('_id', last_id)])
 
                 reqs = []
-                reqs_max = 100
+                n_bytes = 0
                 groups = []
-                groups_max = 10
-                n = 0
+                groups_max = COPY_WRITERS
+                n_skips = 0
+                first = True
 
                 for doc in cursor:
-                    reqs.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
-                    if len(reqs) == reqs_max:
+                    if first:
+                        first = False
+                        if resume and doc['_id'] == last_id:
+                            continue
+                    if skip_doc and skip_doc(doc):
+                        n_skips += 1
+                        continue
+                    if bulk_load:
+                        reqs.append(pymongo.InsertOne(doc))
+                        n_bytes += len(doc.raw)
+                    else:
+                        reqs.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+                    if len(reqs) == reqs_max or (reqs_max_bytes and n_bytes >= reqs_max_bytes):
                         groups.append(reqs)
                         reqs = []
+                        n_bytes = 0
                     if len(groups) == groups_max:
-                        threads = [gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False, ignore_duplicate_key_error=True) for i in xrange(groups_max)]
-                        gevent.joinall(threads, raise_error=True)
+                        doc_id = doc['_id']
+                        n_total = self._write_docs(dst_dbname, dst_collname, groups, src_ns, part, doc_id, n_total, add_progress)
+                        resume = True
+                        last_id = doc_id
                         groups = []
 
-                    n += 1
-                    if n % 10000 == 0:
-                        self._progress_logger.add(src_ns, n)
-                        n = 0
-
-                if len(groups) > 0:
-                    threads = [gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False, ignore_duplicate_key_error=True) for i in xrange(len(groups))]
-                    gevent.joinall(threads, raise_error=True)
-                if len(reqs) > 0:
-                    self._dst.bulk_write(dst_dbname, dst_collname, reqs, ordered=False, ignore_duplicate_key_error=True)
+                if reqs:
+                    groups.append(reqs)
+                if groups:
+                    n_total = self._write_docs(dst_dbname, dst_collname, groups, src_ns, part, doc['_id'], n_total, add_progress)
+                if state:
+                    state.done(src_ns, part, n_total)
+                if n_skips > 0:
+                    log.info('skip %d documents of %s (%s)' % (n_skips, src_ns, part))
+                return n_total
+            except pymongo.errors.AutoReconnect:
+                src.reconnect()
 
-                self._progress_logger.add(src_ns, n, done=True)
-                return
+    def _is_dst_empty(self, dbname, collname, query=None):
+        """ Check if destination has no document of query.
+        """
+        while True:
+            try:
+                return self._dst.client()[dbname][collname].find_one(query, projection={'_id': True}) is None
             except pymongo.errors.AutoReconnect:
-                self._src.reconnect()
+                self._dst.reconnect()
+
+    def _bulk_load_limits(self):
+        """ Return (max documents, max bytes) of an insert batch by limits of destination.
 
-    def _sync_large_collection(self, namespace_tuple, split_points):
-        """ Sync large collection.
+        Batches of a copy task are written concurrently, so they share the maximum message size.
         """
-        # create indexes first
-        self._create_index(namespace_tuple)
+        if self._bulk_load_limits_cache is None:
+            res = self._dst.client()['admin'].command('isMaster')
+            self._bulk_load_limits_cache = (res.get('maxWriteBatchSize', 1000),
+                                            res.get('maxMessageSizeBytes', 48000000) / COPY_WRITERS)
+        return self._bulk_load_limits_cache
+
+    def _write_docs(self, dbname, collname, groups, src_ns, part, last_id, n_total, add_progress):
+        """ Write groups of requests concurrently and record progress up to last_id.
+
+        Return count of documents copied.
+        """
+        threads = [gevent.spawn(self._dst.bulk_write, dbname, collname, reqs, ordered=False, ignore_duplicate_key_error=True) for reqs in groups]
+        gevent.joinall(threads, raise_error=True)
+        n = sum(len(reqs) for reqs in groups)
+        n_total += n
+        if self._initial_sync_state:
+            self._initial_sync_state.save(src_ns, part, last_id, n_total)
+        if add_progress:
+            add_progress(n)
+        return n_total
+
+    def _initial_sync(self):
+        """ Initial sync.
+
+        If source is a sharded cluster, collections are read from shards directly.
+        Documents are written with write concern of initial sync.
+        """
+        self._dst.set_write_concern(self._initial_sync_write_concern)
+        if not self._shard_srcs:
+            self._schedule_initial_sync()
+        else:
+            colls = self._collect_colls()
+            self._progress_logger = LoggerThread(len(colls))
+            self._progress_logger.start()
+
+            pool = gevent.pool.Pool(8)
+            for res in pool.imap(self._sync_sharded_collection, colls):
+                if res is not None:
+                    sys.exit(1)
+        self._dst.set_write_concern(self._conf.dst_conf.write_concern)
+
+    def _schedule_initial_sync(self):
+        """ Copy all collections and ranges of large collections as tasks by a pool of processes.
+        """
+        colls = self._collect_colls()
+        tasks = []
+        avg_obj_sizes = {}
+        n_parts = {}
 
+        def prepare(namespace_tuple):
+            """ Create indexes and split collection into tasks.
+            """
+            self._create_index(namespace_tuple)
+            dbname, collname = namespace_tuple
+            ns = mongo_utils.gen_namespace(dbname, collname)
+            collstats = self._src.client()[dbname].command('collstats', collname)
+            log.info('%d\t%s' % (collstats['count'], ns))
+            avg_obj_sizes[ns] = collstats.get('avgObjSize', 0)
+            self._progress_logger.register(ns, collstats['count'])
+            points = self._split_coll(namespace_tuple, self._n_workers) if self._is_large_collection(namespace_tuple) else []
+            if points:
+                ranges = self._ranges(ns, points)
+                for part, query in ranges:
+                    tasks.append(CopyTask(namespace_tuple, part, query, collstats['size'] / len(ranges)))
+                n_parts[ns] = len(ranges)
+                log.info('large collection %s is split into %d ranges' % (ns, len(ranges)))
+            else:
+                tasks.append(CopyTask(namespace_tuple, 'all', None, collstats['size']))
+                n_parts[ns] = 1
+
+        self._progress_logger = LoggerThread(len(colls))
+        self._progress_logger.start()
+
+        pool = gevent.pool.Pool(8)
+        for res in pool.imap(prepare, colls):
+            pass
+
+        def on_progress(ns, n):
+            self._progress_logger.add(ns, n)
+            self._add_copied(ns, n, avg_obj_sizes[ns])
+
+        def on_done(task, n):
+            ns = mongo_utils.gen_namespace(*task.namespace_tuple)
+            n_parts[ns] -= 1
+            if n_parts[ns] == 0:
+                self._progress_logger.add(ns, 0, done=True)
+
+        # rates of admission control are shared by copy processes
+        self._n_copy_workers = min(self._copy_workers(), len(tasks))
+        scheduler = InitialSyncScheduler(self._n_copy_workers, self._init_copy_worker, self._run_copy_task)
+        scheduler.run(tasks, on_progress, on_done)
+
+    def _copy_workers(self):
+        """ Return count of copy processes, by cores and concurrent writes to destination.
+        """
+        if self._conf.initial_sync_workers > 0:
+            return self._conf.initial_sync_workers
+        return max(1, min(multiprocessing.cpu_count(), INITIAL_SYNC_WRITERS / COPY_WRITERS))
+
+    def _init_copy_worker(self):
+        """ Connect in a copy process, and limit its writes by a share of admission rates.
+        """
+        self._src.reconnect()
+        self._dst.reconnect()
+        if self._conf.admission_enabled:
+            self._dst.enable_admission_control(**self._admission_options(self._n_copy_workers))
+
+    def _run_copy_task(self, task, progress):
+        """ Copy documents of a task in a copy process.
+        """
+        return self._copy_docs(self._src, task.namespace_tuple, task.part, query=task.query, add_progress=progress)
+
+    def _ranges(self, ns, split_points):
+        """ Return [(part, query)] of ranges of a large collection split by points.
+
+        Ranges are recorded before copying, and reused by a restart.
+        """
+        bounds = []  # [(part, lower, upper)]
+        parts = self._initial_sync_state.parts(ns) if self._initial_sync_state else {}
+        if parts and all(part.startswith('range-') for part in parts):
+            for part in sorted(parts, key=lambda part: int(part[len('range-'):])):
+                bounds.append((part, parts[part].get('lower'), parts[part].get('upper')))
+            log.info('resume %s with %d ranges' % (ns, len(bounds)))
+        else:
+            points = [None] + split_points + [None]
+            for i in xrange(len(points) - 1):
+                bounds.append(('range-%d' % i, points[i], points[i + 1]))
+                if self._initial_sync_state:
+                    self._initial_sync_state.add_range(ns, 'range-%d' % i, points[i], points[i + 1])
+
+        ranges = []
+        for part, lower, upper in bounds:
+            cond = {}
+            if lower is not None:
+                cond['$gte'] = lower
+            if upper is not None:
+                cond['$lt'] = upper
+            ranges.append((part, {'_id': cond} if cond else None))
+        return ranges
+
+    def _sync_sharded_collection(self, namespace_tuple):
+        """ Sync a collection of sharded cluster from shards in parallel.
+        """
         dbname, collname = namespace_tuple
-        ns = '.'.join(namespace_tuple)
+        ns = mongo_utils.gen_namespace(dbname, collname)
+        coll = self._src.client()['config']['collections'].find_one({'_id': ns})
+        if coll and not coll.get('dropped'):
+            route = self._src_router.get_route(ns)
+            if route is None:
+                # orphaned documents cannot be recognized with hashed shard key, read through mongos
+                return self._sync_collection(namespace_tuple)
+            shards = self._shard_srcs.keys()
+        else:
+            # unsharded collection is on the primary shard of database
+            route = None
+            db = self._src.client()['config']['databases'].find_one({'_id': dbname})
+            shards = [db['primary']] if db else self._shard_srcs.keys()
 
-        log.info('pending to sync %s with %d processes' % (ns, len(split_points) + 1))
+        # create indexes first
+        self._create_index(namespace_tuple)
 
-        coll = self._src.client()[dbname][collname]
-        total = coll.count()
+        total = self._src.client()[dbname][collname].count()
         self._progress_logger.register(ns, total)
 
-        prog_q = multiprocessing.Queue()
-        res_q = multiprocessing.Queue()
+        threads = [gevent.spawn(self._sync_shard_collection, shard, namespace_tuple, route) for shard in shards]
+        gevent.joinall(threads, raise_error=True)
+        self._progress_logger.add(ns, 0, done=True)
 
-        proc_logging = multiprocessing.Process(target=logging_progress, args=(ns, total, prog_q))
-        proc_logging.start()
+    def _sync_shard_collection(self, shard, namespace_tuple, route):
+        """ Sync documents of a collection on a shard.
 
-        queries = []
-        lower_bound = None
-        for point in split_points:
-            if lower_bound is None:
-                queries.append({'_id': {'$lt': point}})
-            else:
-                queries.append({'_id': {'$gte': lower_bound, '$lt': point}})
-            lower_bound = point
-        queries.append({'_id': {'$gte': lower_bound}})
+        Orphaned documents, which are in chunks of another shard, are skipped.
+        A document whose owner is unknown, e.g. shard key cannot be computed, is copied from every shard that has it.
+        """
+        src_ns = mongo_utils.gen_namespace(*namespace_tuple)
+        src = self._shard_srcs[shard]
+        avg_obj_size = self._avg_obj_size(src, namespace_tuple)
 
-        procs = []
-        for query in queries:
-            p = multiprocessing.Process(target=self._sync_collection_with_query, args=(namespace_tuple, query, prog_q, res_q))
-            p.start()
-            procs.append(p)
-            log.info('start process %s with query %s' % (p.name, query))
+        def add_progress(n):
+            self._progress_logger.add(src_ns, n)
+            self._add_copied(src_ns, n, avg_obj_size)
 
-        for p in procs:
-            p.join()
+        def skip_doc(doc):
+            owner = route.find_shard(doc)
+            return owner is not None and owner != shard
 
-        n_docs = 0
-        for p in procs:
-            n_docs += res_q.get()
-        self._progress_logger.add(ns, n_docs, done=True)
+        self._copy_docs(src, namespace_tuple, 'shard-%s' % shard, skip_doc=skip_doc if route else None, add_progress=add_progress)
 
-        prog_q.put(True)
-        prog_q.close()
-        prog_q.join_thread()
-        proc_logging.join()
+    def _avg_obj_size(self, src, namespace_tuple):
+        """ Return average document size of collection, 0 if unknown.
+        """
+        dbname, collname = namespace_tuple
+        try:
+            return src.client()[dbname].command('collstats', collname).get('avgObjSize', 0)
+        except pymongo.errors.PyMongoError as e:
+            log.error('get collstats of %s.%s failed: %s' % (dbname, collname, e))
+            return 0
+
+    def _add_copied(self, ns, n_docs, avg_obj_size):
+        """ Count documents copied by initial sync.
+        """
+        metrics.INITIAL_SYNC_DOCS.labels(ns).inc(n_docs)
+        metrics.INITIAL_SYNC_BYTES.labels(ns).inc(int(n_docs * avg_obj_size))
+
+    def _locate_start_optime(self, optime):
+        """ Return ts of the first oplog at or after optime, None if not found.
 
-    def _sync_collection_with_query(self, namespace_tuple, query, prog_q, res_q):
-        """ Sync collection with query.
+        For a sharded cluster, each shard locates its own oplog when replay starts.
+        If spool contains optime, it's located in spool, even if it's not in source any more.
         """
-        self._src.reconnect()
-        self._dst.reconnect()
+        if self._shard_srcs:
+            return optime
+        if self._spool and self._spool.first_optime and self._spool.first_optime <= optime <= self._spool.last_optime:
+            return optime
+        return CommonSyncer._locate_start_optime(self, optime)
 
-        src_dbname, src_collname = namespace_tuple
-        dst_dbname, dst_collname = self._conf.db_coll_mapping(src_dbname, src_collname)
+    def _start_initial_sync(self):
+        """ Return optime to replay oplog from after initial sync.
 
-        while True:
-            try:
-                cursor = self._src.client()[src_dbname][src_collname].find(filter=query,
-                                                                           cursor_type=pymongo.cursor.CursorType.EXHAUST,
-                                                                           no_cursor_timeout=True,
-                                                                           # snapshot cause blocking, maybe bug
-                                                                           # modifiers={'$snapshot': True}
-                                                                           )
-                total = 0
-                n = 0
-                reqs = []
-                reqs_max = 100
-                groups = []
-                groups_max = 10
+        If a previous initial sync is recorded and its start optime is still in oplog,
+        initial sync resumes with copied parts of collections, otherwise it starts over.
+        """
+        state = self._initial_sync_state
+        if not state:
+            return self._get_start_optime()
+        start_optime, shard_optimes = state.read()
+        if start_optime and self._locate_start_optime(start_optime) == start_optime:
+            log.info("resume initial sync in '%s', start optime is %s" % (state.ns, start_optime))
+            for shard, optime in shard_optimes.iteritems():
+                if shard in self._shard_srcs:
+                    self._shard_optimes[shard] = optime
+            return start_optime
+        if start_optime:
+            log.info('oplog is stale since last initial sync, start over')
+        start_optime = self._get_start_optime()
+        state.start(start_optime, self._shard_optimes)
+        return start_optime
+
+    def _get_start_optime(self):
+        """ Get optime to replay oplog from, before initial sync.
+
+        For a sharded cluster, it's the earliest optime of shards, and each shard replays from its own optime.
+        """
+        if not self._shard_srcs:
+            return CommonSyncer._get_start_optime(self)
+        for shard, src in self._shard_srcs.iteritems():
+            self._shard_optimes[shard] = mongo_utils.get_optime(src.client())
+        return min(self._shard_optimes.itervalues())
 
-                for doc in cursor:
-                    reqs.append(pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
-                    if len(reqs) == reqs_max:
-                        groups.append(reqs)
-                        reqs = []
-                    if len(groups) == groups_max:
-                        threads = [gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False, ignore_duplicate_key_error=True) for i in xrange(groups_max)]
-                        gevent.joinall(threads, raise_error=True)
-                        groups = []
+    def _get_end_optime(self):
+        """ Get optime that initial sync is done at.
 
-                    n += 1
-                    total += 1
-                    if n % 10000 == 0:
-                        prog_q.put(n)
-                        n = 0
-
-                if len(groups) > 0:
-                    threads = [gevent.spawn(self._dst.bulk_write, dst_dbname, dst_collname, groups[i], ordered=False, ignore_duplicate_key_error=True) for i in xrange(len(groups))]
-                    gevent.joinall(threads, raise_error=True)
-                if len(reqs) > 0:
-                    self._dst.bulk_write(dst_dbname, dst_collname, reqs, ordered=False, ignore_duplicate_key_error=True)
-
-                if n > 0:
-                    prog_q.put(n)
-                res_q.put(total)
-
-                prog_q.close()
-                prog_q.join_thread()
-                res_q.close()
-                res_q.join_thread()
-                return
-            except pymongo.errors.AutoReconnect:
-                self._src.reconnect()
+        For a sharded cluster, it's the latest optime of shards.
+        """
+        if not self._shard_srcs:
+            return CommonSyncer._get_end_optime(self)
+        return max(mongo_utils.get_optime(src.client()) for src in self._shard_srcs.itervalues())
+
+    def _get_shard_start_optime(self, shard):
+        """ Return ts of oplog to replay from on shard, None if not found.
+        """
+        if shard in self._shard_optimes:
+            return self._shard_optimes[shard]
+        # all oplogs at or before the last optime have been applied
+        doc = self._shard_srcs[shard].client()['local']['oplog.rs'].find_one({'fromMigrate': {'$exists': False},
+                                                                             'ts': {'$lte': self._last_optime}},
+                                                                            sort=[('$natural', -1)])
+        return doc['ts'] if doc else None
+
+    def _tail_raw_oplog(self, start_optime):
+        """ Return a started oplog reader of RawBSONDocument from start optime, for spool.
+        """
+        host, port = self._src.client().address
+        log.info('try to spool oplog from %s on %s:%d' % (start_optime, host, port))
+        reader = self._tail_oplog(self._src, start_optime, raw=True)
+        reader.start()
+        return reader
+
+    def _tail_oplog(self, src, start_optime, raw=None):
+        """ Return an oplog reader of source from start optime.
+
+        Oplogs are RawBSONDocument if raw is True, default is replay.lazy_decode.
+        """
+        cursor = src.tail_oplog(start_optime,
+                                raw=self._conf.replay_lazy_decode if raw is None else raw,
+                                ns_query=self._conf.data_filter.gen_oplog_ns_query(),
+                                projection=OPLOG_PROJECTION if self._conf.replay_oplog_projection else None)
+        return OplogReader(cursor,
+                           batch_size=self._oplog_batchsize,
+                           max_batches=self._oplog_prefetch_batches,
+                           max_bytes=self._oplog_prefetch_bytes,
+                           start_optime=start_optime)
+
+    def _open_oplog_reader(self):
+        """ Return a started oplog reader from the last optime.
+
+        For a sharded cluster, oplogs of shards are merged in order of ts.
+        """
+        if self._oplog_hub:
+            return self._oplog_hub.open(self._conf.dst_hostportstr, self._last_optime)
+        if self._spool:
+            if not self._spool.writing:
+                self._spool.start_writer(self._last_optime, self._tail_raw_oplog, self._src.reconnect)
+            log.info('try to sync oplog from %s in spool %s' % (self._last_optime, self._conf.spool_path))
+            return self._spool.open(self._last_optime, raw=self._conf.replay_lazy_decode)
+        if not self._shard_srcs:
+            host, port = self._src.client().address
+            log.info('try to sync oplog from %s on %s:%d' % (self._last_optime, host, port))
+            oplog_reader = self._tail_oplog(self._src, self._last_optime)
+        else:
+            readers = {}
+            for shard, src in self._shard_srcs.iteritems():
+                start_optime = self._get_shard_start_optime(shard)
+                if start_optime is None:
+                    raise StaleOplogError('oplog at or before %s not found on shard %s' % (self._last_optime, shard))
+                host, port = src.client().address
+                log.info('try to sync oplog from %s on shard %s %s:%d' % (start_optime, shard, host, port))
+                readers[shard] = self._tail_oplog(src, start_optime)
+            oplog_reader = MergedOplogReader(readers, on_idle=self._append_oplog_note)
+        oplog_reader.start()
+        return oplog_reader
+
+    def _append_oplog_note(self, shard):
+        """ Write a no-op into oplog of an idle shard, so that it doesn't hold back oplogs of other shards.
+
+        It's rate limited to once per second, and disabled if not permitted,
+        then oplogs wait for periodic no-ops of the idle shard.
+        """
+        if not self._oplog_note_enabled:
+            return
+        now = time.time()
+        if now - self._oplog_note_times.get(shard, 0) < 1:
+            return
+        self._oplog_note_times[shard] = now
+        try:
+            self._shard_srcs[shard].client()['admin'].command('appendOplogNote', data={'msg': 'py-mongo-sync'})
+        except pymongo.errors.OperationFailure as e:
+            log.info('append oplog note failed, wait for periodic no-ops of shards: %s' % e)
+            self._oplog_note_enabled = False
+
+    def _reconnect_src(self):
+        """ Reconnect source and shards.
+        """
+        self._src.reconnect()
+        for src in self._shard_srcs.itervalues():
+            src.reconnect()
 
     def _replay_oplog(self, start_optime):
         """ Replay oplog.
@@ -246,11 +740,13 @@ class MongoSyncer(CommonSyncer):
 
         while True:
             try:
-                start_optime_valid = False
                 need_log = False
-                host, port = self._src.client().address
-                log.info('try to sync oplog from %s on %s:%d' % (self._last_optime, host, port))
-                cursor = self._src.tail_oplog(start_optime)
+                expanded_oplogs = collections.deque()  # operations of applyOps to replay
+                transactions = TransactionBuffer(self._fetch_oplog)
+                oplog_reader = self._open_oplog_reader()
+            except StaleOplogError as e:
+                log.error('%s, terminate' % e)
+                return
             except IndexError as e:
                 log.error(e)
                 log.error('%s not found, terminate' % self._last_optime)
@@ -263,56 +759,69 @@ class MongoSyncer(CommonSyncer):
             while True:
                 try:
                     if need_log:
+                        if self._shard_srcs:
+                            self._shard_optimes.update(oplog_reader.positions(self._last_optime))
+                        metrics.READER_QUEUED_BATCHES.set(oplog_reader.qsize())
+                        metrics.REPLAY_BUFFERED_OPLOGS.set(self._multi_oplog_replayer.count())
                         self._log_optime(self._last_optime)
+                        if self._spool:
+                            # spooled oplogs are kept until optime is recorded
+                            self._spool.set_checkpoint(self._last_logged_optime if self._optime_logger else self._last_optime)
                         self._log_progress()
                         need_log = False
 
-                    if not cursor.alive:
-                        log.error('cursor is dead')
-                        raise pymongo.errors.AutoReconnect
-
-                    oplog = cursor.next()
-                    n_total += 1
-
-                    # check start optime once
-                    if not start_optime_valid:
-                        if oplog['ts'] == self._last_optime:
-                            log.info('oplog is ok: %s' % self._last_optime)
-                            start_optime_valid = True
-                        else:
-                            log.error('oplog %s is stale, terminate' % self._last_optime)
-                            return
+                    if expanded_oplogs:
+                        oplog = expanded_oplogs.popleft()
+                    else:
+                        # oplogs are prefetched by reader while applying
+                        oplog = oplog_reader.next()
+                        n_total += 1
+                        metrics.OPLOGS_READ.labels(oplog['ns']).inc()
+
+                        # replay operations of a transaction one by one once it's committed,
+                        # they share ts of the committing oplog so that optime never points into the middle of a transaction
+                        if is_transaction_oplog(oplog):
+                            expanded_oplogs.extend(transactions.expand(oplog))
+                            if not expanded_oplogs:
+                                need_log = self._skip_optime(oplog['ts'])
+                            continue
 
                     if oplog['op'] == 'n':  # no-op
-                        self._last_optime = oplog['ts']
-                        need_log = True
+                        need_log = self._skip_optime(oplog['ts'])
                         continue
 
                     # validate oplog
-                    if not self._conf.data_filter.valid_oplog(oplog):
+                    dbname, collname = mongo_utils.parse_namespace(oplog['ns'])
+                    if dbname in self._ignore_oplog_dbs or not self._conf.data_filter.valid_oplog(oplog):
                         n_skip += 1
-                        self._last_optime = oplog['ts']
-                        need_log = True
+                        metrics.OPLOGS_SKIPPED.labels(oplog['ns']).inc()
+                        need_log = self._skip_optime(oplog['ts'])
                         continue
 
-                    dbname, collname = mongo_utils.parse_namespace(oplog['ns'])
                     dst_dbname, dst_collname = self._conf.db_coll_mapping(dbname, collname)
                     if dst_dbname != dbname or dst_collname != collname:
+                        # copy the top level only, payloads of RawBSONDocument are still raw,
+                        # oplog might be shared with other destinations
+                        oplog = SON(oplog.items())
                         oplog['ns'] = '%s.%s' % (dst_dbname, dst_collname)
 
                     if self._stage == Stage.post_initial_sync:
                         if self._multi_oplog_replayer:
                             if mongo_utils.is_command(oplog):
-                                self._multi_oplog_replayer.apply(ignore_duplicate_key_error=True)
-                                self._multi_oplog_replayer.clear()
+                                # only wait for oplogs of namespaces that command affects
+                                namespaces = mongo_utils.get_command_namespaces(oplog)
+                                if oplog['ts'] == self._initial_sync_end_optime:
+                                    namespaces = None
+                                self._multi_oplog_replayer.apply(ignore_duplicate_key_error=True, namespaces=namespaces)
+                                self._multi_oplog_replayer.clear(namespaces)
                                 self._dst.apply_oplog(oplog)
-                                self._last_optime = oplog['ts']
-                                need_log = True
+                                if self._multi_oplog_replayer.count() == 0:
+                                    self._last_optime = oplog['ts']
+                                    need_log = True
                             else:
                                 self._multi_oplog_replayer.push(oplog)
-                                if oplog['ts'] == self._initial_sync_end_optime or self._multi_oplog_replayer.count() == self._oplog_batchsize:
-                                    self._multi_oplog_replayer.apply(ignore_duplicate_key_error=True)
-                                    self._multi_oplog_replayer.clear()
+                                if oplog['ts'] == self._initial_sync_end_optime or self._batch_ready():
+                                    self._flush_oplogs()
                                     self._last_optime = oplog['ts']
                                     need_log = True
                         else:
@@ -326,16 +835,18 @@ class MongoSyncer(CommonSyncer):
                     else:
                         if self._multi_oplog_replayer:
                             if mongo_utils.is_command(oplog):
-                                self._multi_oplog_replayer.apply()
-                                self._multi_oplog_replayer.clear()
+                                # only wait for oplogs of namespaces that command affects
+                                namespaces = mongo_utils.get_command_namespaces(oplog)
+                                self._multi_oplog_replayer.apply(namespaces=namespaces)
+                                self._multi_oplog_replayer.clear(namespaces)
                                 self._dst.apply_oplog(oplog)
-                                self._last_optime = oplog['ts']
-                                need_log = True
+                                if self._multi_oplog_replayer.count() == 0:
+                                    self._last_optime = oplog['ts']
+                                    need_log = True
                             else:
                                 self._multi_oplog_replayer.push(oplog)
-                                if self._multi_oplog_replayer.count() == self._oplog_batchsize:
-                                    self._multi_oplog_replayer.apply()
-                                    self._multi_oplog_replayer.clear()
+                                if self._batch_ready():
+                                    self._flush_oplogs()
                                     self._last_optime = oplog['ts']
                                     need_log = True
                         else:
@@ -344,38 +855,87 @@ class MongoSyncer(CommonSyncer):
                             need_log = True
                 except StopIteration as e:
                     if self._multi_oplog_replayer and self._multi_oplog_replayer.count() > 0:
-                        self._multi_oplog_replayer.apply()
-                        self._multi_oplog_replayer.clear()
+                        self._flush_oplogs()
                         self._last_optime = self._multi_oplog_replayer.last_optime()
                         need_log = True
-                    # no more oplogs, wait a moment
-                    time.sleep(0.1)
+                    # no more oplogs, reader has waited a moment
                     self._log_optime(self._last_optime)
                     self._log_progress('latest')
                 except pymongo.errors.DuplicateKeyError as e:
                     if self._stage == Stage.oplog_sync:
                         log.error(e)
                         log.error('terminate')
+                        oplog_reader.stop()
                         return
                     else:
                         log.error('ignore duplicate key error: %s' % e)
                         continue
+                except StaleOplogError as e:
+                    log.error('%s, terminate' % e)
+                    oplog_reader.stop()
+                    return
                 except pymongo.errors.AutoReconnect as e:
                     log.error(e)
-                    self._src.reconnect()
+                    oplog_reader.stop()
+                    # oplogs not applied yet will be read again
+                    if self._multi_oplog_replayer:
+                        self._multi_oplog_replayer.clear()
+                    self._reconnect_src()
                     break
 
+    def _fetch_oplog(self, query):
+        """ Return an oplog of source by query, None if not found.
 
-def logging_progress(ns, total, prog_q):
-    curr = 0
-    while True:
-        m = prog_q.get()
-        if isinstance(m, bool):
-            return
-        curr += m
-        s = '\t%s\t%d/%d\t[%.2f%%]' % (
-                ns,
-                curr,
-                total,
-                float(curr)/total*100 if total > 0 else float(curr+1)/(total+1)*100)
-        log.info(s)
+        For a sharded cluster, shards are queried in turn.
+        """
+        srcs = self._shard_srcs.values() if self._shard_srcs else [self._src]
+        for src in srcs:
+            oplog = src.client()['local']['oplog.rs'].find_one(query)
+            if oplog:
+                return oplog
+        return None
+
+    def _skip_optime(self, optime):
+        """ Move optime over an oplog that needs no replay.
+
+        Optime stays if buffered oplogs are not applied yet, otherwise they would be lost on resume.
+        Return True if moved and it's time to record it, optimes of skipped oplogs are recorded periodically
+        rather than one by one, since most oplogs might be filtered.
+        """
+        if self._multi_oplog_replayer and self._multi_oplog_replayer.count() > 0:
+            return False
+        self._last_optime = optime
+        return time.time() - self._last_optime_logtime >= SKIPPED_OPTIME_LOG_INTERVAL
+
+    def _optime_partitions(self):
+        """ Return positions of replay processes and shards.
+        """
+        partitions = self._multi_oplog_replayer.partition_optimes()
+        partitions.update(self._shard_optimes)
+        return partitions
+
+    def _batch_ready(self):
+        """ Check if buffered oplogs should be applied.
+
+        Apply if batch is full or the first oplog in buffer has waited too long.
+        """
+        return (self._multi_oplog_replayer.count() >= self._oplog_batchsize or
+                self._multi_oplog_replayer.pending_time() >= self._oplog_max_latency)
+
+    def _flush_oplogs(self):
+        """ Apply buffered oplogs and tune replay parameters.
+        """
+        n = self._multi_oplog_replayer.count()
+        start_time = time.time()
+        self._multi_oplog_replayer.apply(ignore_duplicate_key_error=(self._stage == Stage.post_initial_sync))
+        self._multi_oplog_replayer.clear()
+        metrics.REPLAY_BATCH_OPLOGS.observe(n)
+        metrics.REPLAY_BATCH_SECONDS.observe(time.time() - start_time)
+        if self._replay_controller:
+            now = time.time()
+            lag = now - self._multi_oplog_replayer.last_optime().time
+            self._replay_controller.record(n, now - start_time, lag)
+            self._oplog_batchsize = self._replay_controller.batch_size
+            self._oplog_max_latency = self._replay_controller.max_latency
+            self._multi_oplog_replayer.batch_size = self._replay_controller.vector_size
+            self._multi_oplog_replayer.n_writers = self._replay_controller.n_writers
@@ -1,5 +1,10 @@
+import datetime
+import numbers
 import pymongo
 import bson
+import bson.raw_bson
+from bson.codec_options import CodecOptions
+from bson.son import SON
 
 
 def gen_uri(hosts, username=None, password=None, authdb='admin'):
@@ -47,11 +52,15 @@ def connect(host, port, **kwargs):
         authdb = admin
         read_preference = PRIMARY
         w = 1
+        max_pool_size = 100
+        min_pool_size = 0
     """
     authdb = kwargs.get('authdb', 'admin')  # default authdb is 'admin'
     username = kwargs.get('username', '')
     password = kwargs.get('password', '')
     w = kwargs.get('w', 1)
+    max_pool_size = kwargs.get('max_pool_size', 100)
+    min_pool_size = kwargs.get('min_pool_size', 0)
     replset_name = get_replica_set_name(host, port, **kwargs)
     if replset_name:
         mc = pymongo.MongoClient(host=host,
@@ -61,14 +70,18 @@ def connect(host, port, **kwargs):
                                  serverSelectionTimeoutMS=3000,
                                  replicaSet=replset_name,
                                  read_preference=pymongo.read_preferences.ReadPreference.PRIMARY,
-                                 w=w)
+                                 w=w,
+                                 maxPoolSize=max_pool_size,
+                                 minPoolSize=min_pool_size)
     else:
         mc = pymongo.MongoClient(host,
                                  port,
                                  document_class=bson.son.SON,
                                  connect=True,
                                  serverSelectionTimeoutMS=3000,
-                                 w=w)
+                                 w=w,
+                                 maxPoolSize=max_pool_size,
+                                 minPoolSize=min_pool_size)
     if username and password and authdb:
         # raise exception if auth failed here
         mc[authdb].authenticate(username, password)
@@ -225,3 +238,159 @@ def is_command(oplog):
     if op == 'c' or (op == 'i' and '_id' not in oplog['o']):
         return True
     return False
+
+
+def is_apply_ops(oplog):
+    """ Check if oplog is an applyOps command, e.g. a transaction.
+    """
+    return oplog['op'] == 'c' and 'applyOps' in oplog['o']
+
+
+def expand_apply_ops(oplog):
+    """ Expand an applyOps oplog into oplogs of its operations.
+
+    Expanded oplogs take ts of the applyOps oplog, nested applyOps are expanded too.
+    """
+    res = []
+    for op in oplog['o']['applyOps']:
+        sub = SON(op.items())
+        sub['ts'] = oplog['ts']
+        if is_apply_ops(sub):
+            res.extend(expand_apply_ops(sub))
+        else:
+            res.append(sub)
+    return res
+
+
+def get_bson_size(doc):
+    """ Get size of a document in BSON.
+    """
+    if isinstance(doc, bson.raw_bson.RawBSONDocument):
+        return len(doc.raw)
+    return len(bson.BSON.encode(doc))
+
+
+def get_command_namespaces(oplog):
+    """ Get namespaces affected by a command oplog.
+
+    Return a set of namespaces, 'db.*' indicates all collections of database.
+    Return None if not sure, which indicates all namespaces.
+    """
+    dbname, _ = parse_namespace(oplog['ns'])
+    op = oplog['op']
+    if op == 'i':
+        # createIndex() inserts a document into *.system.indexes
+        if 'ns' not in oplog['o']:
+            return None
+        _, collname = parse_namespace(oplog['o']['ns'])
+        return set([gen_namespace(dbname, collname)])
+    elif op == 'c' and oplog['o']:
+        cmd = next(iter(oplog['o']))
+        if cmd in ['create', 'drop', 'collMod', 'createIndexes', 'dropIndexes', 'deleteIndexes', 'convertToCapped', 'emptycapped']:
+            return set([gen_namespace(dbname, oplog['o'][cmd])])
+        elif cmd == 'dropDatabase':
+            return set([gen_namespace(dbname, '*')])
+        elif cmd in ['commitTransaction', 'abortTransaction']:
+            # operations of transaction are replayed as oplogs of their namespaces
+            return set()
+    return None
+
+
+def match_namespace(ns, namespaces):
+    """ Check if namespace matches any of namespaces.
+
+    'db.*' in namespaces matches all collections of database.
+    """
+    if ns in namespaces:
+        return True
+    dbname, _ = parse_namespace(ns)
+    return gen_namespace(dbname, '*') in namespaces
+
+
+def decode_raw(doc):
+    """ Decode RawBSONDocument into SON.
+
+    RawBSONDocument in the top level of a dict is decoded too.
+    """
+    if isinstance(doc, bson.raw_bson.RawBSONDocument):
+        return bson.BSON(doc.raw).decode(codec_options=CodecOptions(document_class=SON))
+    if isinstance(doc, dict):
+        res = SON()
+        for k, v in doc.iteritems():
+            res[k] = decode_raw(v) if isinstance(v, bson.raw_bson.RawBSONDocument) else v
+        return res
+    return doc
+
+
+def get_oplog_id(oplog):
+    """ Get _id of the document that CRUD oplog operates.
+    """
+    if oplog['op'] == 'u':
+        return oplog['o2']['_id']
+    return oplog['o']['_id']
+
+
+def gen_hashable_id(_id):
+    """ Generate a hashable key for _id.
+    """
+    if isinstance(_id, bool):
+        return (bool, _id)
+    try:
+        hash(_id)
+        return _id
+    except TypeError:
+        return bson.BSON.encode({'_id': _id})
+
+
+def gen_bson_sort_key(val):
+    """ Generate a key that sorts values in the same order as MongoDB.
+
+    Raise TypeError if value type is not supported.
+
+    Refer to https://docs.mongodb.com/manual/reference/bson-type-comparison-order/
+    """
+    if isinstance(val, bson.min_key.MinKey):
+        return (1,)
+    if val is None:
+        return (2,)
+    if isinstance(val, bool):
+        return (9, val)
+    if isinstance(val, numbers.Number):
+        return (3, val)
+    if isinstance(val, bson.decimal128.Decimal128):
+        return (3, val.to_decimal())
+    if isinstance(val, unicode):
+        return (4, val.encode('utf-8'))
+    if isinstance(val, str):
+        return (4, val)
+    if isinstance(val, (dict, bson.raw_bson.RawBSONDocument)):
+        items = []
+        for k, v in val.iteritems():
+            key = gen_bson_sort_key(v)
+            items.append((key[0], k.encode('utf-8') if isinstance(k, unicode) else k, key))
+        return (5, tuple(items))
+    if isinstance(val, (list, tuple)):
+        return (6, tuple(gen_bson_sort_key(v) for v in val))
+    if isinstance(val, bson.binary.Binary):
+        return (7, len(val), val.subtype, str(val))
+    if isinstance(val, bson.objectid.ObjectId):
+        return (8, val.binary)
+    if isinstance(val, datetime.datetime):
+        return (10, val)
+    if isinstance(val, bson.timestamp.Timestamp):
+        return (11, val.time, val.inc)
+    if isinstance(val, bson.max_key.MaxKey):
+        return (13,)
+    raise TypeError('unsupported type to compare: %s' % type(val))
+
+
+def get_error_codes(e):
+    """ Get error codes of an exception, including write errors of BulkWriteError.
+    """
+    codes = set()
+    if isinstance(e, pymongo.errors.BulkWriteError):
+        for err in e.details.get('writeErrors', []):
+            codes.add(err.get('code'))
+    elif isinstance(e, pymongo.errors.OperationFailure):
+        codes.add(e.code)
+    return codes
@@ -1,12 +1,19 @@
+import time
 import pymongo
 import gevent
+import gevent.pool
 import mmh3
 import mongo_utils
-from mongosync.mongo.syncer import MongoHandler
+from mongosync import metrics
+from mongosync.mongo.handler import MongoHandler
+from mongosync.oplog_coalescer import OplogCoalescer
 from mongosync.logger import Logger
 
 log = Logger.get()
 
+# ids in a DeleteMany merged from deletes, the filter document is far below 16MB
+DELETE_MANY_MAX_IDS = 1000
+
 
 class OplogVector(object):
     """ A set of oplogs with same namespace.
@@ -20,11 +27,12 @@ class OplogVector(object):
 class MultiOplogReplayer(object):
     """ Concurrent oplog replayer for MongoDB.
     """
-    def __init__(self, mongo_handler, n_writers=10, batch_size=40):
+    def __init__(self, mongo_handler, n_writers=10, batch_size=40, coalesce=False):
         """
         Parameter:
           - n_writers: maximum coroutine count
           - batch_size: maximum oplog count in a batch, 40 is empiric value
+          - coalesce: fold oplogs with the same _id before writing
         """
         assert isinstance(mongo_handler, MongoHandler)
         assert n_writers > 0
@@ -32,15 +40,28 @@ class MultiOplogReplayer(object):
         self._mongo_handler = mongo_handler  # type of MongoHandler
         self._pool = gevent.pool.Pool(n_writers)
         self._batch_size = batch_size
+        self._coalescer = OplogCoalescer() if coalesce else None
         self._map = {}
         self._count = 0
         self._last_optime = None
+        self._first_push_time = None  # time of the first oplog in buffer
 
-    def clear(self):
+    def clear(self, namespaces=None):
         """ Clear oplogs.
+
+        Clear oplogs of the specified namespaces only if namespaces is not None.
         """
-        self._map.clear()
-        self._count = 0
+        if namespaces is None:
+            self._map.clear()
+            self._count = 0
+            self._first_push_time = None
+            return
+        for ns in self._map.keys():
+            if mongo_utils.match_namespace(ns, namespaces):
+                self._count -= len(self._map[ns])
+                del self._map[ns]
+        if self._count == 0:
+            self._first_push_time = None
 
     def push(self, oplog):
         """ Push oplog and group by namespace.
@@ -50,35 +71,50 @@ class MultiOplogReplayer(object):
             self._map[ns] = []
         self._map[ns].append(oplog)
         self._count += 1
+        if self._first_push_time is None:
+            self._first_push_time = time.time()
         self._last_optime = oplog['ts']
 
-    def apply(self, ignore_duplicate_key_error=False):
+    def apply(self, ignore_duplicate_key_error=False, namespaces=None):
         """ Apply oplogs.
+
+        Apply oplogs of the specified namespaces only if namespaces is not None,
+        it works as a barrier for commands that affect these namespaces.
         """
         oplog_vecs = []
         for ns, oplogs in self._map.iteritems():
+            if namespaces is not None and not mongo_utils.match_namespace(ns, namespaces):
+                continue
+            metrics.OPLOGS_APPLIED.labels(ns).inc(len(oplogs))
+            if self._coalescer:
+                oplogs = self._coalescer.coalesce(oplogs)
             dbname, collname = mongo_utils.parse_namespace(ns)
-            n = len(oplogs) / self._batch_size + 1
-            if n == 1:
-                vec = OplogVector(dbname, collname)
-                for oplog in oplogs:
-                    op = self.__convert(oplog)
-                    assert op is not None
-                    vec._oplogs.append(op)
-                oplog_vecs.append(vec)
+            if self._mongo_handler.shard_router:
+                # a bulk write of each group hits only one shard
+                groups = self._mongo_handler.shard_router.partition(ns, oplogs).values()
             else:
-                vecs = [OplogVector(dbname, collname) for i in xrange(n)]
-                for oplog in oplogs:
-                    op = self.__convert(oplog)
-                    assert op is not None
-                    # filter of UpdateOne/ReplaceOne/DeleteOne is {'_id': ObjectID}
-                    # @ref https://github.com/mongodb/mongo-python-driver/blob/master/pymongo/operations.py
-                    m = self.__hash(op._filter['_id'])
-                    vecs[m % n]._oplogs.append(op)
-                oplog_vecs.extend(vecs)
+                groups = [oplogs]
+            for oplogs in groups:
+                n = len(oplogs) / self._batch_size + 1
+                if n == 1:
+                    vec = OplogVector(dbname, collname)
+                    for oplog in oplogs:
+                        op = self.__convert(oplog, insert=not ignore_duplicate_key_error)
+                        assert op is not None
+                        vec._oplogs.append(op)
+                    oplog_vecs.append(vec)
+                else:
+                    vecs = [OplogVector(dbname, collname) for i in xrange(n)]
+                    for oplog in oplogs:
+                        op = self.__convert(oplog, insert=not ignore_duplicate_key_error)
+                        assert op is not None
+                        m = hash_id(mongo_utils.get_oplog_id(oplog))
+                        vecs[m % n]._oplogs.append(op)
+                    oplog_vecs.extend(vecs)
 
         for vec in oplog_vecs:
             if vec._oplogs:
+                vec._oplogs = merge_deletes(vec._oplogs)
                 self._pool.spawn(self._mongo_handler.bulk_write,
                                  vec._dbname,
                                  vec._collname,
@@ -96,8 +132,44 @@ class MultiOplogReplayer(object):
         """
         return self._last_optime
 
-    def __convert(self, oplog):
+    def partition_optimes(self):
+        """ Return a dict {partition: optime} of the last applied oplog in each partition.
+        """
+        return {}
+
+    def pending_time(self):
+        """ Return seconds that the first oplog in buffer has waited.
+        """
+        if self._first_push_time is None:
+            return 0
+        return time.time() - self._first_push_time
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, n):
+        assert n > 0
+        self._batch_size = n
+
+    @property
+    def n_writers(self):
+        return self._pool.size
+
+    @n_writers.setter
+    def n_writers(self, n):
+        """ Resize writer pool, call it between applies.
+        """
+        assert n > 0
+        if n != self._pool.size:
+            self._pool = gevent.pool.Pool(n)
+
+    def __convert(self, oplog, insert=True):
         """ Convert oplog to operation that supports bulk write.
+
+        Insert is converted to InsertOne if insert is True, otherwise ReplaceOne with upsert,
+        which is idempotent but slower.
         """
         op = oplog['op']
         if op == 'u':
@@ -113,6 +185,9 @@ class MultiOplogReplayer(object):
             else:
                 return pymongo.operations.ReplaceOne({'_id': oplog['o2']['_id']}, oplog['o'], upsert=True)
         elif op == 'i':
+            if insert:
+                # a duplicate key of _id is retried as upsert by bulk write
+                return pymongo.operations.InsertOne(oplog['o'])
             return pymongo.operations.ReplaceOne({'_id': oplog['o']['_id']}, oplog['o'], upsert=True)
         elif op == 'd':
             return pymongo.operations.DeleteOne({'_id': oplog['o']['_id']})
@@ -120,12 +195,46 @@ class MultiOplogReplayer(object):
             log.error('invaid op: %s' % oplog)
             return None
 
-    def __hash(self, oid):
-        """ Hash ObjectID with murmurhash3.
-        """
-        try:
+
+def merge_deletes(ops, max_ids=DELETE_MANY_MAX_IDS):
+    """ Merge runs of DeleteOne into DeleteMany with $in of _id.
+
+    Operations are written in order, so a run of deletes has no other operation in between,
+    and merging keeps order relative to operations on the same keys.
+    """
+    res = []
+    ids = []
+    for op in ops:
+        if isinstance(op, pymongo.operations.DeleteOne) and len(ids) < max_ids:
+            ids.append(op._filter['_id'])
+            continue
+        if ids:
+            res.append(_delete_ids(ids))
+            ids = []
+        if isinstance(op, pymongo.operations.DeleteOne):
+            ids.append(op._filter['_id'])
+        else:
+            res.append(op)
+    if ids:
+        res.append(_delete_ids(ids))
+    return res
+
+
+def _delete_ids(ids):
+    if len(ids) == 1:
+        return pymongo.operations.DeleteOne({'_id': ids[0]})
+    return pymongo.operations.DeleteMany({'_id': {'$in': ids}})
+
+
+def hash_id(oid):
+    """ Hash ObjectID with murmurhash3.
+    """
+    try:
+        if isinstance(oid, unicode):
+            m = mmh3.hash(oid.encode('utf-8'), signed=False)
+        else:
             # str(oid) may contain non-ascii characters
             m = mmh3.hash(str(oid), signed=False)
-        except Exception as e:
-            m = 0
-        return m
+    except Exception as e:
+        m = 0
+    return m
@@ -0,0 +1,148 @@
+import sys
+import multiprocessing
+import bson
+import gevent.socket
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from mongosync import metrics, mongo_utils
+from mongosync.config import MongoConfig
+from mongosync.logger import Logger
+from mongosync.mongo.handler import MongoHandler
+from mongosync.multi_oplog_replayer import MultiOplogReplayer, hash_id
+
+log = Logger.get()
+
+
+class MultiProcessOplogReplayer(MultiOplogReplayer):
+    """ Oplog replayer that applies oplogs in multiple processes.
+
+    Oplogs are partitioned by hash of (ns, _id) so that oplogs of a document are applied in order by the same process.
+    Each process applies its partition with a MultiOplogReplayer.
+    Oplogs are transported as BSON through pipes.
+    RawBSONDocument oplogs (replay.lazy_decode) are forwarded as their raw bytes,
+    while decoded oplogs are still encoded in the main process.
+    """
+    def __init__(self, mongo_handler, dst_conf, n_processes=4, n_writers=10, batch_size=40, coalesce=False, shard_routing=False, admission=None, error_policy=None):
+        """
+        Parameter:
+          - dst_conf: destination config for worker processes to connect
+          - n_processes: worker process count
+          - n_writers: maximum coroutine count in a worker
+          - batch_size: maximum oplog count in a bulk write
+          - shard_routing: route bulk writes to shards in worker processes
+          - admission: options of admission control in a worker process, disabled if None
+          - error_policy: options of error policy in a worker process, see MongoHandler.set_error_policy
+        """
+        # oplogs are coalesced in worker processes
+        MultiOplogReplayer.__init__(self, mongo_handler, n_writers=n_writers, batch_size=batch_size)
+        assert isinstance(dst_conf, MongoConfig)
+        assert n_processes > 0
+        self._n_writers = n_writers
+        self._seq = 0
+        self._optimes = {}  # {process name: optime of the last applied oplog}
+        self._procs = []
+        self._conns = []  # (oplog sender, ack receiver) of each process
+        for i in xrange(n_processes):
+            # use one-way pipes rather than socket pair, which is non-blocking after monkey patching
+            oplog_r, oplog_w = multiprocessing.Pipe(duplex=False)
+            ack_r, ack_w = multiprocessing.Pipe(duplex=False)
+            p = multiprocessing.Process(target=replay_worker,
+                                        args=(dst_conf, oplog_r, ack_w, coalesce, shard_routing, admission, error_policy),
+                                        name='replayer-%d' % i)
+            p.daemon = True
+            p.start()
+            oplog_r.close()
+            ack_w.close()
+            self._procs.append(p)
+            self._conns.append((oplog_w, ack_r))
+            log.info('start oplog replay process %s' % p.name)
+
+    def apply(self, ignore_duplicate_key_error=False, namespaces=None):
+        """ Apply oplogs and wait for all processes to acknowledge.
+        """
+        n = len(self._conns)
+        partitions = [[] for i in xrange(n)]
+        optimes = [None] * n
+        for ns, oplogs in self._map.iteritems():
+            if namespaces is not None and not mongo_utils.match_namespace(ns, namespaces):
+                continue
+            metrics.OPLOGS_APPLIED.labels(ns).inc(len(oplogs))
+            for oplog in oplogs:
+                m = (hash_id(ns) ^ hash_id(mongo_utils.get_oplog_id(oplog))) % n
+                partitions[m].append(oplog.raw if isinstance(oplog, RawBSONDocument) else bson.BSON.encode(oplog))
+                if optimes[m] is None or oplog['ts'] > optimes[m]:
+                    optimes[m] = oplog['ts']
+
+        self._seq += 1
+        header = bson.BSON.encode({'seq': self._seq,
+                                   'ignore_duplicate_key_error': ignore_duplicate_key_error,
+                                   'batch_size': self._batch_size,
+                                   'n_writers': self._n_writers})
+        busy = []
+        for i, partition in enumerate(partitions):
+            if partition:
+                oplog_w, _ = self._conns[i]
+                oplog_w.send_bytes(header + ''.join(partition))
+                busy.append(i)
+
+        for i in busy:
+            _, ack_r = self._conns[i]
+            try:
+                # wait cooperatively, so that oplog reader keeps reading
+                gevent.socket.wait_read(ack_r.fileno())
+                seq = ack_r.recv()
+            except EOFError:
+                log.error('oplog replay process %s exited' % self._procs[i].name)
+                sys.exit(1)
+            if seq != self._seq:
+                log.error('oplog replay process %s acknowledged %s, expect %s' % (self._procs[i].name, seq, self._seq))
+                sys.exit(1)
+            self._optimes[self._procs[i].name] = optimes[i]
+
+    def partition_optimes(self):
+        """ Return a dict {process name: optime} of the last applied oplog in each process.
+        """
+        return dict(self._optimes)
+
+    @property
+    def n_writers(self):
+        return self._n_writers
+
+    @n_writers.setter
+    def n_writers(self, n):
+        """ Coroutine count of each process, takes effect in the next batch.
+        """
+        assert n > 0
+        self._n_writers = n
+
+
+def replay_worker(dst_conf, oplog_r, ack_w, coalesce, shard_routing, admission, error_policy):
+    """ Apply oplogs received from pipe and acknowledge.
+    """
+    dst = MongoHandler(dst_conf)
+    dst.reconnect()
+    if shard_routing:
+        dst.enable_shard_routing()
+    if admission:
+        dst.enable_admission_control(**admission)
+    if error_policy:
+        dst.set_error_policy(**error_policy)
+    replayer = None
+    codec_options = CodecOptions(document_class=RawBSONDocument)
+    while True:
+        try:
+            data = oplog_r.recv_bytes()
+        except EOFError:
+            return
+        docs = bson.decode_all(data, codec_options)
+        header = docs[0]
+        if replayer is None:
+            replayer = MultiOplogReplayer(dst, n_writers=header['n_writers'], batch_size=header['batch_size'], coalesce=coalesce)
+        else:
+            replayer.n_writers = header['n_writers']
+            replayer.batch_size = header['batch_size']
+        for oplog in docs[1:]:
+            replayer.push(oplog)
+        replayer.apply(ignore_duplicate_key_error=header['ignore_duplicate_key_error'])
+        replayer.clear()
+        ack_w.send(header['seq'])
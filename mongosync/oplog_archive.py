@@ -0,0 +1,177 @@
+import os
+import mmap
+import bisect
+import struct
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from bson.timestamp import Timestamp
+
+# archive layout:
+#   magic, oplogs in BSON, index entries, footer
+# an index entry (ts.time, ts.inc, offset) is recorded every index interval oplogs
+MAGIC = 'MSOPLOG\x01'
+INDEX_ENTRY = struct.Struct('<IIQ')
+FOOTER = struct.Struct('<QQIIII8s')  # index offset, oplog count, first ts, last ts, magic
+FOOTER_MAGIC = 'MSOPIDX\x01'
+BSON_LENGTH = struct.Struct('<i')
+
+
+class ArchiveDone(Exception):
+    """ All oplogs of archive are replayed.
+    """
+    pass
+
+
+class ArchiveWriter(object):
+    """ Write oplogs into an archive file.
+    """
+    def __init__(self, path, index_interval=1000):
+        assert index_interval > 0
+        self._path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._index_interval = index_interval
+        self._index = []
+        self._count = 0
+        self._first_optime = None
+        self._last_optime = None
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def last_optime(self):
+        return self._last_optime
+
+    def write(self, oplog):
+        """ Append an oplog, oplogs must be written in order of ts.
+        """
+        data = oplog.raw if isinstance(oplog, RawBSONDocument) else bson.BSON.encode(oplog)
+        ts = oplog['ts']
+        if self._count % self._index_interval == 0:
+            self._index.append((ts.time, ts.inc, self._offset))
+        if self._first_optime is None:
+            self._first_optime = ts
+        self._last_optime = ts
+        self._file.write(data)
+        self._offset += len(data)
+        self._count += 1
+
+    def close(self):
+        """ Write index and footer, the archive is incomplete without them.
+        """
+        first = self._first_optime or Timestamp(0, 0)
+        last = self._last_optime or Timestamp(0, 0)
+        index_offset = self._offset
+        for entry in self._index:
+            self._file.write(INDEX_ENTRY.pack(*entry))
+        self._file.write(FOOTER.pack(index_offset, self._count, first.time, first.inc, last.time, last.inc, FOOTER_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+class ArchiveReader(object):
+    """ Read oplogs of an archive file with memory mapping.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < len(MAGIC) + FOOTER.size or self._mm[:len(MAGIC)] != MAGIC:
+            raise RuntimeError('invalid oplog archive: %s' % path)
+        index_offset, self.count, t0, i0, t1, i1, magic = FOOTER.unpack_from(self._mm, len(self._mm) - FOOTER.size)
+        if magic != FOOTER_MAGIC:
+            raise RuntimeError('incomplete oplog archive: %s' % path)
+        self.first_optime = Timestamp(t0, i0) if self.count else None
+        self.last_optime = Timestamp(t1, i1) if self.count else None
+        self._end = index_offset
+        self._index_optimes = []
+        self._index_offsets = []
+        for pos in xrange(index_offset, len(self._mm) - FOOTER.size, INDEX_ENTRY.size):
+            t, i, offset = INDEX_ENTRY.unpack_from(self._mm, pos)
+            self._index_optimes.append(Timestamp(t, i))
+            self._index_offsets.append(offset)
+
+    @property
+    def path(self):
+        return self._path
+
+    def close(self):
+        self._mm.close()
+
+    def locate(self, optime):
+        """ Return ts of the first oplog at or after optime, None if not found.
+        """
+        for ts, data in self.iter_raw(optime):
+            return ts
+        return None
+
+    def iter_raw(self, start_optime=None):
+        """ Yield (ts, BSON data) of oplogs from start optime.
+        """
+        pos = len(MAGIC)
+        if start_optime is not None:
+            i = bisect.bisect_right(self._index_optimes, start_optime) - 1
+            if i >= 0:
+                pos = self._index_offsets[i]
+        while pos < self._end:
+            length = BSON_LENGTH.unpack_from(self._mm, pos)[0]
+            data = self._mm[pos:pos + length]
+            pos += length
+            ts = RawBSONDocument(data)['ts']
+            if start_optime is not None and ts < start_optime:
+                continue
+            yield ts, data
+
+
+class ArchiveOplogReader(object):
+    """ Read oplogs of an archive from start optime.
+
+    It provides the same interface as OplogReader.
+    When exhausted, raise ArchiveDone if is_done() returns True, otherwise raise StopIteration,
+    so that applier flushes buffered oplogs.
+    """
+    def __init__(self, archive, start_optime, raw, is_done):
+        self._iter = archive.iter_raw(start_optime)
+        self._raw = raw
+        self._codec_options = CodecOptions(document_class=SON)
+        self._is_done = is_done
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def qsize(self):
+        return 0
+
+    def next(self, timeout=0.1):
+        """ Return the next oplog.
+        """
+        for ts, data in self._iter:
+            if self._raw:
+                return RawBSONDocument(data)
+            return bson.BSON(data).decode(codec_options=self._codec_options)
+        if self._is_done():
+            raise ArchiveDone()
+        raise StopIteration
+
+
+if __name__ == '__main__':
+    path = '/tmp/test_oplog_archive'
+    writer = ArchiveWriter(path, index_interval=10)
+    for i in xrange(1, 101):
+        writer.write({'ts': Timestamp(1000 + i / 3, i % 3), 'op': 'i', 'ns': 'test.coll', 'o': {'_id': i}})
+    writer.close()
+    reader = ArchiveReader(path)
+    print reader.count, reader.first_optime, reader.last_optime
+    print reader.locate(Timestamp(1020, 0)), reader.locate(Timestamp(1020, 2)), reader.locate(Timestamp(2000, 0))
+    print len(list(reader.iter_raw())), len(list(reader.iter_raw(Timestamp(1030, 1))))
+    reader.close()
+    os.remove(path)
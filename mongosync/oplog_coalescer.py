@@ -0,0 +1,294 @@
+import collections
+import numbers
+from bson.son import SON
+from mongosync import mongo_utils
+
+
+class Unfoldable(Exception):
+    """ Oplogs cannot be folded into one.
+    """
+    pass
+
+
+class OplogCoalescer(object):
+    """ Fold oplogs with the same _id in a batch.
+
+    Rules:
+      - insert/replace + ... + delete => delete, since the insert might be applied before a resume
+      - ... + insert/replace          => insert/replace with the new document
+      - insert/replace + update       => insert/replace with the updated document
+      - update + update               => update with merged modifiers
+      - delete + update               => delete
+    Only $set, $unset and $inc are folded, other modifiers are kept as they are.
+    """
+    def __init__(self):
+        pass
+
+    def coalesce(self, oplogs):
+        """ Coalesce oplogs of a namespace.
+        """
+        groups = collections.OrderedDict()
+        for oplog in oplogs:
+            key = mongo_utils.gen_hashable_id(mongo_utils.get_oplog_id(oplog))
+            # move to the end to keep order with the last oplog
+            folded = groups.pop(key, [])
+            self._fold(folded, oplog)
+            groups[key] = folded
+        res = []
+        for folded in groups.itervalues():
+            res.extend(folded)
+        return res
+
+    def _fold(self, folded, oplog):
+        """ Fold oplog into the folded oplogs of a document.
+        """
+        if not folded:
+            folded.append(oplog)
+            return
+
+        op = oplog['op']
+        last = folded[-1]
+
+        if op == 'd':
+            folded[:] = [oplog]
+            return
+
+        # fold decoded oplogs, since RawBSONDocument inflates into dict that loses order of fields
+        oplog = mongo_utils.decode_raw(oplog)
+        last = folded[-1] = mongo_utils.decode_raw(last)
+
+        if op == 'i' or not is_update(oplog):
+            # a whole new document
+            doc = oplog['o']
+            if folded[0]['op'] == 'i':
+                folded[:] = [gen_insert_oplog(oplog, doc)]
+            else:
+                folded[:] = [gen_replace_oplog(oplog, doc)]
+            return
+
+        # update
+        if last['op'] == 'd':
+            # nothing to update
+            return
+        try:
+            if last['op'] == 'i':
+                folded[-1] = gen_insert_oplog(oplog, apply_update(last['o'], oplog['o']))
+            elif not is_update(last):
+                folded[-1] = gen_replace_oplog(oplog, apply_update(last['o'], oplog['o']))
+            else:
+                folded[-1] = gen_update_oplog(oplog, merge_update(last['o'], oplog['o']))
+        except Unfoldable:
+            folded.append(oplog)
+
+
+def is_update(oplog):
+    """ Check if oplog is an update with modifiers rather than a replacement.
+    """
+    if oplog['op'] != 'u':
+        return False
+    # @ref https://docs.mongodb.com/manual/reference/limits/#naming-restrictions
+    for key in oplog['o'].iterkeys():
+        if key[0] == '$':
+            return True
+    return False
+
+
+def gen_insert_oplog(oplog, doc):
+    """ Generate an insert oplog.
+    """
+    _id, doc = get_id_and_doc(oplog, doc)
+    return {'ts': oplog['ts'], 'op': 'i', 'ns': oplog['ns'], 'o': doc}
+
+
+def gen_replace_oplog(oplog, doc):
+    """ Generate an upsert-replace oplog.
+    """
+    _id, doc = get_id_and_doc(oplog, doc)
+    return {'ts': oplog['ts'], 'op': 'u', 'ns': oplog['ns'], 'o': doc, 'o2': {'_id': _id}}
+
+
+def get_id_and_doc(oplog, doc):
+    """ Return _id of oplog and document that contains _id.
+    """
+    _id = mongo_utils.get_oplog_id(oplog)
+    if '_id' not in doc:
+        new_doc = SON([('_id', _id)])
+        new_doc.update(doc)
+        doc = new_doc
+    return _id, doc
+
+
+def gen_update_oplog(oplog, spec):
+    """ Generate an update oplog.
+    """
+    return {'ts': oplog['ts'], 'op': 'u', 'ns': oplog['ns'], 'o': spec, 'o2': oplog['o2']}
+
+
+def parse_update(spec):
+    """ Parse update spec into an ordered dict of {path: (modifier, value)}.
+    """
+    res = collections.OrderedDict()
+    for modifier, fields in spec.iteritems():
+        if modifier == '$v':
+            continue
+        if modifier not in ['$set', '$unset', '$inc']:
+            raise Unfoldable()
+        for path, val in fields.iteritems():
+            if modifier == '$inc' and not is_number(val):
+                raise Unfoldable()
+            res[path] = (modifier, val)
+    check_paths(res.keys())
+    return res
+
+
+def check_paths(paths):
+    """ Raise Unfoldable if a path is the prefix of another one.
+    """
+    s = set(paths)
+    for path in paths:
+        pos = path.find('.')
+        while pos >= 0:
+            if path[:pos] in s:
+                raise Unfoldable()
+            pos = path.find('.', pos + 1)
+
+
+def merge_update(spec1, spec2):
+    """ Merge two update specs, spec2 follows spec1.
+    """
+    res = parse_update(spec1)
+    for path, (modifier, val) in parse_update(spec2).iteritems():
+        if path in res and modifier == '$inc':
+            prev_modifier, prev_val = res.pop(path)
+            if prev_modifier == '$inc':
+                res[path] = ('$inc', add_number(prev_val, val))
+            elif prev_modifier == '$set':
+                if not is_number(prev_val):
+                    raise Unfoldable()
+                res[path] = ('$set', add_number(prev_val, val))
+            else:
+                res[path] = ('$set', val)
+        else:
+            res.pop(path, None)
+            res[path] = (modifier, val)
+    check_paths(res.keys())
+
+    spec = SON()
+    if '$v' in spec2:
+        spec['$v'] = spec2['$v']
+    elif '$v' in spec1:
+        spec['$v'] = spec1['$v']
+    for path, (modifier, val) in res.iteritems():
+        if modifier not in spec:
+            spec[modifier] = SON()
+        spec[modifier][path] = val
+    return spec
+
+
+def apply_update(doc, spec):
+    """ Apply update spec to document and return a new document.
+
+    Embedded documents on the updated paths are copied, others are shared.
+    """
+    res = copy_doc(doc)
+    for path, (modifier, val) in parse_update(spec).iteritems():
+        keys = path.split('.')
+        if keys[0] == '_id':
+            raise Unfoldable()
+        parent = get_parent(res, keys, create=(modifier != '$unset'))
+        if parent is None:
+            continue
+        key = keys[-1]
+        if modifier == '$set':
+            parent[key] = val
+        elif modifier == '$unset':
+            parent.pop(key, None)
+        elif modifier == '$inc':
+            if key not in parent:
+                parent[key] = val
+            elif is_number(parent[key]):
+                parent[key] = add_number(parent[key], val)
+            else:
+                raise Unfoldable()
+    return res
+
+
+def get_parent(doc, keys, create):
+    """ Return the copied parent document of path, or None if not existed.
+    """
+    for key in keys[:-1]:
+        if key not in doc:
+            if not create:
+                return None
+            sub = SON()
+        elif isinstance(doc[key], collections.Mapping):
+            sub = copy_doc(doc[key])
+        else:
+            # array, null or scalar
+            raise Unfoldable()
+        doc[key] = sub
+        doc = sub
+    return doc
+
+
+def copy_doc(doc):
+    """ Shallow copy a decoded document, order of fields is kept.
+    """
+    return SON([(k, v) for k, v in doc.iteritems()])
+
+
+def is_number(val):
+    """ Check if value is a number that can be added in Python.
+    """
+    return isinstance(val, numbers.Real) and not isinstance(val, bool)
+
+
+def add_number(val1, val2):
+    """ Add numbers.
+    """
+    if not is_number(val1) or not is_number(val2):
+        raise Unfoldable()
+    return val1 + val2
+
+
+# test case
+if __name__ == '__main__':
+    c = OplogCoalescer()
+
+    ins = {'ts': 1, 'op': 'i', 'ns': 'db.coll', 'o': SON([('_id', 1), ('a', 1)])}
+    upd = {'ts': 2, 'op': 'u', 'ns': 'db.coll', 'o2': {'_id': 1}, 'o': {'$set': {'b.c': 2}}}
+    inc = {'ts': 3, 'op': 'u', 'ns': 'db.coll', 'o2': {'_id': 1}, 'o': {'$inc': {'a': 2}}}
+    dele = {'ts': 4, 'op': 'd', 'ns': 'db.coll', 'o': {'_id': 1}}
+    other = {'ts': 5, 'op': 'i', 'ns': 'db.coll', 'o': SON([('_id', 2)])}
+
+    res = c.coalesce([ins, upd, inc])
+    assert len(res) == 1
+    assert res[0]['op'] == 'i'
+    assert res[0]['o'] == {'_id': 1, 'a': 3, 'b': {'c': 2}}
+    assert ins['o'] == {'_id': 1, 'a': 1}
+
+    assert c.coalesce([ins, upd, dele]) == [dele]
+    assert c.coalesce([upd, dele, other]) == [dele, other]
+
+    res = c.coalesce([upd, inc, inc])
+    assert len(res) == 1
+    assert res[0]['o'] == {'$set': {'b.c': 2}, '$inc': {'a': 4}}
+
+    push = {'ts': 6, 'op': 'u', 'ns': 'db.coll', 'o2': {'_id': 1}, 'o': {'$push': {'l': 1}}}
+    assert len(c.coalesce([upd, push, inc])) == 3
+
+    conflict = {'ts': 7, 'op': 'u', 'ns': 'db.coll', 'o2': {'_id': 1}, 'o': {'$set': {'b': 1}}}
+    assert len(c.coalesce([upd, conflict])) == 2
+
+    # order of fields is kept for RawBSONDocument
+    import bson
+    from bson.raw_bson import RawBSONDocument
+    raw_ins = RawBSONDocument(bson.BSON.encode({'ts': 8, 'op': 'i', 'ns': 'db.coll',
+                                                'o': SON([('_id', 3), ('name', 'a'), ('age', 1), ('addr', SON([('zip', 1), ('city', 'x')]))])}))
+    raw_upd = RawBSONDocument(bson.BSON.encode({'ts': 9, 'op': 'u', 'ns': 'db.coll', 'o2': {'_id': 3}, 'o': {'$set': {'addr.city': 'y'}}}))
+    res = c.coalesce([raw_ins, raw_upd])
+    assert len(res) == 1
+    assert res[0]['o'].keys() == ['_id', 'name', 'age', 'addr']
+    assert res[0]['o']['addr'].items() == [('zip', 1), ('city', 'y')]
+
+    print 'test cases all pass'
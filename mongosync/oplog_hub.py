@@ -0,0 +1,172 @@
+import gevent
+import gevent.queue
+import pymongo
+from mongosync.logger import Logger
+from mongosync.oplog_reader import StaleOplogError
+
+log = Logger.get()
+
+
+class OplogHub(object):
+    """ Read oplogs once and fan out batches to several sinks.
+
+    Each sink buffers batches in a bounded queue, and the hub waits for a sink whose buffer is full,
+    so a slow sink holds back the others only after its buffer is full.
+    Oplogs are shared by sinks, sinks must not modify them.
+    """
+    def __init__(self, open_reader, reconnect, sinks, max_batches=64):
+        """
+        Parameter:
+          - open_reader: function that returns a started OplogReader from an optime
+          - reconnect: function that reconnects source
+          - sinks: names of sinks
+          - max_batches: maximum batch count buffered for each sink
+        """
+        assert sinks
+        assert max_batches > 0
+        self._open_reader = open_reader
+        self._reconnect = reconnect
+        self._queues = dict((sink, gevent.queue.Queue(max_batches)) for sink in sinks)
+        self._start_optimes = {}  # {sink: optime to start from}
+        self._greenlet = None
+
+    def open(self, sink, start_optime):
+        """ Return an oplog reader of sink from start optime.
+
+        Reading starts from the earliest start optime once all sinks are opened,
+        sinks get no oplog until then.
+        Oplogs taken from buffer can not be read again, so a sink that is opened again, e.g. after an error,
+        is closed and gets a reader of its own.
+        """
+        if sink in self._start_optimes:
+            self.close(sink)
+            log.info('oplog sink %s is opened again, read oplog on its own from %s' % (sink, start_optime))
+            return self._open_reader(start_optime)
+        assert sink in self._queues
+        self._start_optimes[sink] = start_optime
+        reader = SinkOplogReader(self, sink, self._queues[sink], start_optime)
+        self._try_start()
+        return reader
+
+    def close(self, sink):
+        """ Close sink, oplogs are not delivered to it any more.
+        """
+        if self._queues.pop(sink, None) is not None:
+            log.info('oplog sink %s is closed' % sink)
+            self._try_start()
+
+    def _try_start(self):
+        """ Start reading if all sinks are opened.
+        """
+        if self._greenlet is not None or not self._queues:
+            return
+        if any(sink not in self._start_optimes for sink in self._queues):
+            return
+        start_optime = min(self._start_optimes[sink] for sink in self._queues)
+        log.info('start to read oplog from %s for %d sinks' % (start_optime, len(self._queues)))
+        self._greenlet = gevent.spawn(self._run, start_optime)
+
+    def _run(self, start_optime):
+        """ Read and fan out oplogs until error.
+        """
+        reader = None
+        last_optime = None
+        while self._queues:
+            try:
+                if reader is None:
+                    reader = self._open_reader(last_optime or start_optime)
+                batch = reader.next_batch()
+                if last_optime is not None and batch[0]['ts'] <= last_optime:
+                    # read again after reconnecting
+                    batch = [oplog for oplog in batch if oplog['ts'] > last_optime]
+                    if not batch:
+                        continue
+                last_optime = batch[-1]['ts']
+                self._fan_out(batch)
+            except StopIteration:
+                continue
+            except pymongo.errors.AutoReconnect as e:
+                log.error(e)
+                if reader:
+                    reader.stop()
+                    reader = None
+                self._reconnect()
+            except gevent.GreenletExit:
+                raise
+            except Exception as e:
+                log.error('read oplog failed: %s' % e)
+                if reader:
+                    reader.stop()
+                self._fan_out(e)
+                return
+        if reader:
+            reader.stop()
+
+    def _fan_out(self, item):
+        """ Put item into queue of each sink, wait if a queue is full.
+        """
+        for sink, q in self._queues.items():
+            while sink in self._queues:
+                try:
+                    q.put(item, timeout=1)
+                    break
+                except gevent.queue.Full:
+                    continue
+
+
+class SinkOplogReader(object):
+    """ Oplog reader of a sink in OplogHub.
+
+    It provides the same interface as OplogReader.
+    """
+    def __init__(self, hub, sink, q, start_optime):
+        self._hub = hub
+        self._sink = sink
+        self._q = q
+        self._start_optime = start_optime
+        self._batch = []
+        self._pos = 0
+
+    def start(self):
+        """ Hub reads for all sinks.
+        """
+        pass
+
+    def stop(self):
+        """ Close sink in hub.
+        """
+        self._hub.close(self._sink)
+
+    def qsize(self):
+        """ Return count of batches buffered for sink.
+        """
+        return self._q.qsize()
+
+    def next(self, timeout=0.1):
+        """ Return the next oplog.
+
+        Oplogs before start optime are skipped.
+        Raise StopIteration if no oplog is available before timeout.
+        """
+        while True:
+            if self._pos >= len(self._batch):
+                try:
+                    item = self._q.get(timeout=timeout)
+                except gevent.queue.Empty:
+                    raise StopIteration
+                if isinstance(item, Exception):
+                    raise item
+                self._batch = item
+                self._pos = 0
+            oplog = self._batch[self._pos]
+            self._pos += 1
+
+            # check start optime once
+            if self._start_optime is not None:
+                if oplog['ts'] < self._start_optime:
+                    continue
+                if oplog['ts'] != self._start_optime:
+                    raise StaleOplogError('oplog %s is stale' % self._start_optime)
+                log.info('oplog is ok: %s' % self._start_optime)
+                self._start_optime = None
+            return oplog
@@ -0,0 +1,246 @@
+import collections
+import gevent
+import gevent.event
+import gevent.queue
+import pymongo
+from bson.raw_bson import RawBSONDocument
+from mongosync import mongo_utils
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+# encode one of so many decoded oplogs to estimate size of the others
+SIZE_SAMPLE_INTERVAL = 100
+
+
+class StaleOplogError(Exception):
+    """ Oplog of start optime is not found.
+    """
+    pass
+
+
+class OplogReader(object):
+    """ Prefetch oplogs from a tailable cursor in a background greenlet.
+
+    Oplogs are grouped into batches and buffered in a bounded queue,
+    so reading from source overlaps with applying to destination.
+    """
+    def __init__(self, cursor, batch_size=1000, max_batches=8, max_bytes=64*1024*1024, start_optime=None):
+        """
+        Parameter:
+          - batch_size: maximum oplog count in a batch
+          - max_batches: maximum batch count in queue
+          - max_bytes: maximum bytes of buffered oplogs
+          - start_optime: if specified, the first oplog must be at it, otherwise oplog is stale
+        """
+        assert batch_size > 0
+        assert max_batches > 0
+        assert max_bytes > 0
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self._max_bytes = max_bytes
+        self._start_optime = start_optime
+        self._q = gevent.queue.Queue(max_batches)
+        self._bytes = 0  # bytes of buffered oplogs
+        self._sampled_bytes = 0
+        self._n_sampled = 0
+        self._n_unsampled = 0  # oplogs since the last sampled one
+        self._space = gevent.event.Event()
+        self._greenlet = None
+
+        # batch being consumed
+        self._batch = []
+        self._pos = 0
+
+    def start(self):
+        """ Start to read.
+        """
+        self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        """ Stop reading and close cursor.
+        """
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+        try:
+            self._cursor.close()
+        except Exception as e:
+            log.error('close oplog cursor failed: %s' % e)
+
+    def next(self, timeout=0.1):
+        """ Return the next oplog.
+
+        Raise StopIteration if no oplog is available before timeout.
+        Raise the exception that reader got, e.g. AutoReconnect or StaleOplogError.
+        """
+        if self._pos >= len(self._batch):
+            self._batch = self._next_batch(timeout)
+            self._pos = 0
+        oplog = self._batch[self._pos]
+        self._pos += 1
+        return oplog
+
+    def qsize(self):
+        """ Return count of prefetched batches in queue.
+        """
+        return self._q.qsize()
+
+    def next_batch(self, timeout=0.1):
+        """ Return the rest of current batch or the next batch.
+
+        Raise the same exceptions as next().
+        """
+        if self._pos < len(self._batch):
+            batch = self._batch[self._pos:]
+        else:
+            batch = self._next_batch(timeout)
+        self._batch = []
+        self._pos = 0
+        return batch
+
+    def _next_batch(self, timeout):
+        """ Return the next batch from queue.
+        """
+        try:
+            item = self._q.get(timeout=timeout)
+        except gevent.queue.Empty:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        batch, nbytes = item
+        self._bytes -= nbytes
+        self._space.set()
+        return batch
+
+    def _run(self):
+        """ Read oplogs until error.
+        """
+        batch = []
+        nbytes = 0
+        try:
+            while True:
+                while self._bytes >= self._max_bytes:
+                    if batch:
+                        self._q.put((batch, nbytes))
+                        batch = []
+                        nbytes = 0
+                    self._space.clear()
+                    self._space.wait()
+
+                if not self._cursor.alive:
+                    log.error('cursor is dead')
+                    raise pymongo.errors.AutoReconnect('cursor is dead')
+
+                try:
+                    oplog = self._cursor.next()
+                except StopIteration:
+                    if batch:
+                        self._q.put((batch, nbytes))
+                        batch = []
+                        nbytes = 0
+                    continue
+
+                # check start optime once
+                if self._start_optime is not None:
+                    if oplog['ts'] != self._start_optime:
+                        raise StaleOplogError('oplog %s is stale' % self._start_optime)
+                    log.info('oplog is ok: %s' % self._start_optime)
+                    self._start_optime = None
+
+                size = self._oplog_size(oplog)
+                self._bytes += size
+                batch.append(oplog)
+                nbytes += size
+
+                # hand over a partial batch if applier is idle
+                if len(batch) >= self._batch_size or self._q.empty():
+                    self._q.put((batch, nbytes))
+                    batch = []
+                    nbytes = 0
+        except gevent.GreenletExit:
+            raise
+        except Exception as e:
+            self._q.put(e)
+
+    def _oplog_size(self, oplog):
+        """ Return size of oplog in BSON.
+
+        Size of a raw oplog is exact, while a decoded oplog is estimated by average size of sampled ones,
+        since encoding every oplog again takes as much CPU as a good part of decoding.
+        """
+        if isinstance(oplog, RawBSONDocument):
+            return len(oplog.raw)
+        if self._n_sampled == 0 or self._n_unsampled >= SIZE_SAMPLE_INTERVAL:
+            size = mongo_utils.get_bson_size(oplog)
+            self._sampled_bytes += size
+            self._n_sampled += 1
+            self._n_unsampled = 0
+            return size
+        self._n_unsampled += 1
+        return self._sampled_bytes / self._n_sampled
+
+
+class MergedOplogReader(object):
+    """ Merge oplogs of shards in order of ts.
+
+    An oplog is returned only if every shard has a later one, so that a shard is never behind the others.
+    Idle shards hold back the others until they write oplogs, e.g. periodic no-ops.
+    """
+    def __init__(self, readers, on_idle=None):
+        """
+        Parameter:
+          - readers: dict {shard: OplogReader}
+          - on_idle: function called with shard that holds back other shards
+        """
+        assert readers
+        self._readers = readers
+        self._on_idle = on_idle
+        self._heads = {}  # {shard: the next oplog}
+        self._emitted = dict((shard, collections.deque()) for shard in readers)  # ts of returned oplogs
+        self._positions = {}  # {shard: ts of the last oplog at or before checkpoint}
+
+    def start(self):
+        """ Start to read.
+        """
+        for reader in self._readers.itervalues():
+            reader.start()
+
+    def stop(self):
+        """ Stop reading.
+        """
+        for reader in self._readers.itervalues():
+            reader.stop()
+
+    def next(self, timeout=0.1):
+        """ Return the next oplog in order of ts.
+
+        Raise StopIteration if a shard has no oplog available before timeout.
+        """
+        for shard, reader in self._readers.iteritems():
+            if shard not in self._heads:
+                try:
+                    self._heads[shard] = reader.next(timeout)
+                except StopIteration:
+                    if self._on_idle and self._heads:
+                        self._on_idle(shard)
+                    raise
+        shard = min(self._heads, key=lambda s: self._heads[s]['ts'])
+        oplog = self._heads.pop(shard)
+        self._emitted[shard].append(oplog['ts'])
+        return oplog
+
+    def qsize(self):
+        """ Return count of prefetched batches of all shards.
+        """
+        return sum(reader.qsize() for reader in self._readers.itervalues())
+
+    def positions(self, optime):
+        """ Return a dict {shard: ts} of the last returned oplog at or before optime for each shard.
+
+        It's the position to resume from if all oplogs at or before optime are applied.
+        """
+        for shard, q in self._emitted.iteritems():
+            while q and q[0] <= optime:
+                self._positions[shard] = q.popleft()
+        return dict(self._positions)
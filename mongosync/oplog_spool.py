@@ -0,0 +1,428 @@
+import os
+import mmap
+import glob
+import time
+import zlib
+import struct
+import bson
+import gevent
+import gevent.event
+import pymongo
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from bson.timestamp import Timestamp
+from mongosync import metrics
+from mongosync.logger import Logger
+from mongosync.oplog_reader import StaleOplogError
+
+log = Logger.get()
+
+# a block is a batch of oplogs in BSON, header is payload length and flags
+BLOCK_HEADER = struct.Struct('<IB')
+FLAG_ZLIB = 1
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+SON_CODEC_OPTIONS = CodecOptions(document_class=SON)
+
+
+class Segment(object):
+    """ A spool file of oplogs from ts of its first oplog.
+    """
+    def __init__(self, path, first_optime, size):
+        self.path = path
+        self.first_optime = first_optime
+        self.size = size
+
+
+class OplogSpool(object):
+    """ Spool oplogs of source into local files, so reading source never waits for applying to destination.
+
+    Oplogs are appended in blocks into segment files, a segment is named by ts of its first oplog,
+    and a new segment is started once the current one is full.
+    Segments before checkpoint of applier are removed, and writer waits if spool is full.
+    """
+    def __init__(self, path, segment_bytes=64*1024*1024, max_bytes=10*1024*1024*1024, compress=False):
+        """
+        Parameter:
+          - path: directory of segment files
+          - segment_bytes: bytes of a segment file
+          - max_bytes: maximum bytes of all segment files
+          - compress: compress blocks with zlib
+        """
+        assert segment_bytes > 0
+        assert max_bytes >= segment_bytes
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._path = path
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._compress = compress
+        self._segments = []  # sorted by first optime
+        self._file = None  # file of the last segment to append
+        self._last_optime = None
+        self._checkpoint = self._read_checkpoint()
+        self._checkpoint_time = 0
+        self._appended = gevent.event.Event()
+        self._space = gevent.event.Event()
+        self._writer = None
+        self._error = None  # error that stopped writer
+        self._bytes_gauge = metrics.SPOOL_BYTES.labels(path)
+        self._backlog_gauge = metrics.SPOOL_BACKLOG_BYTES.labels(path)
+        self._load()
+
+    @property
+    def first_optime(self):
+        return self._segments[0].first_optime if self._segments else None
+
+    @property
+    def last_optime(self):
+        return self._last_optime
+
+    @property
+    def checkpoint(self):
+        """ Return optime that applier has recorded, None if not recorded yet.
+        """
+        return self._checkpoint
+
+    def start_writer(self, start_optime, open_reader, reconnect):
+        """ Start to spool oplogs of source.
+
+        Source is read from the last spooled oplog if spool contains start optime,
+        otherwise spool is cleared and source is read from start optime.
+        Parameter:
+          - open_reader: function that returns a started OplogReader of RawBSONDocument from an optime
+          - reconnect: function that reconnects source
+        """
+        assert self._writer is None
+        if self._segments and self.first_optime <= start_optime <= self._last_optime:
+            log.info('spool %s contains oplogs from %s to %s' % (self._path, self.first_optime, self._last_optime))
+            start_optime = self._last_optime
+        else:
+            if self._segments:
+                log.info('spool %s does not contain %s, clear it' % (self._path, start_optime))
+            self._clear()
+        self._writer = gevent.spawn(self._run, start_optime, open_reader, reconnect)
+
+    @property
+    def writing(self):
+        return self._writer is not None
+
+    def open(self, start_optime, raw=False):
+        """ Return an oplog reader of spool from start optime.
+        """
+        assert self._writer is not None
+        return SpoolOplogReader(self, start_optime, raw=raw)
+
+    def set_checkpoint(self, optime):
+        """ Record optime that applier has recorded, segments before it are removed.
+
+        It's persisted at most once per second.
+        """
+        if optime is None or (self._checkpoint and optime <= self._checkpoint):
+            return
+        self._checkpoint = optime
+        now = time.time()
+        if now - self._checkpoint_time >= 1:
+            self._checkpoint_time = now
+            self._write_checkpoint(optime)
+            self._gc()
+
+    def stop(self):
+        """ Stop writer and close files.
+        """
+        if self._writer:
+            self._writer.kill()
+            self._writer = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _run(self, start_optime, open_reader, reconnect):
+        """ Read source and append oplogs until error.
+        """
+        reader = None
+        last_optime = None
+        while True:
+            try:
+                if reader is None:
+                    reader = open_reader(last_optime or start_optime)
+                batch = reader.next_batch()
+                if self._last_optime is not None and batch[0]['ts'] <= self._last_optime:
+                    # the last spooled oplog is read again to validate
+                    batch = [oplog for oplog in batch if oplog['ts'] > self._last_optime]
+                    if not batch:
+                        continue
+                self._append(batch)
+                last_optime = self._last_optime
+            except StopIteration:
+                continue
+            except pymongo.errors.AutoReconnect as e:
+                log.error(e)
+                if reader:
+                    reader.stop()
+                    reader = None
+                reconnect()
+            except gevent.GreenletExit:
+                if reader:
+                    reader.stop()
+                raise
+            except Exception as e:
+                log.error('spool oplog failed: %s' % e)
+                if reader:
+                    reader.stop()
+                self._error = e
+                self._appended.set()
+                return
+
+    def _append(self, batch):
+        """ Append a batch of RawBSONDocument as a block.
+        """
+        while self._bytes() >= self._max_bytes:
+            log.warning('spool %s is full, wait for applier' % self._path)
+            self._space.clear()
+            self._space.wait(timeout=10)
+
+        if self._file is None or self._segments[-1].size >= self._segment_bytes:
+            self._rotate(batch[0]['ts'])
+
+        payload = ''.join(oplog.raw for oplog in batch)
+        flags = 0
+        if self._compress:
+            payload = zlib.compress(payload, 1)
+            flags |= FLAG_ZLIB
+        self._file.write(BLOCK_HEADER.pack(len(payload), flags))
+        self._file.write(payload)
+        self._file.flush()
+        self._segments[-1].size += BLOCK_HEADER.size + len(payload)
+        self._last_optime = batch[-1]['ts']
+        self._bytes_gauge.set(self._bytes())
+
+        # wake up reader
+        self._appended.set()
+        self._appended.clear()
+
+    def _rotate(self, first_optime):
+        """ Start a new segment from first optime.
+        """
+        if self._file:
+            os.fsync(self._file.fileno())
+            self._file.close()
+        path = os.path.join(self._path, '%010d_%010d.seg' % (first_optime.time, first_optime.inc))
+        self._file = open(path, 'ab')
+        self._segments.append(Segment(path, first_optime, 0))
+        self._gc()
+
+    def _gc(self):
+        """ Remove segments before checkpoint.
+        """
+        if not self._checkpoint:
+            return
+        # all oplogs of a segment are before the next segment
+        while len(self._segments) > 1 and self._segments[1].first_optime <= self._checkpoint:
+            seg = self._segments.pop(0)
+            os.remove(seg.path)
+            log.info('remove spool segment %s' % seg.path)
+        self._bytes_gauge.set(self._bytes())
+        self._space.set()
+
+    def _bytes(self):
+        return sum(seg.size for seg in self._segments)
+
+    def _clear(self):
+        """ Remove all segments.
+        """
+        if self._file:
+            self._file.close()
+            self._file = None
+        for seg in self._segments:
+            os.remove(seg.path)
+        self._segments = []
+        self._last_optime = None
+        self._checkpoint = None
+        if os.path.exists(os.path.join(self._path, 'checkpoint')):
+            os.remove(os.path.join(self._path, 'checkpoint'))
+        self._bytes_gauge.set(0)
+
+    def _load(self):
+        """ Load segments and recover the last one.
+        """
+        for path in sorted(glob.glob(os.path.join(self._path, '*.seg'))):
+            t, i = os.path.basename(path)[:-len('.seg')].split('_')
+            self._segments.append(Segment(path, Timestamp(int(t), int(i)), os.path.getsize(path)))
+        while self._segments:
+            seg = self._segments[-1]
+            # drop partial block written before crash
+            end, last_payload = scan_blocks(seg.path)
+            if end < seg.size:
+                log.info('truncate partial block of spool segment %s at %d' % (seg.path, end))
+                with open(seg.path, 'r+b') as f:
+                    f.truncate(end)
+                seg.size = end
+            if last_payload is None:
+                os.remove(seg.path)
+                self._segments.pop()
+                continue
+            self._last_optime = bson.decode_all(last_payload, RAW_CODEC_OPTIONS)[-1]['ts']
+            self._file = open(seg.path, 'ab')
+            break
+        self._bytes_gauge.set(self._bytes())
+
+    def _read_checkpoint(self):
+        path = os.path.join(self._path, 'checkpoint')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            t, i = f.read().split()
+            return Timestamp(int(t), int(i))
+
+    def _write_checkpoint(self, optime):
+        path = os.path.join(self._path, 'checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d\n' % (optime.time, optime.inc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _next_segment(self, seg):
+        """ Return segment after seg, None if seg is the last one.
+        """
+        for s in self._segments:
+            if s.first_optime > seg.first_optime:
+                return s
+        return None
+
+    def _find_segment(self, optime):
+        """ Return the last segment from or before optime, None if not found.
+        """
+        res = None
+        for seg in self._segments:
+            if seg.first_optime <= optime:
+                res = seg
+        return res
+
+
+class SpoolOplogReader(object):
+    """ Read oplogs from spool with memory-mapped segment files.
+
+    It provides the same interface as OplogReader.
+    """
+    def __init__(self, spool, start_optime, raw=False):
+        """
+        Parameter:
+          - raw: return RawBSONDocument if True, otherwise SON
+        """
+        self._spool = spool
+        self._start_optime = start_optime
+        self._codec_options = RAW_CODEC_OPTIONS if raw else SON_CODEC_OPTIONS
+        self._seg = None
+        self._mm = None
+        self._pos = 0
+        self._oplogs = []
+        self._idx = 0
+
+    def start(self):
+        """ Spool writer reads for reader.
+        """
+        pass
+
+    def stop(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+
+    def qsize(self):
+        """ Return count of decoded blocks that are not consumed yet.
+        """
+        return 1 if self._idx < len(self._oplogs) else 0
+
+    def next(self, timeout=0.1):
+        """ Return the next oplog.
+
+        Raise StopIteration if no oplog is available before timeout.
+        Raise the exception that stopped spool writer once all spooled oplogs are read.
+        """
+        while True:
+            if self._idx >= len(self._oplogs) and not self._read_block():
+                if self._spool._error:
+                    raise self._spool._error
+                self._spool._appended.wait(timeout)
+                if not self._read_block():
+                    raise StopIteration
+            oplog = self._oplogs[self._idx]
+            self._idx += 1
+
+            # check start optime once
+            if self._start_optime is not None:
+                if oplog['ts'] < self._start_optime:
+                    continue
+                if oplog['ts'] != self._start_optime:
+                    raise StaleOplogError('oplog %s is stale' % self._start_optime)
+                log.info('oplog is ok: %s' % self._start_optime)
+                self._start_optime = None
+            return oplog
+
+    def _read_block(self):
+        """ Read and decode the next block, return False if no block is available.
+        """
+        while True:
+            if self._seg is None:
+                self._seg = self._spool._find_segment(self._start_optime) or (self._spool._segments[0] if self._spool._segments else None)
+                if self._seg is None:
+                    return False
+                self._pos = 0
+            if self._mm is None or len(self._mm) < self._seg.size:
+                # map again as segment grows
+                if self._mm:
+                    self._mm.close()
+                    self._mm = None
+                if self._seg.size > 0:
+                    with open(self._seg.path, 'rb') as f:
+                        self._mm = mmap.mmap(f.fileno(), self._seg.size, access=mmap.ACCESS_READ)
+            if self._mm is not None and self._pos + BLOCK_HEADER.size <= len(self._mm):
+                length, flags = BLOCK_HEADER.unpack_from(self._mm, self._pos)
+                end = self._pos + BLOCK_HEADER.size + length
+                if end <= len(self._mm):
+                    payload = self._mm[self._pos + BLOCK_HEADER.size:end]
+                    if flags & FLAG_ZLIB:
+                        payload = zlib.decompress(payload)
+                    self._oplogs = bson.decode_all(payload, self._codec_options)
+                    self._idx = 0
+                    self._pos = end
+                    self._update_backlog()
+                    return True
+            # move to the next segment if current one is done
+            seg = self._spool._next_segment(self._seg)
+            if seg is None:
+                return False
+            if self._mm:
+                self._mm.close()
+                self._mm = None
+            self._seg = seg
+            self._pos = 0
+
+    def _update_backlog(self):
+        n = self._seg.size - self._pos
+        for seg in self._spool._segments:
+            if seg.first_optime > self._seg.first_optime:
+                n += seg.size
+        self._spool._backlog_gauge.set(n)
+
+
+def scan_blocks(path):
+    """ Return (end of the last complete block, payload of the last complete block) of a segment file.
+    """
+    end = 0
+    last_payload = None
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            length, flags = BLOCK_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            end += BLOCK_HEADER.size + length
+            last_payload = zlib.decompress(payload) if flags & FLAG_ZLIB else payload
+    return end, last_payload
@@ -18,8 +18,9 @@ class OptimeLogger(object):
     def __del__(self):
         self._fd.close()
 
-    def write(self, optime):
+    def write(self, optime, partitions=None):
         """ Write optime.
+        Positions of partitions are not recorded in file.
         """
         self._fd.seek(0, os.SEEK_SET)
         time_data = struct.pack('I', optime.time)
@@ -0,0 +1,223 @@
+import datetime
+import numbers
+import pymongo
+from bson.objectid import ObjectId
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+# partitioners in order of trial if 'auto'
+PARTITIONERS = ('auto', 'split_vector', 'sample', 'bisect')
+
+SAMPLES_PER_PARTITION = 1000  # documents sampled for a partition
+BUCKETS_PER_PARTITION = 10  # sampled documents are grouped into buckets, buckets are merged into partitions by bytes
+BISECT_MAX_ITERATIONS = 32
+BISECT_TOLERANCE = 0.05  # of documents of a partition
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class Partitioner(object):
+    """ Split a collection into ranges of _id.
+
+    A range of _id is queried with $gte and $lt, which only match values of the same type,
+    so a collection is split only if its min and max _id are of the same type, and split points are of the type too.
+    """
+    name = None
+
+    def split(self, coll, n_partitions, collstats):
+        """ Return a list of split points, [] if not able to split.
+        """
+        raise NotImplementedError('you should implement %s.%s' % (self.__class__.__name__, self.split.__name__))
+
+
+class SplitVectorPartitioner(Partitioner):
+    """ Split by splitVector command, which is not available through mongos or without privilege of it.
+
+    splitPointCount = partitionCount - 1
+    splitPointCount = keyTotalCount / (keyCount + 1)
+    keyCount = maxChunkSize / (2 * avgObjSize)
+    =>
+    maxChunkSize = (keyTotalCount / (partionCount - 1) - 1) * 2 * avgObjSize
+
+    Note: maxChunkObjects is default 250000.
+    """
+    name = 'split_vector'
+
+    def split(self, coll, n_partitions, collstats):
+        if coll.database.client.is_mongos:
+            return []
+        max_chunk_size = ((collstats['count'] / (n_partitions - 1) - 1) * 2 * collstats['avgObjSize']) / 1024 / 1024
+        if max_chunk_size <= 0:
+            return []
+        try:
+            res = coll.database.command('splitVector', coll.full_name,
+                                        keyPattern={'_id': 1},
+                                        maxSplitPoints=n_partitions - 1,
+                                        maxChunkSize=max_chunk_size,
+                                        maxChunkObjects=collstats['count'])
+        except pymongo.errors.OperationFailure as e:
+            log.info('splitVector of %s failed: %s' % (coll.full_name, e))
+            return []
+        return [doc['_id'] for doc in res['splitKeys']]
+
+
+class SamplePartitioner(Partitioner):
+    """ Split by sampled documents, $sample and $bucketAuto require MongoDB 3.4+.
+
+    Sampled documents are grouped into buckets of _id, which are merged into partitions of about the same bytes.
+    Bytes of documents require $bsonSize of MongoDB 4.4+, otherwise partitions are of about the same count.
+    """
+    name = 'sample'
+
+    def split(self, coll, n_partitions, collstats):
+        n_samples = min(collstats['count'], n_partitions * SAMPLES_PER_PARTITION)
+        try:
+            buckets = self._sample(coll, n_samples, n_partitions * BUCKETS_PER_PARTITION, {'$bsonSize': '$$ROOT'})
+        except pymongo.errors.OperationFailure:
+            try:
+                buckets = self._sample(coll, n_samples, n_partitions * BUCKETS_PER_PARTITION, {'$literal': 1})
+            except pymongo.errors.OperationFailure as e:
+                log.info('sample %s failed: %s' % (coll.full_name, e))
+                return []
+
+        total = sum(bucket['bytes'] for bucket in buckets)
+        points = []
+        acc = 0
+        for i in xrange(len(buckets) - 1):
+            acc += buckets[i]['bytes']
+            if acc * n_partitions >= total * (len(points) + 1):
+                points.append(buckets[i + 1]['_id']['min'])
+                if len(points) == n_partitions - 1:
+                    break
+        return points
+
+    def _sample(self, coll, n_samples, n_buckets, size_expr):
+        """ Return buckets [{_id: {min: _id, max: _id}, bytes: n}] of sampled documents in order of _id.
+        """
+        pipeline = [{'$sample': {'size': n_samples}},
+                    {'$project': {'size': size_expr}},
+                    {'$bucketAuto': {'groupBy': '$_id', 'buckets': n_buckets, 'output': {'bytes': {'$sum': '$size'}}}}]
+        return list(coll.aggregate(pipeline, allowDiskUse=True))
+
+
+class BisectPartitioner(Partitioner):
+    """ Split by bisecting between min and max _id, until count of a range is about a partition.
+
+    Only for _id of numbers, ObjectIds and dates.
+    Partitions are of about the same count, i.e. the same bytes by average document size.
+    """
+    name = 'bisect'
+
+    def split(self, coll, n_partitions, collstats):
+        min_id = _first_id(coll, pymongo.ASCENDING)
+        max_id = _first_id(coll, pymongo.DESCENDING)
+        codec = _codec(min_id)
+        if codec is None:
+            log.info('bisect %s failed: not supported _id type %s' % (coll.full_name, type(min_id).__name__))
+            return []
+        encode, decode = codec
+
+        total = coll.count()
+        target = total / n_partitions
+        points = []
+        lower = min_id
+        lo_bound = encode(min_id)
+        hi_bound = encode(max_id)
+        for i in xrange(n_partitions - 1):
+            # find point that count of [lower, point) is about target
+            lo, hi = lo_bound, hi_bound
+            point = None
+            for _ in xrange(BISECT_MAX_ITERATIONS):
+                mid = decode(lo + (hi - lo) / 2)
+                n = coll.count({'_id': {'$gte': lower, '$lt': mid}})
+                point = mid
+                if abs(n - target) <= target * BISECT_TOLERANCE:
+                    break
+                if n < target:
+                    lo = encode(mid)
+                else:
+                    hi = encode(mid)
+                if hi - lo <= 1:
+                    break
+            if point is None or point <= lower or point >= max_id:
+                break
+            points.append(point)
+            lower = point
+            lo_bound = encode(point)
+        return points
+
+
+def _first_id(coll, direction):
+    doc = coll.find_one(projection={'_id': True}, sort=[('_id', direction)])
+    return doc['_id'] if doc else None
+
+
+def _type_bracket(value):
+    """ Return type of value that range queries match, all numbers are of a type.
+    """
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return numbers.Number
+    if isinstance(value, basestring):
+        return basestring
+    return type(value)
+
+
+def _codec(value):
+    """ Return functions to encode a _id into a number and decode it back, None if not supported.
+    """
+    if isinstance(value, ObjectId):
+        return lambda oid: long(str(oid), 16), lambda n: ObjectId('%024x' % n)
+    if isinstance(value, datetime.datetime):
+        return (lambda dt: _datetime_to_ms(dt),
+                lambda n: EPOCH + datetime.timedelta(milliseconds=n))
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return lambda n: n, lambda n: n
+    if isinstance(value, float):
+        return lambda n: n, lambda n: n
+    return None
+
+
+def _datetime_to_ms(dt):
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds / 1000
+
+
+_partitioners = dict((cls.name, cls()) for cls in (SplitVectorPartitioner, SamplePartitioner, BisectPartitioner))
+
+
+def split_coll(coll, n_partitions, partitioner='auto'):
+    """ Split a collection into n partitions by partitioner.
+
+    Return a list of split points, [] if not able to split.
+    If partitioner is 'auto', partitioners are tried in order until one splits.
+    """
+    if n_partitions <= 1:
+        raise RuntimeError('n_partitions need greater than 1, but %s' % n_partitions)
+    if partitioner not in PARTITIONERS:
+        raise RuntimeError('invalid partitioner: %s' % partitioner)
+
+    collstats = coll.database.command('collstats', coll.name)
+    if 'avgObjSize' not in collstats:  # empty collection
+        return []
+
+    min_id = _first_id(coll, pymongo.ASCENDING)
+    max_id = _first_id(coll, pymongo.DESCENDING)
+    if min_id is None or _type_bracket(min_id) != _type_bracket(max_id):
+        log.warn('%s is not split, _id of different types: %r, %r' % (coll.full_name, min_id, max_id))
+        return []
+    bracket = _type_bracket(min_id)
+
+    names = PARTITIONERS[1:] if partitioner == 'auto' else [partitioner]
+    for name in names:
+        points = []
+        for point in _partitioners[name].split(coll, n_partitions, collstats):
+            # drop duplicate points and points out of type
+            if _type_bracket(point) == bracket and (not points or point > points[-1]):
+                points.append(point)
+        if points:
+            log.info('split %s into %d partitions by %s' % (coll.full_name, len(points) + 1, name))
+            return points
+    return []
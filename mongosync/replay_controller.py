@@ -0,0 +1,93 @@
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+MAX_WRITERS = 50  # writers that are tuned up to by default
+
+
+class ReplayController(object):
+    """ Tune oplog replay parameters at runtime.
+
+    It works in two modes according to replication lag:
+      - catch-up: lag is large, probe larger batches and more writers while throughput grows
+      - steady: lag is small, size batches to be applied within half of max latency
+    """
+    def __init__(self,
+                 batch_size=1000, min_batch_size=100, max_batch_size=10000,
+                 vector_size=40, min_vector_size=10, max_vector_size=1000,
+                 n_writers=10, min_writers=2, max_writers=MAX_WRITERS,
+                 max_latency=1.0, catchup_lag=10):
+        """
+        Parameter:
+          - max_latency: maximum seconds that an oplog waits in buffer
+          - catchup_lag: enter catch-up mode if lag in seconds is larger than it
+        """
+        assert max_latency > 0
+        self.batch_size = self._clamp(batch_size, min_batch_size, max_batch_size)
+        self.vector_size = self._clamp(vector_size, min_vector_size, max_vector_size)
+        self.n_writers = self._clamp(n_writers, min_writers, max_writers)
+        self.max_latency = max_latency
+        self._min_batch_size = min_batch_size
+        self._max_batch_size = max_batch_size
+        self._min_vector_size = min_vector_size
+        self._max_vector_size = max_vector_size
+        self._min_writers = min_writers
+        self._max_writers = max_writers
+        self._catchup_lag = catchup_lag
+
+        self._rate = None  # smoothed oplogs per second
+        self._last_rate = None  # rate of the previous probe
+        self._catchup = False
+        self._alpha = 0.3  # smoothing factor
+
+    def record(self, n_oplogs, elapsed, lag):
+        """ Record a batch applied and adjust parameters.
+
+        Parameter:
+          - n_oplogs: oplog count of batch
+          - elapsed: seconds used to apply batch
+          - lag: seconds behind source
+        """
+        if n_oplogs <= 0:
+            return
+        rate = n_oplogs / max(elapsed, 0.001)
+        if self._rate is None:
+            self._rate = rate
+        else:
+            self._rate = self._alpha * rate + (1 - self._alpha) * self._rate
+
+        catchup = lag > self._catchup_lag
+        if catchup != self._catchup:
+            log.info('replay controller switch to %s mode, lag %d seconds' % ('catch-up' if catchup else 'steady', lag))
+            self._catchup = catchup
+            self._last_rate = None
+
+        if catchup:
+            # only full batches tell the throughput of current settings
+            if n_oplogs < self.batch_size:
+                return
+            if self._last_rate is None or self._rate >= self._last_rate * 0.95:
+                self.batch_size = self._clamp(int(self.batch_size * 1.25), self._min_batch_size, self._max_batch_size)
+                self.n_writers = self._clamp(self.n_writers + 1, self._min_writers, self._max_writers)
+            else:
+                self.batch_size = self._clamp(int(self.batch_size * 0.8), self._min_batch_size, self._max_batch_size)
+                self.n_writers = self._clamp(self.n_writers - 1, self._min_writers, self._max_writers)
+            self._last_rate = self._rate
+        else:
+            batch_size = int(self._rate * self.max_latency / 2)
+            self.batch_size = self._clamp(batch_size, self._min_batch_size, self._max_batch_size)
+            if elapsed > self.max_latency / 2:
+                self.n_writers = self._clamp(self.n_writers + 1, self._min_writers, self._max_writers)
+            elif elapsed < self.max_latency / 8:
+                self.n_writers = self._clamp(self.n_writers - 1, self._min_writers, self._max_writers)
+
+        # spread a batch over writers
+        self.vector_size = self._clamp(self.batch_size / self.n_writers, self._min_vector_size, self._max_vector_size)
+
+    @property
+    def catchup(self):
+        return self._catchup
+
+    @staticmethod
+    def _clamp(val, min_val, max_val):
+        return max(min_val, min(val, max_val))
@@ -0,0 +1,146 @@
+from bson.timestamp import Timestamp
+from mongosync import mongo_utils
+from mongosync.logger import Logger
+
+log = Logger.get()
+
+TRANSACTION_COMMANDS = ('commitTransaction', 'abortTransaction')
+
+
+def is_transaction_command(oplog):
+    """ Check if oplog commits or aborts a prepared transaction.
+    """
+    if oplog['op'] != 'c':
+        return False
+    o = oplog['o']
+    return any(cmd in o for cmd in TRANSACTION_COMMANDS)
+
+
+def is_transaction_oplog(oplog):
+    """ Check if oplog is an applyOps or a command that commits or aborts a transaction.
+    """
+    return mongo_utils.is_apply_ops(oplog) or is_transaction_command(oplog)
+
+
+class TransactionBuffer(object):
+    """ Buffer operations of transactions until they are committed.
+
+    Rules:
+      - applyOps with partialTxn (4.2+) or prepare (4.2+ sharded cluster) is buffered by (lsid, txnNumber)
+      - applyOps without them commits the buffered ones of its transaction, if any
+      - commitTransaction commits the buffered ones of a prepared transaction, abortTransaction drops them
+    Operations take ts of the oplog that commits, so that optime never points into the middle of a transaction.
+    If a transaction is committed after a resume, its oplogs before the start optime are fetched by prevOpTime.
+    """
+    def __init__(self, fetch_oplog=None):
+        """
+        Parameter:
+          - fetch_oplog: function that returns an oplog by query, None if not found
+        """
+        self._txns = {}  # {(lsid.id, lsid.uid, txnNumber): [applyOps oplog]}
+        self._fetch_oplog = fetch_oplog
+
+    def count(self):
+        """ Return count of transactions that are not committed or aborted yet.
+        """
+        return len(self._txns)
+
+    def expand(self, oplog):
+        """ Return operations to replay for a transaction oplog, [] if buffered or aborted.
+        """
+        o = oplog['o']
+        key = gen_txn_key(oplog)
+        if 'applyOps' in o:
+            if key is not None and (o.get('partialTxn') or o.get('prepare')):
+                self._txns.setdefault(key, []).append(oplog)
+                return []
+            chain = self._pop(key, oplog) if key is not None else []
+            chain.append(oplog)
+            return expand_chain(chain, oplog['ts'])
+        if 'commitTransaction' in o:
+            return expand_chain(self._pop(key, oplog), oplog['ts'])
+        # abortTransaction
+        self._txns.pop(key, None)
+        return []
+
+    def _pop(self, key, oplog):
+        """ Return buffered oplogs of transaction, which are fetched if not buffered.
+        """
+        if key in self._txns:
+            return self._txns.pop(key)
+        chain = []
+        prev = oplog.get('prevOpTime')
+        while prev and prev['ts'] != Timestamp(0, 0):
+            entry = self._fetch_oplog({'ts': prev['ts'], 'lsid.id': key[0], 'txnNumber': key[2]}) if self._fetch_oplog else None
+            if entry is None:
+                raise RuntimeError('oplog %s of transaction committed at %s is not found' % (prev['ts'], oplog['ts']))
+            chain.append(entry)
+            prev = entry.get('prevOpTime')
+        chain.reverse()
+        if chain:
+            log.info('fetched %d oplogs of transaction committed at %s' % (len(chain), oplog['ts']))
+        return chain
+
+
+def gen_txn_key(oplog):
+    """ Return key of transaction of oplog, None if not in a transaction.
+    """
+    lsid = oplog.get('lsid')
+    if lsid is None or 'txnNumber' not in oplog:
+        return None
+    return (lsid['id'], lsid.get('uid'), oplog['txnNumber'])
+
+
+def expand_chain(chain, ts):
+    """ Expand applyOps oplogs of a transaction into operations that take ts.
+    """
+    res = []
+    for oplog in chain:
+        for op in mongo_utils.expand_apply_ops(oplog):
+            op['ts'] = ts
+            res.append(op)
+    return res
+
+
+if __name__ == '__main__':
+    from bson.objectid import ObjectId
+    from mongosync.mongo.handler import OPLOG_PROJECTION
+
+    def project(oplog):
+        return dict((k, v) for k, v in oplog.iteritems() if k in OPLOG_PROJECTION)
+
+    def txn_oplog(ts, o, txn_number, prev_ts, op='c'):
+        return project({'ts': Timestamp(ts, 0), 't': 1, 'h': 0, 'v': 2, 'op': op, 'ns': 'admin.$cmd', 'o': o,
+                        'lsid': {'id': 'session', 'uid': 'user'}, 'txnNumber': txn_number,
+                        'prevOpTime': {'ts': Timestamp(prev_ts, 0), 't': 1}, 'wall': None})
+
+    def insert(_id):
+        return {'op': 'i', 'ns': 'db.coll', 'ui': ObjectId(), 'o': {'_id': _id}}
+
+    # partial transaction is applied at the last applyOps
+    buf = TransactionBuffer()
+    assert buf.expand(txn_oplog(1, {'applyOps': [insert(1)], 'partialTxn': True}, 1, 0)) == []
+    assert buf.count() == 1
+    ops = buf.expand(txn_oplog(2, {'applyOps': [insert(2)], 'count': 2}, 1, 1))
+    assert [op['o']['_id'] for op in ops] == [1, 2]
+    assert all(op['ts'] == Timestamp(2, 0) for op in ops)
+    assert buf.count() == 0
+
+    # prepared transaction is applied at commitTransaction
+    assert buf.expand(txn_oplog(3, {'applyOps': [insert(3)], 'prepare': True}, 2, 0)) == []
+    ops = buf.expand(txn_oplog(4, {'commitTransaction': 1, 'commitTimestamp': Timestamp(3, 0)}, 2, 3))
+    assert [op['o']['_id'] for op in ops] == [3]
+    assert ops[0]['ts'] == Timestamp(4, 0)
+
+    # aborted transaction is dropped
+    assert buf.expand(txn_oplog(5, {'applyOps': [insert(4)], 'prepare': True}, 3, 0)) == []
+    assert buf.expand(txn_oplog(6, {'abortTransaction': 1}, 3, 5)) == []
+    assert buf.count() == 0
+
+    # transaction committed after a resume is fetched by prevOpTime
+    prepared = txn_oplog(7, {'applyOps': [insert(5)], 'prepare': True}, 4, 0)
+    buf = TransactionBuffer(lambda query: prepared if query['ts'] == prepared['ts'] else None)
+    ops = buf.expand(txn_oplog(8, {'commitTransaction': 1, 'commitTimestamp': Timestamp(7, 0)}, 4, 7))
+    assert [op['o']['_id'] for op in ops] == [5]
+
+    print 'test cases all pass'
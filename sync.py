@@ -12,6 +12,7 @@ import sys
 from mongosync.command_options import CommandOptions
 from mongosync.config import MongoConfig, EsConfig
 from mongosync.logger import Logger
+from mongosync.mongo_utils import parse_hostportstr
 
 if __name__ == '__main__':
     conf = CommandOptions.parse()
@@ -22,7 +23,16 @@ if __name__ == '__main__':
     if conf.logfilepath:
         conf.info(sys.stdout)
 
-    if isinstance(conf.dst_conf, MongoConfig):
+    if conf.metrics_listen:
+        from mongosync import metrics
+        host, port = parse_hostportstr(conf.metrics_listen)
+        metrics.start_server(host, port)
+
+    if len(conf.dst_confs) > 1:
+        from mongosync.mongo.fanout_syncer import FanoutSyncer
+        syncer = FanoutSyncer(conf)
+        syncer.run()
+    elif isinstance(conf.dst_conf, MongoConfig):
         from mongosync.mongo.syncer import MongoSyncer
         syncer = MongoSyncer(conf)
         syncer.run()